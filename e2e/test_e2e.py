@@ -1,22 +1,43 @@
+import asyncio
+import json
+import os
 import random
+import re
+import time
+from itertools import combinations
+from typing import Any
 
+import pytest
 from anystore.io import smart_stream_json
+from anystore.logging import get_logger
+from procrastinate import utils
+from procrastinate.jobs import Status
 
 from e2e.tasks import app
-from openaleph_procrastinate.app import run_sync_worker
+from openaleph_procrastinate.app import PrefetchJobManager, run_sync_worker
+from openaleph_procrastinate.manage import sql
+from openaleph_procrastinate.manage.async_db import AsyncDb
 from openaleph_procrastinate.manage.db import Db, get_db
 from openaleph_procrastinate.manage.status import get_dataset_status, get_status
-from openaleph_procrastinate.model import DatasetJob
-from openaleph_procrastinate.settings import OpenAlephSettings
+from openaleph_procrastinate.model import DatasetJob, Job
+from openaleph_procrastinate.settings import (
+    DeferSettings,
+    OpenAlephSettings,
+    ServiceSettings,
+)
 from openaleph_procrastinate.tasks import unpack_job
 
+log = get_logger(__name__)
 
-def _setup_db() -> Db:
+
+def _setup_db(**features: Any) -> Db:
     settings = OpenAlephSettings()
     assert not settings.in_memory_db
     assert not settings.procrastinate_sync
 
+    # optional features (e.g. `fetch_fair_share=True`) are installed on demand
     db = get_db()
+    db.settings = settings.model_copy(update=features)
     db._destroy()
     db.configure()
     return db
@@ -95,3 +116,977 @@ def test_e2e_psql_status():
 
     assert d1.took is not None
     assert d1.took.total_seconds() > 0
+
+
+# the status summary as aggregated from the jobs table before the counts table
+LIVE_STATUS_SUMMARY = """
+SELECT dataset, batch, queue_name, task_name, status, COUNT(*) AS jobs
+FROM procrastinate_jobs
+GROUP BY dataset, batch, queue_name, task_name, status
+ORDER BY dataset, batch, queue_name, task_name, status
+"""
+
+
+def test_e2e_psql_status_counts():
+    db = _setup_db()
+
+    def counts() -> list[tuple]:
+        return [r[:6] for r in db.iterate_status(active_only=False)]
+
+    def live() -> list[tuple]:
+        return list(db._execute_iter(LIVE_STATUS_SUMMARY))
+
+    jobs = [
+        DatasetJob(
+            queue=random.choice(["q", "b"]),
+            batch=random.choice(["1", "2"]),
+            dataset=random.choice(["d1", "d2"]),
+            task="e2e.tasks.task_with_errors",
+        )
+        for _ in range(20)
+    ]
+    with app.open():
+        Job.defer_many(app, jobs[:10])  # one statement
+        for job in jobs[10:]:
+            job.defer(app)
+    assert sum(r[5] for r in counts()) == 20
+    assert counts() == live()
+
+    run_sync_worker(app)
+    assert counts() == live()
+    assert not list(db.iterate_status(active_only=True))
+
+    with app.open():
+        Job.defer_many(app, jobs[:5])
+    db.cancel_jobs(dataset="d1")
+    assert counts() == live()
+    db._execute("DELETE FROM procrastinate_jobs WHERE status = 'failed'")
+    assert counts() == live()
+    assert all(r[4] != "failed" for r in counts())
+
+    # filters
+    d2 = list(db.iterate_status(dataset="d2", active_only=False))
+    assert d2 == [r for r in db.iterate_status(active_only=False) if r[0] == "d2"]
+
+    def deltas() -> int:
+        rows = db._execute_iter(f"SELECT COUNT(*) FROM {sql.STATUS_DELTAS_TABLE}")
+        return list(rows)[0][0]
+
+    # while another transaction compacts, the deltas are kept and still counted
+    assert deltas() == 0
+    with db._connect() as conn:
+        conn.execute(
+            "SELECT pg_advisory_xact_lock(hashtext('procrastinate_status_counts'))"
+        )
+        with app.open():
+            Job.defer_many(app, jobs[5:10])
+        assert deltas() > 0
+        assert counts() == live()
+    db.cancel_jobs(dataset="d2")
+    assert deltas() == 0
+    assert counts() == live()
+
+    # drift is reconciled by the rebuild, not by the configuration
+    db._execute("UPDATE procrastinate_status_counts SET jobs = jobs + 100")
+    assert counts() != live()
+    db.configure()
+    assert counts() != live()
+    db.rebuild_status_counts()
+    assert counts() == live()
+
+
+def test_e2e_psql_throughput(monkeypatch):
+    monkeypatch.setenv("OPENALEPH_STATUS_THROUGHPUT", "1")
+    db = _setup_db(status_throughput=True)
+
+    def defer(n: int) -> None:
+        entities = [{"id": "a", "schema": "Thing"}, {"id": "b", "schema": "Thing"}]
+        jobs = [
+            DatasetJob(
+                queue="t",
+                dataset="d1",
+                task="e2e.tasks.task_with_errors",
+                payload={"entities": entities},
+            )
+            for _ in range(n)
+        ]
+        with app.open():
+            Job.defer_many(app, jobs)
+
+    defer(5)
+    # the worker samples when it starts, at most once per interval
+    run_sync_worker(app)
+    assert not db.sample_throughput()
+    # reading the status doesn't write
+    rows = list(db._execute_iter(f"SELECT * FROM {sql.SAMPLES_TABLE}"))
+    list(db.iterate_status(active_only=False))
+    assert list(db._execute_iter(f"SELECT * FROM {sql.SAMPLES_TABLE}")) == rows
+    # no sample older than a minute yet
+    assert all(r[8] is None for r in db.iterate_status(active_only=False))
+
+    # 10 more jobs finished since the sample of the first 5 jobs 5 minutes ago
+    db._execute(f"DELETE FROM {sql.SAMPLES_TABLE}")
+    db._execute(f"DELETE FROM {sql.SAMPLER_TABLE}")
+    assert db.sample_throughput()
+    db._execute(
+        "UPDATE procrastinate_throughput_samples "
+        "SET sampled_at = now() - interval '5 minutes'"
+    )
+    db._execute(
+        "UPDATE procrastinate_throughput_sampler "
+        "SET sampled_at = now() - interval '5 minutes'"
+    )
+    defer(10)
+    run_sync_worker(app)
+    defer(4)
+    for row in db.iterate_status(active_only=False):
+        assert 1.9 < row[8] <= 2
+        assert 3.8 < row[9] <= 4
+    d1 = get_dataset_status("d1", active_only=False)
+    assert d1.throughput is not None
+    assert d1.eta is not None
+    assert 1.9 < d1.eta.total_seconds() / 60 <= 2.1  # 4 todo at 2 jobs/min
+
+    # the sample before the window is its start, no jobs finished since
+    db._execute(
+        "UPDATE procrastinate_throughput_samples AS s "
+        "SET sampled_at = now() - interval '20 minutes', "
+        "jobs = f.jobs, entities = f.entities "
+        "FROM procrastinate_finished_counts AS f"  # a single group
+    )
+    db._execute(
+        "UPDATE procrastinate_finished_counts "
+        "SET updated_at = now() - interval '20 minutes'"
+    )
+    assert all(r[8] == 0 for r in db.iterate_status(active_only=False))
+
+    # unchanged groups aren't sampled again
+    def samples() -> int:
+        return len(list(db._execute_iter(f"SELECT * FROM {sql.SAMPLES_TABLE}")))
+
+    sampled = samples()
+    db._execute(
+        "UPDATE procrastinate_throughput_sampler "
+        "SET sampled_at = now() - interval '2 minutes'"
+    )
+    assert db.sample_throughput()
+    assert samples() == sampled
+
+    # groups idle for the whole ring buffer are removed
+    db._execute(
+        "UPDATE procrastinate_finished_counts "
+        "SET updated_at = now() - interval '2 hours'"
+    )
+    db._execute(
+        "UPDATE procrastinate_throughput_sampler "
+        "SET sampled_at = now() - interval '2 minutes'"
+    )
+    assert db.sample_throughput()
+    assert samples() == 0
+    rows = list(db._execute_iter(f"SELECT * FROM {sql.FINISHED_TABLE}"))
+    assert rows == []
+
+    # disabling removes the triggers and the counters
+    db = _setup_db()
+    defer(1)
+    run_sync_worker(app)
+    rows = list(db._execute_iter(f"SELECT * FROM {sql.FINISHED_TABLE}"))
+    assert rows == []
+
+
+def test_e2e_psql_async_db():
+    db = _setup_db()
+    async_db = AsyncDb()
+
+    jobs = [
+        DatasetJob(queue="q", dataset=d, task="e2e.tasks.task_with_errors")
+        for d in ("d1", "d2", "d2")
+    ]
+    with app.open():
+        Job.defer_many(app, jobs)
+
+    async def run():
+        try:
+            status = [s async for s in async_db.get_status()]
+            d2 = await async_db.get_dataset_status("d2")
+            missing = await async_db.get_dataset_status("missing")
+            rows = [r async for r in async_db.iterate_status(active_only=False)]
+            jobs = [j async for j in async_db.iterate_jobs(dataset="d2")]
+            return status, d2, missing, rows, jobs
+        finally:
+            await async_db.close()
+
+    status, d2, missing, rows, jobs = asyncio.run(run())
+    assert [s.name for s in status] == ["d1", "d2"]
+    assert [s.model_dump() for s in status] == [s.model_dump() for s in get_status()]
+    assert d2.todo == 2
+    assert missing.total == 0
+    assert rows == list(db.iterate_status(active_only=False))
+    assert len(jobs) == 2
+    assert {j.id for j in jobs} == {j.id for j in db.iterate_jobs(dataset="d2")}
+
+    # the instance (e.g. from the cached `get_async_db`) works in another loop
+    async def run_again():
+        try:
+            return await async_db.get_dataset_status("d2")
+        finally:
+            await async_db.close()
+
+    assert asyncio.run(run_again()).todo == 2
+
+
+def test_e2e_psql_streaming():
+    db = _setup_db()
+
+    # server side cursor in chunks of `itersize`
+    rows = db._execute_iter("SELECT generate_series(1, 10000)", itersize=100)
+    assert [r[0] for r in rows] == list(range(1, 10001))
+
+    jobs = [
+        DatasetJob(queue="q", dataset=d, task="e2e.tasks.task_with_errors")
+        for d in ("d1", "d2", "d2")
+    ]
+    with app.open():
+        Job.defer_many(app, jobs)
+
+    # binary COPY yields the same jobs
+    for kwargs in ({}, {"dataset": "d2"}, {"status": "todo"}, {"dataset": "d3"}):
+        jobs = sorted(db.iterate_jobs(**kwargs), key=lambda j: j.id)
+        dumped = sorted(db.iterate_jobs(**kwargs, dump=True), key=lambda j: j.id)
+        assert [j.model_dump() for j in jobs] == [j.model_dump() for j in dumped]
+    assert len(list(db.iterate_jobs(dataset="d2", dump=True))) == 2
+
+
+def test_e2e_psql_connection_pool():
+    db = _setup_db()
+    pool = db.get_pool()
+    assert db.get_pool() is pool
+
+    # many small queries reuse the pooled connections
+    stats = pool.get_stats()
+    for _ in range(100):
+        list(db.iterate_status())
+    db.rebuild_status_counts()
+    assert pool.get_stats().get("connections_num", 0) == stats.get("connections_num", 0)
+    assert pool.get_stats()["pool_size"] <= db.settings.db_pool_size
+
+    # autocommit is set per checkout
+    with db._connect(autocommit=True) as conn:
+        assert conn.autocommit
+    with db._connect() as conn:
+        assert not conn.autocommit
+
+    # an unfinished iteration releases its connection
+    rows = db._execute_iter("SELECT generate_series(1, 10000)", itersize=10)
+    assert next(rows) == (1,)
+    rows.close()
+    assert pool.get_stats()["pool_available"] == pool.get_stats()["pool_size"]
+
+    db.close()
+    assert db.get_pool() is not pool
+    assert len(list(db.iterate_jobs())) == 0
+
+
+def _explain_nodes(db: Db, query: str):
+    # generic plan (postgres >= 16) with the named placeholders as $n
+    names: list[str] = []
+
+    def _param(match: re.Match) -> str:
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    query = re.sub(r"%\((\w+)\)s", _param, query)
+    with db._connect() as conn:
+        conn.execute("SET LOCAL enable_seqscan = off")
+        for statement in filter(str.strip, query.split(";")):
+            cursor = conn.execute(f"EXPLAIN (GENERIC_PLAN, FORMAT JSON) {statement}")
+            plans = [cursor.fetchone()[0][0]["Plan"]]
+            while plans:
+                node = plans.pop()
+                plans.extend(node.get("Plans", []))
+                yield node
+
+
+def test_e2e_psql_compiled_filters():
+    db = _setup_db()
+
+    queries = {
+        sql.STATUS_SUMMARY: (sql.STATUS_TABLE, sql.FILTER_COLUMNS),
+        sql.STATUS_SUMMARY_ACTIVE: (sql.STATUS_TABLE, sql.FILTER_COLUMNS),
+        sql.ALL_JOBS: (sql.JOBS, sql.FILTER_COLUMNS),
+        sql.CANCEL_JOBS: (sql.JOBS, ("dataset", "batch", "queue", "task")),
+        sql.GET_FAILED_JOBS: (sql.JOBS, ("dataset", "batch", "queue", "task")),
+        sql.GET_ORPHANED_JOBS: (sql.JOBS, ("dataset", "batch", "queue", "task")),
+    }
+    for query, (table, filters) in queries.items():
+        for n in range(1, len(filters) + 1):
+            for combination in combinations(filters, n):
+                params = {name: "x" for name in combination}
+                compiled = sql.compile_filters(query, **params)
+                assert sql.FILTERS not in compiled
+                nodes = list(_explain_nodes(db, compiled))
+                scans = [n for n in nodes if n.get("Relation Name") == table]
+                assert scans, (compiled, combination)
+                assert all(n["Node Type"] != "Seq Scan" for n in scans), combination
+                if "dataset" in combination:
+                    # the leading column of the grouping index (and primary key)
+                    assert any(
+                        "dataset = " in n.get("Index Cond", "")
+                        for n in nodes
+                        if n.get("Index Name", "").startswith(table)
+                        or n.get("Index Name", "").startswith(f"idx_{table}")
+                    ), combination
+
+    # unset filters are left out
+    assert sql.compile_filters(sql.ALL_JOBS).count("%(") == 2
+
+
+def test_e2e_psql_requeue_jobs():
+    db = _setup_db()
+
+    jobs = [
+        DatasetJob(queue="q", dataset=d, task="e2e.tasks.task_with_errors")
+        for d in ["d1"] * 20 + ["d2"] * 5
+    ]
+    locked = app.configure_task(name=jobs[0].task, queue="q", queueing_lock="l")
+    with app.open():
+        Job.defer_many(app, jobs)
+        locked.defer(**jobs[0].to_args())
+    db._execute("UPDATE procrastinate_jobs SET status = 'failed' WHERE dataset = 'd1'")
+    db._execute(
+        "UPDATE procrastinate_jobs SET status = 'doing', worker_id = 12345, "
+        "abort_requested = id = (SELECT MAX(id) FROM procrastinate_jobs j "
+        "WHERE j.dataset = 'd2') "
+        "WHERE dataset = 'd2'"
+    )
+    with app.open():
+        # a waiting job holds the queueing lock of a failed job
+        locked.defer(**jobs[0].to_args())
+
+    # failed jobs, the one with a taken queueing lock is skipped
+    assert db.requeue_jobs(dataset="d1", chunk_size=7) == 20
+    rows = list(
+        db._execute_iter(
+            "SELECT status::text, attempts, COUNT(*) FROM procrastinate_jobs "
+            "WHERE dataset = 'd1' GROUP BY 1, 2 ORDER BY 1, 2"
+        )
+    )
+    assert rows == [("failed", 0, 1), ("todo", 0, 1), ("todo", 1, 20)]
+    events = list(
+        db._execute_iter(
+            "SELECT COUNT(*) FROM procrastinate_events WHERE type = 'retried'"
+        )
+    )
+    assert events == [(20,)]
+    assert db.requeue_jobs(dataset="d1") == 0
+
+    # stalled jobs, the one with a requested abort fails
+    assert len(list(db.get_orphaned_jobs(dataset="d2"))) == 5
+    assert db.requeue_jobs(stalled=True, chunk_size=2) == 4
+    rows = list(
+        db._execute_iter(
+            "SELECT status::text, attempts, COUNT(*) FROM procrastinate_jobs "
+            "WHERE dataset = 'd2' GROUP BY 1, 2 ORDER BY 1, 2"
+        )
+    )
+    assert rows == [("failed", 0, 1), ("todo", 1, 4)]
+    assert not list(db.get_orphaned_jobs())
+    assert get_dataset_status("d2").todo == 4
+
+
+def test_e2e_psql_job_pages(tmp_path):
+    db = _setup_db()
+
+    jobs = [
+        DatasetJob(queue="q", dataset=f"d{i % 2}", task="e2e.tasks.task_with_errors")
+        for i in range(25)
+    ]
+    with app.open():
+        Job.defer_many(app, jobs)
+
+    pages = list(db.iterate_job_pages(page_size=10))
+    assert [len(p.jobs) for p in pages] == [10, 10, 5]
+    ids = [j.id for p in pages for j in p.jobs]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 25
+
+    # resume after the first page, the time range is kept from the start
+    with app.open():
+        Job.defer_many(app, jobs[:1])
+    resumed = list(db.iterate_job_pages(page_size=10, resume=pages[0].token))
+    assert [j.id for p in resumed for j in p.jobs] == ids[10:]
+
+    # filters
+    d1 = [j for p in db.iterate_job_pages(dataset="d1", page_size=5) for j in p.jobs]
+    assert len(d1) == 12
+    assert all(j.dataset == "d1" for j in d1)
+
+    with pytest.raises(ValueError):
+        list(db.iterate_job_pages(resume="invalid"))
+
+    # cli export, interrupted and resumed
+    from typer.testing import CliRunner
+
+    from openaleph_procrastinate.cli import cli
+
+    out = tmp_path / "jobs.json"
+    runner = CliRunner()
+    args = ["export-jobs", "-o", str(out), "-d", "d0", "--page-size", "5"]
+    res = runner.invoke(cli, args)
+    assert res.exit_code == 0
+    exported = [j for j in smart_stream_json(str(out))]
+    assert len(exported) == 14
+    first_page = next(db.iterate_job_pages(dataset="d0", page_size=5))
+    out.write_text("\n".join(json.dumps(j) for j in exported[:5]) + "\n")
+    res = runner.invoke(cli, [*args, "--resume", first_page.token])
+    assert res.exit_code == 0
+    assert list(smart_stream_json(str(out))) == exported
+
+
+def test_e2e_psql_batch_fetch():
+    _setup_db()
+
+    jobs = [
+        DatasetJob(queue="q", dataset="d1", task="e2e.tasks.task_with_errors")
+        for _ in range(5)
+    ]
+    with app.open():
+        assert Job.defer_many(app, ((job, 10) for job in jobs)) == 5
+
+    manager = PrefetchJobManager(app.connector, batch_size=3)
+
+    async def fetch():
+        async with app.open_async():
+            fetched = await manager.fetch_jobs(["q"], worker_id=1)
+            assert len(fetched) == 3
+            # the buffer claims the remaining 2 jobs and hands out 1
+            job = await manager.fetch_job(["q"], worker_id=1)
+            assert job is not None
+            assert await manager.release_prefetched() == 1
+
+    asyncio.run(fetch())
+
+    with app.open():
+        statuses = [job.status for job in app.job_manager.list_jobs()]
+    assert statuses.count("doing") == 4
+    assert statuses.count("todo") == 1
+
+
+def test_e2e_psql_fair_share_fetch():
+    _setup_db(fetch_fair_share=True)
+
+    def make_jobs(dataset: str, n: int):
+        for _ in range(n):
+            job = DatasetJob(
+                queue="q", dataset=dataset, task="e2e.tasks.task_with_errors"
+            )
+            yield job, 50
+
+    with app.open():
+        # the small dataset is queued last with the same priority
+        Job.defer_many(app, make_jobs("big", 2_000))
+        Job.defer_many(app, make_jobs("small", 5))
+
+    async def fetch(manager: PrefetchJobManager, n: int) -> list[str]:
+        fetched = []
+        async with app.open_async():
+            for _ in range(n):
+                job = await manager.fetch_job(["q"], worker_id=1)
+                assert job is not None
+                fetched.append(job.task_kwargs["dataset"])
+        return fetched
+
+    # the datasets take turns until the small one is done
+    fair = PrefetchJobManager(app.connector, batch_size=1, fair_share=True)
+    datasets = asyncio.run(fetch(fair, 10))
+    assert datasets.count("small") == 5
+    assert all(a != b for a, b in zip(datasets, datasets[1:]))
+
+    fast = PrefetchJobManager(app.connector, batch_size=1)
+    assert set(asyncio.run(fetch(fast, 100))) == {"big"}
+    assert set(asyncio.run(fetch(fair, 100))) == {"big"}
+
+
+def test_e2e_psql_fair_share_disabled():
+    db = _setup_db(fetch_fair_share=True)
+    assert sql.DATASET_INDEXES <= db._get_indexes()
+
+    # disabling removes the triggers, the index and the bookkeeping, the fair
+    # fetch falls back to the regular fetch
+    db = _setup_db()
+    assert not sql.DATASET_INDEXES & db._get_indexes()
+    jobs = [
+        DatasetJob(queue="q", dataset=d, task="e2e.tasks.task_with_errors")
+        for d in ("d1", "d2")
+    ]
+    with app.open():
+        Job.defer_many(app, jobs)
+    rows = list(db._execute_iter(f"SELECT dataset FROM {sql.FAIR_SHARE_TABLE}"))
+    assert rows == []
+
+    manager = PrefetchJobManager(app.connector, batch_size=10, fair_share=True)
+
+    async def fetch() -> list[Job]:
+        async with app.open_async():
+            return await manager.fetch_jobs(["q"], worker_id=1)
+
+    assert len(asyncio.run(fetch())) == 1
+
+
+def test_e2e_psql_fair_share_returning_jobs():
+    db = _setup_db(fetch_fair_share=True)
+
+    jobs = [
+        DatasetJob(queue="q", dataset=d, task="e2e.tasks.task_with_errors")
+        for d in ("d1", "d2", "d2")
+    ]
+    with app.open():
+        Job.defer_many(app, jobs)
+
+    def shares() -> set[str]:
+        rows = db._execute_iter(f"SELECT dataset FROM {sql.FAIR_SHARE_TABLE}")
+        return {row[0] for row in rows}
+
+    manager = PrefetchJobManager(app.connector, batch_size=10, fair_share=True)
+
+    async def fetch() -> list[Job]:
+        async with app.open_async():
+            return await manager.fetch_jobs(["q"], worker_id=1)
+
+    def drain() -> dict[int, str]:
+        # claim all jobs, the last fetch removes the drained datasets
+        fetched: dict[int, str] = {}
+        while jobs := asyncio.run(fetch()):
+            fetched.update({j.id: j.task_kwargs["dataset"] for j in jobs if j.id})
+        assert shares() == set()
+        return fetched
+
+    assert shares() == {"d1", "d2"}
+    fetched = drain()
+    assert sorted(fetched.values()) == ["d1", "d2", "d2"]
+
+    # procrastinate retry (doing -> todo)
+    job_id, dataset = next(iter(fetched.items()))
+    with app.open():
+        app.job_manager.retry_job_by_id(job_id, retry_at=utils.utcnow())
+    assert shares() == {dataset}
+    assert drain() == {job_id: dataset}
+
+    # released prefetched jobs (doing -> todo)
+    db._execute(sql.RELEASE_JOBS, job_ids=list(fetched))
+    assert shares() == {"d1", "d2"}
+    assert drain() == fetched
+
+    # bulk requeue of failed jobs (failed -> todo)
+    db._execute("UPDATE procrastinate_jobs SET status = 'failed'")
+    assert db.requeue_jobs(dataset="d2") == 2
+    assert shares() == {"d2"}
+    assert sorted(drain().values()) == ["d2", "d2"]
+
+
+def test_e2e_psql_concurrency_limits():
+    db = _setup_db()
+
+    def make_jobs(dataset: str, n: int):
+        for _ in range(n):
+            yield DatasetJob(
+                queue="q", dataset=dataset, task="e2e.tasks.task_with_errors"
+            )
+
+    with app.open():
+        Job.defer_many(app, make_jobs("big", 10))
+        Job.defer_many(app, make_jobs("small", 2))
+
+    db.set_concurrency_limit("q", 3, dataset="big")
+    assert sql.DATASET_INDEXES <= db._get_indexes()
+    manager = PrefetchJobManager(app.connector, batch_size=1)
+
+    async def fetch(n: int) -> list[str]:
+        fetched = []
+        async with app.open_async():
+            for _ in range(n):
+                job = await manager.fetch_job(["q"], worker_id=1)
+                if job is not None:
+                    fetched.append(job.task_kwargs["dataset"])
+        return fetched
+
+    # big is capped at 3 running jobs, small isn't limited
+    datasets = asyncio.run(fetch(10))
+    assert datasets.count("big") == 3
+    assert datasets.count("small") == 2
+    limits = list(db.iterate_concurrency_limits())
+    assert limits == [("q", "big", "*", 3, 3)]
+    # the running deltas are folded into the counts
+    deltas = list(db._execute_iter(f"SELECT * FROM {sql.RUNNING_DELTAS_TABLE}"))
+    assert deltas == []
+
+    # a finished job frees a slot
+    async def finish(dataset: str) -> None:
+        async with app.open_async():
+            doing = await app.job_manager.list_jobs_async(status="doing")
+            job = next(j for j in doing if j.task_kwargs["dataset"] == dataset)
+            assert job.id is not None
+            await app.job_manager.finish_job_by_id_async(
+                job.id, Status.SUCCEEDED, delete_job=False
+            )
+
+    asyncio.run(finish("big"))
+    assert asyncio.run(fetch(2)) == ["big"]
+
+    db.remove_concurrency_limit("q", dataset="big")
+    assert len(asyncio.run(fetch(10))) == 6
+
+
+def test_e2e_psql_rate_limits():
+    db = _setup_db()
+
+    service = ServiceSettings(
+        queue="r", task="e2e.tasks.task_with_errors", max_rate=1, rate_burst=2
+    )
+    db.sync_rate_limits(DeferSettings(transcribe=service))
+
+    jobs = [DatasetJob(queue="r", dataset="d1", task=service.task) for _ in range(5)]
+    with app.open():
+        Job.defer_many(app, jobs)
+
+    async def fetch(manager: PrefetchJobManager, n: int) -> int:
+        fetched = 0
+        async with app.open_async():
+            for _ in range(n):
+                if await manager.fetch_job(["r"], worker_id=1) is not None:
+                    fetched += 1
+        return fetched
+
+    # the burst of 2 tokens is used up immediately
+    manager = PrefetchJobManager(app.connector, batch_size=1)
+    assert asyncio.run(fetch(manager, 5)) == 2
+
+    # the taken tokens are settled into the bucket by the next fetch
+    rows = list(db._execute_iter(f"SELECT tokens FROM {sql.RATE_USAGE_TABLE}"))
+    assert not rows
+    rows = list(db._execute_iter(f"SELECT tokens FROM {sql.RATE_LIMITS_TABLE}"))
+    assert len(rows) == 1 and rows[0][0] < 1
+
+    # the exhausted queue is excluded before scanning its jobs
+    rows = list(
+        db._execute_iter(
+            "SELECT procrastinate_unblocked_queues("
+            "NULL, procrastinate_blocked_scopes(NULL))"
+        )
+    )
+    assert rows == [([],)]
+
+    # a rate limited worker doesn't wait in the fetch, it schedules a wake up
+    # for when the next token is available
+    async def on_notification(**kwargs: Any) -> None:
+        pass
+
+    async def fetch_limited() -> float:
+        assert await fetch(manager, 1) == 0
+        assert manager._wake_up is not None
+        manager._wake_up.cancel()
+        return manager._wake_up.when() - asyncio.get_running_loop().time()
+
+    manager.rate_limited = True
+    manager._on_notification = on_notification
+    assert 0 < asyncio.run(fetch_limited()) <= 1
+    wait = asyncio.run(manager.backoff(["r"]))
+    assert 0 < wait <= 1
+    time.sleep(wait)
+    assert asyncio.run(fetch(manager, 1)) == 1
+
+    db.sync_rate_limits(DeferSettings())
+    assert asyncio.run(fetch(manager, 5)) == 2
+
+    # entities are counted at defer time for per entity rate limits
+    rows = list(db._execute_iter(f"SELECT DISTINCT entity_count FROM {sql.JOBS}"))
+    assert rows == [(0,)]
+
+
+def test_e2e_psql_priority_aging():
+    db = _setup_db(priority_aging={"a": 1})
+    assert sql.AGING_INDEXES <= db._get_indexes()
+
+    job = DatasetJob(queue="a", dataset="d1", task="e2e.tasks.task_with_errors")
+    with app.open():
+        for priority in (0, 50, 0, 0):
+            app.configure_task(name=job.task, queue=job.queue, priority=priority).defer(
+                **job.to_args()
+            )
+    # the first low priority job has been waiting for 2 hours, the others for
+    # 15 minutes
+    db._execute(
+        "UPDATE procrastinate_jobs SET created_at = now() - interval '2 hours' "
+        "WHERE id = %(id)s",
+        id=1,
+    )
+    db._execute(
+        "UPDATE procrastinate_jobs SET created_at = now() - interval '15 minutes' "
+        "WHERE id IN (3, 4)"
+    )
+    # a job deferred before the base priority existed gets it backfilled
+    db._execute("UPDATE procrastinate_jobs SET base_priority = NULL WHERE id = 4")
+    db._execute(sql.PRIORITY_AGING_TRIGGERS)
+
+    manager = PrefetchJobManager(app.connector, batch_size=1, priority_aging=True)
+
+    async def fetch() -> int | None:
+        async with app.open_async():
+            job = await manager.fetch_job(["a"], worker_id=1)
+            return job.id if job is not None else None
+
+    def priorities() -> dict[int, tuple[int, int]]:
+        return {
+            r[0]: r[1:]
+            for r in db._execute_iter(
+                "SELECT id, priority, base_priority FROM procrastinate_jobs"
+            )
+        }
+
+    # aged to the max priority (0 + 1/min * 120min, capped at 100), the others
+    # by one step (0 + 1/min * 15min, in steps of 10)
+    assert asyncio.run(fetch()) == 1
+    assert priorities() == {1: (100, 0), 2: (50, 50), 3: (10, 0), 4: (10, 0)}
+
+    # the aging doesn't compound and only rewrites jobs that reach a new step
+    assert asyncio.run(manager.age_priorities(force=True)) == 0
+    assert priorities() == {1: (100, 0), 2: (50, 50), 3: (10, 0), 4: (10, 0)}
+
+    # a job retried with a new priority ages from there
+    with app.open():
+        app.job_manager.retry_job_by_id(1, retry_at=utils.utcnow(), priority=20)
+    assert asyncio.run(manager.age_priorities(force=True)) == 0
+    assert priorities()[1] == (20, 20)
+    assert asyncio.run(fetch()) == 2
+
+    # without aging configured nothing changes
+    db.sync_priority_aging({})
+    assert asyncio.run(manager.age_priorities(force=True)) == 0
+
+    # disabling removes the triggers and the index
+    db.settings = db.settings.model_copy(update={"priority_aging": {}})
+    db.configure()
+    assert not sql.AGING_INDEXES & db._get_indexes()
+    with app.open():
+        app.configure_task(name=job.task, queue=job.queue, priority=30).defer(
+            **job.to_args()
+        )
+    rows = list(
+        db._execute_iter(
+            f"SELECT DISTINCT base_priority FROM {sql.JOBS} WHERE status = 'todo'"
+        )
+    )
+    assert rows == [(None,)]
+
+
+def test_e2e_psql_priority_aging_limit():
+    db = _setup_db(priority_aging={"a": 1})
+    db._execute(f"""
+        INSERT INTO {sql.JOBS} (queue_name, task_name, args, priority, created_at)
+        SELECT 'a', 'e2e.tasks.task_with_errors', '{{}}', 0,
+            now() - interval '1 hour' - i * interval '1 second'
+        FROM generate_series(1, {sql.PRIORITY_AGING_LIMIT + 10}) AS i
+        """)
+    manager = PrefetchJobManager(app.connector, batch_size=1, priority_aging=True)
+
+    async def age() -> int:
+        async with app.open_async():
+            return await manager.age_priorities(force=True)
+
+    # each run ages a limited number of jobs, the longest waiting first
+    assert asyncio.run(age()) == sql.PRIORITY_AGING_LIMIT
+    rows = list(
+        db._execute_iter(f"SELECT min(created_at) FROM {sql.JOBS} WHERE priority = 0")
+    )
+    assert (
+        rows[0][0]
+        > list(
+            db._execute_iter(
+                f"SELECT max(created_at) FROM {sql.JOBS} WHERE priority > 0"
+            )
+        )[0][0]
+    )
+    assert asyncio.run(age()) == 10
+    assert asyncio.run(age()) == 0
+
+
+@pytest.mark.parametrize("lock_heads", [False, True])
+def test_e2e_psql_lock_state(lock_heads: bool):
+    _setup_db(fetch_lock_heads=lock_heads)
+
+    job = DatasetJob(queue="l", dataset="d1", task="e2e.tasks.task_with_errors")
+    with app.open():
+        for priority in (10, 50, 10):
+            app.configure_task(
+                name=job.task, queue=job.queue, lock="L", priority=priority
+            ).defer(**job.to_args())
+        app.configure_task(name=job.task, queue=job.queue, lock="M").defer(
+            **job.to_args()
+        )
+
+    manager = PrefetchJobManager(app.connector, batch_size=1)
+
+    async def fetch() -> tuple[int | None, str | None]:
+        async with app.open_async():
+            job = await manager.fetch_job(["l"], worker_id=1)
+            if job is None:
+                return None, None
+            assert job.id is not None
+            await app.job_manager.finish_job_by_id_async(
+                job.id, Status.SUCCEEDED, delete_job=False
+            )
+            return job.id, job.lock
+
+    async def fetch_busy() -> list[str | None]:
+        # fetch without finishing: a lock only runs one job at a time
+        async with app.open_async():
+            fetched = []
+            while job := await manager.fetch_job(["l"], worker_id=1):
+                fetched.append(job.lock)
+            return fetched
+
+    # head of lock "L" is the job with the highest priority (id 2)
+    assert asyncio.run(fetch()) == (2, "L")
+    assert sorted(asyncio.run(fetch_busy()), key=str) == ["L", "M"]
+
+
+def test_e2e_psql_lock_heads():
+    db = _setup_db(fetch_lock_heads=True)
+    assert sql.LOCK_HEAD_INDEXES <= db._get_indexes()
+
+    job = DatasetJob(queue="l", dataset="d1", task="e2e.tasks.task_with_errors")
+    with app.open():
+        for priority in (10, 50, 10):
+            app.configure_task(
+                name=job.task, queue=job.queue, lock="L", priority=priority
+            ).defer(**job.to_args())
+
+    manager = PrefetchJobManager(app.connector, batch_size=1)
+
+    async def fetch() -> int | None:
+        async with app.open_async():
+            job = await manager.fetch_job(["l"], worker_id=1)
+            return job.id if job is not None else None
+
+    async def finish(job_id: int) -> None:
+        async with app.open_async():
+            await app.job_manager.finish_job_by_id_async(
+                job_id, Status.SUCCEEDED, delete_job=False
+            )
+
+    def heads() -> list[tuple[str, int | None, bool]]:
+        return list(
+            db._execute_iter(f"SELECT lock, job_id, busy FROM {sql.LOCKS_TABLE}")
+        )
+
+    assert heads() == [("L", 2, False)]
+
+    # a running job blocks the other jobs of its lock
+    assert asyncio.run(fetch()) == 2
+    assert heads() == [("L", 1, True)]
+    assert asyncio.run(fetch()) is None
+
+    # a retried job becomes the head again
+    with app.open():
+        app.job_manager.retry_job_by_id(2, retry_at=utils.utcnow())
+    assert heads() == [("L", 2, False)]
+    assert asyncio.run(fetch()) == 2
+
+    # finishing moves the head on
+    asyncio.run(finish(2))
+    assert heads() == [("L", 1, False)]
+    assert asyncio.run(fetch()) == 1
+
+    # a cancelled job is not the head anymore
+    with app.open():
+        assert app.job_manager.cancel_job_by_id(3)
+    assert heads() == [("L", None, True)]
+    assert asyncio.run(fetch()) is None
+
+    # the head is removed with the last job of its lock
+    asyncio.run(finish(1))
+    assert heads() == []
+
+    # disabling removes the triggers, the index and the lock state
+    with app.open():
+        app.configure_task(name=job.task, queue=job.queue, lock="L").defer(
+            **job.to_args()
+        )
+    assert len(heads()) == 1
+    db = _setup_db()
+    assert not sql.LOCK_HEAD_INDEXES & db._get_indexes()
+    with app.open():
+        app.configure_task(name=job.task, queue=job.queue, lock="M").defer(
+            **job.to_args()
+        )
+    assert heads() == []
+
+
+LEGACY_LOCKED_CANDIDATE = """
+SELECT jobs.id
+FROM procrastinate_jobs AS jobs
+WHERE jobs.status = 'todo'
+  AND jobs.lock IS NOT NULL
+  AND NOT EXISTS (
+      SELECT 1
+      FROM procrastinate_jobs AS other_jobs
+      WHERE other_jobs.lock = jobs.lock
+        AND (
+            other_jobs.status = 'doing'
+            OR (
+                other_jobs.status = 'todo'
+                AND (
+                    other_jobs.priority > jobs.priority
+                    OR (other_jobs.priority = jobs.priority AND other_jobs.id < jobs.id)
+                )
+            )
+        )
+  )
+ORDER BY jobs.priority DESC, jobs.id ASC
+LIMIT 1
+"""
+
+LOCKED_CANDIDATE = """
+SELECT heads.job_id
+FROM procrastinate_lock_heads AS heads
+WHERE NOT heads.busy AND heads.job_id IS NOT NULL
+ORDER BY heads.priority DESC, heads.job_id ASC
+LIMIT 1
+"""
+
+BENCHMARK_LOCKED_JOBS = """
+SET session_replication_role = replica;
+INSERT INTO procrastinate_jobs (queue_name, task_name, lock, args, priority, status)
+SELECT 'l', 'e2e.tasks.task_with_errors', 'lock-' || i, '{}', 50, 'doing'
+FROM generate_series(1, 1000) AS i;
+INSERT INTO procrastinate_jobs (queue_name, task_name, lock, args, priority, status)
+SELECT 'l', 'e2e.tasks.task_with_errors', 'lock-' || (i % 1000 + 1), '{}',
+    (i % 100) + 1, 'todo'
+FROM generate_series(1, 1000000) AS i;
+-- the only fetchable locked job, lowest priority
+INSERT INTO procrastinate_jobs (queue_name, task_name, lock, args, priority, status)
+VALUES ('l', 'e2e.tasks.task_with_errors', 'free', '{}', 0, 'todo');
+SET session_replication_role = DEFAULT;
+ANALYZE procrastinate_jobs;
+"""
+
+
+@pytest.mark.skipif(
+    not os.environ.get("E2E_BENCHMARK"), reason="set E2E_BENCHMARK=1 to run"
+)
+def test_e2e_psql_lock_state_benchmark():
+    db = _setup_db(fetch_lock_heads=True)
+    db._execute(BENCHMARK_LOCKED_JOBS)
+    db._execute(sql.REBUILD_LOCK_STATE)
+
+    def timed(query: str) -> tuple[float, int]:
+        start = time.perf_counter()
+        rows = list(db._execute_iter(query))
+        return time.perf_counter() - start, rows[0][0]
+
+    legacy_took, legacy_id = timed(LEGACY_LOCKED_CANDIDATE)
+    took, job_id = timed(LOCKED_CANDIDATE)
+    log.info("Locked job fetch", legacy=legacy_took, lock_state=took)
+    assert job_id == legacy_id
+    assert took * 10 < legacy_took
@@ -1,19 +1,27 @@
+import asyncio
 import threading
+import time
+from collections import defaultdict, deque
 from functools import cache
+from typing import Any, Iterable
 
 import procrastinate
 from anystore.logging import configure_logging, get_logger
 from anystore.util import mask_uri
 from cachetools import TTLCache, cached
 from cachetools.keys import hashkey
-from procrastinate import connector, testing, utils
+from procrastinate import connector, jobs, manager, testing, utils
 from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
 from openaleph_procrastinate.logging import patch_procrastinate_logging
-from openaleph_procrastinate.settings import OpenAlephSettings
+from openaleph_procrastinate.settings import DeferSettings, OpenAlephSettings
+from openaleph_procrastinate.util import json_dumps, json_loads
 
 log = get_logger(__name__)
 
+# min seconds between two priority aging runs of a worker
+PRIORITY_AGING_INTERVAL = 60
+
 # Thread-safe cache for get_pool function
 _pool_cache = TTLCache(maxsize=10, ttl=3600)  # 1 hour TTL
 _pool_cache_lock = threading.RLock()
@@ -35,7 +43,7 @@ def get_pool(sync: bool | None = False) -> ConnectionPool | AsyncConnectionPool
     - Active PostgreSQL connections drop to 0
     - Workers appear "hung" but are actually waiting for usable connections
 
-    Configuration rationale:
+    Configuration rationale (the durations are configurable via settings):
     - max_idle=300s (5min)
       Pool proactively closes connections before PostgreSQL kills them
     - check=ConnectionPool.check_connection is ESSENTIAL
@@ -56,22 +64,179 @@ def get_pool(sync: bool | None = False) -> ConnectionPool | AsyncConnectionPool
             min_size=1,
             max_size=settings.db_pool_size,
             check=ConnectionPool.check_connection,
-            max_idle=300,
-            max_lifetime=3600,
-            timeout=30,
+            max_idle=settings.db_pool_max_idle,
+            max_lifetime=settings.db_pool_max_lifetime,
+            timeout=settings.db_pool_timeout,
         )
     return AsyncConnectionPool(
         settings.procrastinate_db_uri,
         min_size=1,
         max_size=settings.db_pool_size,
         check=AsyncConnectionPool.check_connection,
-        max_idle=300,
-        max_lifetime=3600,
-        timeout=30,
+        max_idle=settings.db_pool_max_idle,
+        max_lifetime=settings.db_pool_max_lifetime,
+        timeout=settings.db_pool_timeout,
     )
 
 
+class PrefetchJobManager(manager.JobManager):
+    """
+    A job manager that claims up to `batch_size` jobs per fetch query (instead
+    of one round trip per job) and hands them out one by one to the worker
+    concurrency slots. Enable via `OPENALEPH_FETCH_BATCH_SIZE`, the fetch
+    function is installed via `openaleph-procrastinate init-db`.
+
+    With `fair_share`, jobs are fetched round-robin over the datasets of the
+    queues instead of strictly by priority (see `OPENALEPH_FETCH_FAIR_SHARE`).
+
+    With `rate_limited`, the worker is woken up as soon as the next token is
+    available if nothing was fetched because of a rate limit, it waits in its
+    own loop meanwhile (see `max_rate` in the
+    [stage settings][openaleph_procrastinate.settings.ServiceSettings]).
+
+    With `priority_aging`, the worker raises the priority of long waiting jobs
+    every `PRIORITY_AGING_INTERVAL` seconds (see `OPENALEPH_PRIORITY_AGING`).
+    """
+
+    def __init__(
+        self,
+        connector: connector.BaseConnector,
+        batch_size: int,
+        fair_share: bool | None = False,
+        rate_limited: bool | None = False,
+        priority_aging: bool | None = False,
+    ) -> None:
+        super().__init__(connector=connector)
+        self.batch_size = batch_size
+        self.fair_share = fair_share
+        self.rate_limited = rate_limited
+        self.priority_aging = priority_aging
+        self._aged_at: float | None = None
+        self._prefetched: defaultdict[int, deque[jobs.Job]] = defaultdict(deque)
+        self._on_notification: manager.NotificationCallback | None = None
+        self._wake_up: asyncio.TimerHandle | None = None
+        self._woken: asyncio.Future[None] | None = None
+
+    async def listen_for_jobs(
+        self,
+        *,
+        on_notification: manager.NotificationCallback,
+        queues: Iterable[str] | None = None,
+    ) -> None:
+        # keep the callback of the worker to wake it up after a rate limit
+        self._on_notification = on_notification
+        await super().listen_for_jobs(on_notification=on_notification, queues=queues)
+
+    async def fetch_job(
+        self, queues: Iterable[str] | None, worker_id: int
+    ) -> jobs.Job | None:
+        prefetched = self._prefetched[worker_id]
+        if self.priority_aging:
+            await self.age_priorities()
+        if not prefetched:
+            prefetched.extend(await self.fetch_jobs(queues, worker_id))
+        if not prefetched and self.rate_limited:
+            await self.backoff(queues)
+        if prefetched:
+            return prefetched.popleft()
+        return None
+
+    async def fetch_jobs(
+        self, queues: Iterable[str] | None, worker_id: int
+    ) -> list[jobs.Job]:
+        """Claim up to `batch_size` jobs in one query, in fetch order"""
+        # avoid circular import
+        from openaleph_procrastinate.manage import sql
+
+        rows = await self.connector.execute_query_all_async(
+            query=sql.FAIR_FETCH_JOBS if self.fair_share else sql.BATCH_FETCH_JOBS,
+            queues=list(queues) if queues is not None else None,
+            worker_id=worker_id,
+            limit=self.batch_size,
+        )
+        fetched = [jobs.Job.from_row(row) for row in rows]
+        if self.fair_share:  # already in round-robin order
+            return fetched
+        return sorted(fetched, key=lambda j: (-j.priority, j.id or 0))
+
+    async def backoff(self, queues: Iterable[str] | None) -> float:
+        """Schedule a wake up of the worker for when the next rate limit token
+        for the given queues is available. The worker waits in its loop (which
+        is interrupted by a shutdown), without notifications it polls."""
+        # avoid circular import
+        from openaleph_procrastinate.manage import sql
+
+        row = await self.connector.execute_query_one_async(
+            query=sql.RATE_LIMIT_WAIT,
+            queues=list(queues) if queues is not None else None,
+        )
+        wait = float(row["wait"] or 0)
+        if wait > 0 and self._on_notification is not None:
+            log.debug("Rate limited, backing off ...", wait=wait)
+            if self._wake_up is not None:
+                self._wake_up.cancel()
+            self._wake_up = asyncio.get_running_loop().call_later(wait, self.wake_up)
+        return wait
+
+    def wake_up(self) -> None:
+        """Notify the worker as if a new job was deferred"""
+        self._wake_up = None
+        if self._on_notification is not None:
+            self._woken = asyncio.ensure_future(
+                self._on_notification(
+                    channel="procrastinate_any_queue_v1",
+                    notification={"type": "job_inserted", "job_id": 0},
+                )
+            )
+
+    async def age_priorities(self, force: bool | None = False) -> int:
+        """Raise the priority of waiting jobs of the queues with priority aging
+        (at most every `PRIORITY_AGING_INTERVAL` seconds)"""
+        # avoid circular import
+        from openaleph_procrastinate.manage import sql
+
+        now = time.monotonic()
+        if not force and self._aged_at is not None:
+            if now - self._aged_at < PRIORITY_AGING_INTERVAL:
+                return 0
+        self._aged_at = now
+        row = await self.connector.execute_query_one_async(query=sql.AGE_PRIORITIES)
+        aged = int(row["aged"] or 0)
+        if aged:
+            log.info("Aged job priorities.", jobs=aged)
+        return aged
+
+    async def release_prefetched(self) -> int:
+        """Put prefetched but not started jobs back to the queue"""
+        # avoid circular import
+        from openaleph_procrastinate.manage import sql
+
+        job_ids = [j.id for p in self._prefetched.values() for j in p if j.id]
+        self._prefetched.clear()
+        if job_ids:
+            await self.connector.execute_query_async(
+                query=sql.RELEASE_JOBS, job_ids=job_ids
+            )
+            log.info("Released prefetched jobs.", jobs=len(job_ids))
+        return len(job_ids)
+
+
 class App(procrastinate.App):
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        settings = OpenAlephSettings()
+        rate_limited = any(s.max_rate for s in DeferSettings().services.values())
+        aging = bool(settings.priority_aging)
+        prefetch = settings.fetch_batch_size > 1 or settings.fetch_fair_share
+        if (prefetch or rate_limited or aging) and not settings.in_memory_db:
+            self.job_manager = PrefetchJobManager(
+                self.connector,
+                settings.fetch_batch_size,
+                fair_share=settings.fetch_fair_share,
+                rate_limited=rate_limited,
+                priority_aging=aging,
+            )
+
     def open(
         self, pool_or_engine: connector.Pool | connector.Engine | None = None
     ) -> procrastinate.App:
@@ -86,6 +251,40 @@ class App(procrastinate.App):
             pool = get_pool()
         return super().open_async(pool)
 
+    async def run_worker_async(self, **kwargs: Any) -> None:
+        """Sample the throughput (with `status_throughput`) while the worker
+        runs and release prefetched jobs when it stops"""
+        sampler = None
+        if OpenAlephSettings().status_throughput and not isinstance(
+            self.connector, testing.InMemoryConnector
+        ):
+            sampler = asyncio.create_task(self.sample_throughput())
+        try:
+            await super().run_worker_async(**kwargs)
+        finally:
+            if sampler is not None:
+                sampler.cancel()
+            if isinstance(self.job_manager, PrefetchJobManager):
+                await self.job_manager.release_prefetched()
+
+    async def sample_throughput(self) -> None:
+        """Sample the finished jobs counters for the status throughput every
+        `THROUGHPUT_INTERVAL` seconds (at most once per interval across all
+        workers)"""
+        # avoid circular import
+        from openaleph_procrastinate.manage import sql
+
+        while True:
+            try:
+                await self.connector.execute_query_one_async(
+                    query=sql.SAMPLE_THROUGHPUT,
+                    interval=sql.THROUGHPUT_INTERVAL,
+                    slots=sql.THROUGHPUT_SLOTS,
+                )
+            except Exception as e:
+                log.warning(f"Could not sample the throughput: {e}")
+            await asyncio.sleep(sql.THROUGHPUT_INTERVAL)
+
 
 @cache
 def in_memory_connector() -> testing.InMemoryConnector:
@@ -101,8 +300,12 @@ def get_connector(sync: bool | None = False) -> connector.BaseConnector:
         return in_memory_connector()
     db_uri = settings.procrastinate_db_uri
     if sync:
-        return procrastinate.SyncPsycopgConnector(conninfo=db_uri)
-    return procrastinate.PsycopgConnector(conninfo=db_uri)
+        return procrastinate.SyncPsycopgConnector(
+            conninfo=db_uri, json_dumps=json_dumps, json_loads=json_loads
+        )
+    return procrastinate.PsycopgConnector(
+        conninfo=db_uri, json_dumps=json_dumps, json_loads=json_loads
+    )
 
 
 @cache
@@ -129,3 +332,10 @@ def run_sync_worker(app: App) -> None:
     # used for testing. Force using async connector with re-initializing app:
     app = make_app(list(app.import_paths)[0])
     app.run_worker(wait=False)
+
+
+async def run_worker_async(app: App) -> None:
+    # used for testing in async context, see `run_sync_worker`
+    app = make_app(list(app.import_paths)[0])
+    async with app.open_async():
+        await app.run_worker_async(wait=False)
@@ -1,16 +1,20 @@
-from typing import Annotated, Optional
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Annotated, Any, Iterable, Optional
 
 import typer
 from anystore.cli import ErrorHandler
-from anystore.io import logged_items, smart_stream_json
+from anystore.io import logged_items, smart_open, smart_stream_json
 from anystore.logging import configure_logging, get_logger
+from anystore.util import Took
 from ftmq.io import smart_read_proxies
 from rich import print
 
 from openaleph_procrastinate import __version__, model, tasks
-from openaleph_procrastinate.app import make_app
-from openaleph_procrastinate.manage.db import get_db
+from openaleph_procrastinate.app import App, make_app
+from openaleph_procrastinate.manage.db import REQUEUE_CHUNK_SIZE, get_db
 from openaleph_procrastinate.settings import OpenAlephSettings
+from openaleph_procrastinate.util import batched, json_dumps
 
 settings = OpenAlephSettings()
 
@@ -26,6 +30,57 @@ OPT_DATASET_REQUIRED = typer.Option(..., "-d", help="Dataset")
 OPT_QUEUE_REQUIRED = typer.Option(..., "-q", help="Queue name")
 OPT_TASK_REQUIRED = typer.Option(..., "-t", help="Task module path")
 
+OPT_BATCH_SIZE = typer.Option(
+    1, "--batch-size", min=1, help="Number of entities per job"
+)
+OPT_CHUNK_SIZE = typer.Option(
+    None, "--chunk-size", min=1, help="Number of jobs per insert query"
+)
+OPT_CONCURRENCY = typer.Option(
+    1, "--concurrency", min=1, help="Number of parallel database inserts"
+)
+
+
+def _defer_concurrent(
+    app: App,
+    jobs: Iterable[model.Job],
+    chunk_size: int | None = None,
+    concurrency: int = 1,
+) -> int:
+    """
+    Defer jobs in chunks with up to `concurrency` inserts running in parallel
+    while the input is still being read. At most `concurrency * 2` chunks are
+    pending at once, so memory stays bounded for arbitrarily large inputs.
+    """
+    chunk_size = chunk_size or settings.defer_chunk_size
+    pending = threading.BoundedSemaphore(concurrency * 2)
+    failed = threading.Event()
+    futures: list[Future[int]] = []
+
+    def _done(future: Future[int]) -> None:
+        if future.exception() is not None:
+            failed.set()
+        pending.release()
+
+    with Took() as t, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for chunk in batched(jobs, chunk_size):
+            pending.acquire()
+            if failed.is_set():
+                pending.release()
+                break
+            future = executor.submit(model.Job.defer_many, app, chunk, chunk_size)
+            future.add_done_callback(_done)
+            futures.append(future)
+    # re-raises the first insert error (if any)
+    deferred = sum(f.result() for f in futures)
+    seconds = t.took.total_seconds()
+    log.info(
+        f"Deferred {deferred} jobs.",
+        took=t.took,
+        jobs_per_second=round(deferred / seconds, 2) if seconds else None,
+    )
+    return deferred
+
 
 @cli.callback(invoke_without_command=True)
 def cli_opal_procrastinate(
@@ -50,29 +105,40 @@ def defer_entities(
     dataset: str = OPT_DATASET_REQUIRED,
     queue: str = OPT_QUEUE_REQUIRED,
     task: str = OPT_TASK_REQUIRED,
+    batch_size: int = OPT_BATCH_SIZE,
+    chunk_size: Optional[int] = OPT_CHUNK_SIZE,
+    concurrency: int = OPT_CONCURRENCY,
 ):
     """
     Defer jobs for a stream of proxies
     """
     app = make_app()
     with ErrorHandler(log), app.open():
-        for proxy in smart_read_proxies(input_uri):
-            job = model.DatasetJob.from_entities(
-                dataset=dataset, queue=queue, task=task, entities=[proxy]
+        proxies = smart_read_proxies(input_uri)
+        proxies = logged_items(proxies, "Defer", 10_000, "Entity", log)
+        jobs = (
+            model.DatasetJob.from_entities(
+                dataset=dataset, queue=queue, task=task, entities=entities
             )
-            job.defer(app)
+            for entities in batched(proxies, batch_size)
+        )
+        _defer_concurrent(app, jobs, chunk_size, concurrency)
 
 
 @cli.command()
-def defer_jobs(input_uri: str = OPT_INPUT_URI):
+def defer_jobs(
+    input_uri: str = OPT_INPUT_URI,
+    chunk_size: Optional[int] = OPT_CHUNK_SIZE,
+    concurrency: int = OPT_CONCURRENCY,
+):
     """
     Defer jobs from an input json stream
     """
     app = make_app()
     with ErrorHandler(log), app.open():
-        for data in smart_stream_json(input_uri):
-            job = tasks.unpack_job(data)
-            job.defer(app)
+        data = logged_items(smart_stream_json(input_uri), "Defer", 10_000, "Job", log)
+        jobs = (job for item in data if (job := tasks.unpack_job(item)) is not None)
+        _defer_concurrent(app, jobs, chunk_size, concurrency)
 
 
 @cli.command()
@@ -105,61 +171,176 @@ def ensure_indexes(
         db.ensure_indexes(force=force)
 
 
+@cli.command()
+def export_jobs(
+    output_uri: str = typer.Option("-", "-o", help="Output uri, default stdout"),
+    dataset: str | None = OPT_DATASET,
+    queue: str | None = OPT_QUEUE,
+    task: str | None = OPT_TASK,
+    status: Annotated[Optional[model.Status], typer.Option(help="Job status")] = None,
+    page_size: Annotated[
+        int, typer.Option("--page-size", min=1, help="Number of jobs per query")
+    ] = 1_000,
+    resume: Annotated[
+        Optional[str],
+        typer.Option(help="Resume token of the last exported page (appends output)"),
+    ] = None,
+) -> None:
+    """
+    Export jobs matching the given filters as json lines, page by page. The
+    resume token of each exported page is logged, use it with --resume (and the
+    same filters) to continue an interrupted export.
+    """
+    with ErrorHandler(log):
+        if settings.in_memory_db:
+            log.error("Cannot export jobs with in-memory database")
+            raise typer.Exit(1)
+        db = get_db()
+        pages = db.iterate_job_pages(
+            dataset=dataset,
+            queue=queue,
+            task=task,
+            status=status,
+            page_size=page_size,
+            resume=resume,
+        )
+        exported = 0
+        with smart_open(output_uri, "ab" if resume else "wb") as fh:
+            for page in pages:
+                for job in page.jobs:
+                    fh.write(json_dumps(job.model_dump(mode="json")) + b"\n")
+                fh.flush()
+                exported += len(page.jobs)
+                log.info(f"Exported {exported} jobs.", jobs=exported, resume=page.token)
+
+
+@cli.command()
+def rebuild_status() -> None:
+    """Recount the jobs per dataset, batch, queue, task and status that the
+    status summary is read from"""
+    with ErrorHandler(log):
+        if settings.in_memory_db:
+            return
+        db = get_db()
+        db.rebuild_status_counts()
+
+
+@cli.command()
+def set_limit(
+    queue: str = OPT_QUEUE_REQUIRED,
+    max_doing: Annotated[
+        Optional[int],
+        typer.Option("--max", min=0, help="Max number of running jobs (required)"),
+    ] = None,
+    dataset: str | None = OPT_DATASET,
+    batch: Annotated[Optional[str], typer.Option(help="Batch (requires -d)")] = None,
+) -> None:
+    """
+    Limit the number of concurrently running jobs for a queue, optionally only
+    for a dataset (or a batch of a dataset) within it.
+    """
+    if max_doing is None:
+        raise typer.BadParameter("Missing the max number of jobs", param_hint="--max")
+    with ErrorHandler(log):
+        if settings.in_memory_db:
+            log.error("Cannot set limits with in-memory database")
+            raise typer.Exit(1)
+        db = get_db()
+        db.set_concurrency_limit(queue, max_doing, dataset=dataset, batch=batch)
+
+
+@cli.command()
+def remove_limit(
+    queue: str = OPT_QUEUE_REQUIRED,
+    dataset: str | None = OPT_DATASET,
+    batch: Annotated[Optional[str], typer.Option(help="Batch (requires -d)")] = None,
+) -> None:
+    """Remove a concurrency limit"""
+    with ErrorHandler(log):
+        if settings.in_memory_db:
+            log.error("Cannot remove limits with in-memory database")
+            raise typer.Exit(1)
+        db = get_db()
+        db.remove_concurrency_limit(queue, dataset=dataset, batch=batch)
+
+
+@cli.command()
+def limits() -> None:
+    """Show the concurrency limits and the currently running jobs"""
+    with ErrorHandler(log):
+        if settings.in_memory_db:
+            return
+        db = get_db()
+        for queue, dataset, batch, max_doing, doing in db.iterate_concurrency_limits():
+            print(f"{queue}\t{dataset}\t{batch}\t{doing}/{max_doing}")
+
+
+OPT_REQUEUE_CHUNK_SIZE = typer.Option(
+    REQUEUE_CHUNK_SIZE, "--chunk-size", min=1, help="Number of jobs per update query"
+)
+OPT_PER_JOB = typer.Option(
+    False, "--per-job", help="Retry the jobs one by one via the job manager"
+)
+
+
+def _retry_per_job(rows: Iterable[tuple[Any, ...]], action: str) -> int:
+    """Retry the given (id, queue_name, priority, lock) job rows one by one
+    via procrastinate's job manager"""
+    from procrastinate import utils
+
+    app = make_app(sync=True)
+    requeued = 0
+    with app.open():
+        for job_id, queue_name, priority, lock in logged_items(
+            rows, action, 1000, "Job", log
+        ):
+            try:
+                app.job_manager.retry_job_by_id(
+                    job_id=job_id,
+                    retry_at=utils.utcnow(),
+                    priority=priority,
+                    lock=lock,
+                )
+                requeued += 1
+                log.debug(f"Requeued job {job_id}", job_id=job_id, queue=queue_name)
+            except Exception as e:
+                log.error(
+                    f"Failed to requeue job {job_id}: {e}",
+                    job_id=job_id,
+                    error=str(e),
+                )
+    return requeued
+
+
 @cli.command()
 def requeue_failed(
     dataset: str | None = OPT_DATASET,
     queue: str | None = OPT_QUEUE,
     task: str | None = OPT_TASK,
-):
+    chunk_size: int = OPT_REQUEUE_CHUNK_SIZE,
+    per_job: bool = OPT_PER_JOB,
+) -> None:
     """
     Requeue failed jobs matching the given filters.
 
     This command finds all jobs with status='failed' that match the optional filters
     (dataset, queue, task) and retries them by setting their status back to 'todo'.
+    The jobs are retried in chunks of set based updates, use --per-job to retry
+    them one by one via the procrastinate job manager instead.
     """
-    from procrastinate import utils
-
     with ErrorHandler(log):
         if settings.in_memory_db:
             log.error("Cannot requeue jobs with in-memory database")
             raise typer.Exit(1)
 
         db = get_db()
-        app = make_app(sync=True)
-
-        # Get failed jobs logging iterator
-        failed_jobs = logged_items(
-            db.get_failed_jobs(
-                dataset=dataset,
-                queue=queue,
-                task=task,
-            ),
-            "Requeuing",
-            1000,
-            "Job",
-            log,
-        )
-
-        # Retry each job using the job manager
-        with app.open():
-            requeued = 0
-            for job_id, queue_name, priority, lock in failed_jobs:
-                try:
-                    app.job_manager.retry_job_by_id(
-                        job_id=job_id,
-                        retry_at=utils.utcnow(),
-                        priority=priority,
-                        queue=queue_name,
-                        lock=lock,
-                    )
-                    requeued += 1
-                    log.debug(f"Requeued job {job_id}", job_id=job_id, queue=queue_name)
-                except Exception as e:
-                    log.error(
-                        f"Failed to requeue job {job_id}: {e}",
-                        job_id=job_id,
-                        error=str(e),
-                    )
+        if per_job:
+            failed_jobs = db.get_failed_jobs(dataset=dataset, queue=queue, task=task)
+            requeued = _retry_per_job(failed_jobs, "Requeuing")
+        else:
+            requeued = db.requeue_jobs(
+                dataset=dataset, queue=queue, task=task, chunk_size=chunk_size
+            )
 
         if not requeued:
             log.info("No failed jobs found matching the filters")
@@ -170,62 +351,39 @@ def requeue_stalled(
     dataset: str | None = OPT_DATASET,
     queue: str | None = OPT_QUEUE,
     task: str | None = OPT_TASK,
-):
+    chunk_size: int = OPT_REQUEUE_CHUNK_SIZE,
+    per_job: bool = OPT_PER_JOB,
+) -> None:
     """
     Requeue stalled/orphaned jobs matching the given filters.
 
     This command finds all jobs with status='doing' whose worker no longer exists
     (orphaned jobs) and retries them by setting their status back to 'todo'.
+    The jobs are retried in chunks of set based updates, use --per-job to retry
+    them one by one via the procrastinate job manager instead.
 
     Orphaned jobs can occur when the foreign key constraint on worker_id is dropped
     (for performance) and workers are pruned before completing their jobs.
     """
-    from procrastinate import utils
-
     with ErrorHandler(log):
         if settings.in_memory_db:
             log.error("Cannot requeue jobs with in-memory database")
             raise typer.Exit(1)
 
         db = get_db()
-        app = make_app(sync=True)
-
-        # Get orphaned jobs logging iterator
-        orphaned_jobs = logged_items(
-            db.get_orphaned_jobs(
+        if per_job:
+            orphaned_jobs = db.get_orphaned_jobs(
+                dataset=dataset, queue=queue, task=task
+            )
+            requeued = _retry_per_job(orphaned_jobs, "Requeuing stalled")
+        else:
+            requeued = db.requeue_jobs(
                 dataset=dataset,
                 queue=queue,
                 task=task,
-            ),
-            "Requeuing stalled",
-            1000,
-            "Job",
-            log,
-        )
-
-        # Retry each job using the job manager
-        with app.open():
-            requeued = 0
-            for job_id, queue_name, priority, lock in orphaned_jobs:
-                try:
-                    app.job_manager.retry_job_by_id(
-                        job_id=job_id,
-                        retry_at=utils.utcnow(),
-                        priority=priority,
-                        lock=lock,
-                    )
-                    requeued += 1
-                    log.debug(
-                        f"Requeued stalled job {job_id}",
-                        job_id=job_id,
-                        queue=queue_name,
-                    )
-                except Exception as e:
-                    log.error(
-                        f"Failed to requeue stalled job {job_id}: {e}",
-                        job_id=job_id,
-                        error=str(e),
-                    )
+                stalled=True,
+                chunk_size=chunk_size,
+            )
 
         if not requeued:
             log.info("No stalled/orphaned jobs found matching the filters")
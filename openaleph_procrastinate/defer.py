@@ -24,24 +24,326 @@ To disable deferring for a service, use environment variable:
 
 For example, to disable indexing entities after ingestion, start the
 `ingest-file` worker with this config: `OPENALEPH_INDEX_DEFER=0`
+
+Entities for a stage can be split up into multiple jobs with a maximum number
+of entities or serialized payload size per job, e.g. `OPENALEPH_INDEX_MAX_ENTITIES=1000`
+or `OPENALEPH_INDEX_MAX_BYTES=10000000`
+
+To merge many small defers for the entity stages into fewer jobs, wrap them in
+a [`DeferBuffer`][openaleph_procrastinate.defer.DeferBuffer] context.
 """
 
-from typing import Any, Iterable
+import json
+import threading
+import time
+from contextvars import ContextVar, Token
+from typing import Any, Generator, Iterable, Self, TypeAlias
 
+from anystore.logging import get_logger
 from banal import ensure_dict
 from followthemoney.proxy import EntityProxy
 
 from openaleph_procrastinate.app import App
-from openaleph_procrastinate.model import DatasetJob, Job
-from openaleph_procrastinate.settings import DeferSettings
-
+from openaleph_procrastinate.model import (
+    DatasetJob,
+    Job,
+    get_payload_size,
+    make_entity_payloads,
+)
+from openaleph_procrastinate.settings import DeferSettings, ServiceSettings
+
+log = get_logger(__name__)
 tasks = DeferSettings()
 
+BufferKey: TypeAlias = tuple[str, str, str, str]  # dataset, queue, task, context
+
+
+class _BufferedEntities:
+    def __init__(self, service: ServiceSettings, context: dict[str, Any]) -> None:
+        self.service = service
+        self.context = context
+        self.entities: list[dict[str, Any]] = []
+        self.size = 0
+        self.created = time.monotonic()
+
+
+class DeferBuffer:
+    """
+    Gather entities deferred to the entity stages (`ingest`, `analyze`,
+    `index`, ...) within this context and defer them as merged jobs, instead
+    of one (small) job per call.
+
+    Entities are grouped per dataset, queue, task and job context. A group is
+    flushed when it reaches `max_entities` or `max_bytes` (or the lower limits
+    of the stage settings), when it is older than `max_age` seconds (checked
+    when adding entities) or when leaving the context.
+
+    Example:
+        ```python
+        from openaleph_procrastinate import defer
+
+        @task(app=app)
+        def ingest(job: DatasetJob) -> None:
+            with defer.DeferBuffer(app):
+                for entity in ingest_entities(job):
+                    # buffered instead of deferred one by one
+                    defer.analyze(app, job.dataset, [entity])
+            # remaining entities are deferred when leaving the context
+        ```
+    """
+
+    def __init__(
+        self,
+        app: App,
+        max_entities: int | None = 1_000,
+        max_bytes: int | None = None,
+        max_age: float | None = 60,
+    ) -> None:
+        self.app = app
+        self.max_entities = max_entities
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._buffers: dict[BufferKey, _BufferedEntities] = {}
+        self._lock = threading.RLock()
+        self._token: Token["DeferBuffer | None"] | None = None
+
+    def __enter__(self) -> Self:
+        self._token = _buffer.set(self)
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        if self._token is not None:
+            _buffer.reset(self._token)
+            self._token = None
+        self.flush()
+
+    def add(
+        self,
+        service: ServiceSettings,
+        dataset: str,
+        entities: Iterable[EntityProxy],
+        **context: Any,
+    ) -> None:
+        """Add entities for the given stage to the buffer"""
+        context_key = json.dumps(context, sort_keys=True, default=str)
+        key = (dataset, service.queue, service.task, context_key)
+        max_entities = _min_limit(service.max_entities, self.max_entities)
+        max_bytes = _min_limit(service.max_bytes, self.max_bytes)
+        with self._lock:
+            for data in make_entity_payloads(entities):
+                data_size = get_payload_size(data) if max_bytes else 0
+                buffer = self._buffers.get(key)
+                if buffer is not None and max_bytes:
+                    # flush before the job would exceed `max_bytes` (a single
+                    # entity that is larger still gets its own job)
+                    if buffer.size + data_size > max_bytes:
+                        self._flush([key])
+                        buffer = None
+                if buffer is None:
+                    buffer = _BufferedEntities(service, context)
+                    self._buffers[key] = buffer
+                buffer.entities.append(data)
+                buffer.size += data_size
+                if (max_entities and len(buffer.entities) >= max_entities) or (
+                    max_bytes and buffer.size >= max_bytes
+                ):
+                    self._flush([key])
+            if self.max_age is not None:
+                now = time.monotonic()
+                self._flush(
+                    [
+                        k
+                        for k, b in self._buffers.items()
+                        if now - b.created > self.max_age
+                    ]
+                )
+
+    def flush(self) -> None:
+        """Defer all buffered entities"""
+        with self._lock:
+            self._flush(list(self._buffers))
+
+    def _flush(self, keys: list[BufferKey]) -> None:
+        jobs: list[tuple[Job, int]] = []
+        for key in keys:
+            buffer = self._buffers.pop(key)
+            context = dict(buffer.context)
+            job = DatasetJob(
+                dataset=key[0],
+                queue=buffer.service.queue,
+                task=buffer.service.task,
+                batch=context.pop("batch", None),
+                payload={"entities": buffer.entities, "context": context},
+            )
+            priority = get_priority(context, buffer.service.get_priority())
+            jobs.append((job, priority))
+        if jobs:
+            deferred = Job.defer_many(self.app, jobs)
+            log.debug("Flushed defer buffer.", jobs=deferred)
+
+
+def _min_limit(*limits: int | None) -> int | None:
+    return min((limit for limit in limits if limit), default=None)
+
+
+_buffer: ContextVar[DeferBuffer | None] = ContextVar("defer_buffer", default=None)
+
 
 def get_priority(data: dict[str, Any], default: int) -> int:
     return data.get("priority") or default
 
 
+def get_service(task: str) -> ServiceSettings | None:
+    """Get the stage settings for the given task module path (if known)"""
+    for service in tasks.services.values():
+        if service.task == task:
+            return service
+    return None
+
+
+def bulk(app: App, jobs: Iterable[Job], chunk_size: int | None = None) -> int:
+    """
+    Defer many jobs at once, inserting them in chunks with one query per chunk
+    instead of one query per job (see
+    [`Job.defer_many`][openaleph_procrastinate.model.Job.defer_many]).
+
+    Jobs for a known stage get the priority from its settings (or from
+    `priority` in the job context) and are skipped if deferring is disabled for
+    this stage, the same as the single stage functions below.
+
+    Example:
+        ```python
+        from openaleph_procrastinate import defer
+
+        jobs = (
+            DatasetJob.from_entities(
+                dataset=dataset,
+                queue=defer.tasks.index.queue,
+                task=defer.tasks.index.task,
+                entities=[proxy],
+            )
+            for proxy in proxies
+        )
+        defer.bulk(app, jobs)
+        ```
+
+    Args:
+        app: The procrastinate app instance
+        jobs: The jobs to defer
+        chunk_size: Number of jobs per insert query
+
+    Returns:
+        The number of deferred jobs
+    """
+
+    return Job.defer_many(app, _with_priorities(jobs), chunk_size)
+
+
+async def bulk_async(
+    app: App, jobs: Iterable[Job], chunk_size: int | None = None
+) -> int:
+    """
+    Async version of [`bulk`][openaleph_procrastinate.defer.bulk]. The app
+    needs to be opened via `app.open_async()`.
+    """
+    return await Job.defer_many_async(app, _with_priorities(jobs), chunk_size)
+
+
+def _with_priorities(
+    jobs: Iterable[Job],
+) -> Generator[tuple[Job, int | None], None, None]:
+    for job in jobs:
+        service = get_service(job.task)
+        if service is None:
+            yield job, job.context.get("priority")
+        elif service.defer:
+            yield job, get_priority(job.context, service.get_priority())
+
+
+def _make_entity_jobs(
+    service: ServiceSettings,
+    dataset: str,
+    entities: Iterable[EntityProxy],
+    **context: Any,
+) -> Generator[tuple[DatasetJob, int], None, None]:
+    priority = get_priority(context, service.get_priority())
+    if service.chunked:
+        # split up into jobs bounded by `max_entities` / `max_bytes`
+        jobs = DatasetJob.iter_from_entities(
+            dataset=dataset,
+            queue=service.queue,
+            task=service.task,
+            entities=entities,
+            max_entities=service.max_entities,
+            max_bytes=service.max_bytes,
+            **context,
+        )
+        for job in jobs:
+            yield job, priority
+    else:
+        job = DatasetJob.from_entities(
+            dataset=dataset,
+            queue=service.queue,
+            task=service.task,
+            entities=entities,
+            **context,
+        )
+        yield job, priority
+
+
+def _make_job(
+    service: ServiceSettings, dataset: str | None = None, /, **context: Any
+) -> tuple[Job, int]:
+    # a job for the stages without entities, the context is the payload
+    payload = {"context": ensure_dict(context)}
+    if dataset is None:
+        job = Job(queue=service.queue, task=service.task, payload=payload)
+    else:
+        job = DatasetJob(
+            dataset=dataset, queue=service.queue, task=service.task, payload=payload
+        )
+    return job, get_priority(context, service.get_priority())
+
+
+def _defer_entities(
+    app: App,
+    service: ServiceSettings,
+    dataset: str,
+    entities: Iterable[EntityProxy],
+    **context: Any,
+) -> None:
+    buffer = _buffer.get()
+    if buffer is not None:
+        buffer.add(service, dataset, entities, **context)
+        return
+    Job.defer_many(app, _make_entity_jobs(service, dataset, entities, **context))
+
+
+async def _defer_entities_async(
+    app: App,
+    service: ServiceSettings,
+    dataset: str,
+    entities: Iterable[EntityProxy],
+    **context: Any,
+) -> None:
+    jobs = _make_entity_jobs(service, dataset, entities, **context)
+    await Job.defer_many_async(app, jobs)
+
+
+def _defer_job(
+    app: App, service: ServiceSettings, dataset: str | None = None, /, **context: Any
+) -> None:
+    job, priority = _make_job(service, dataset, **context)
+    job.defer(app, priority)
+
+
+async def _defer_job_async(
+    app: App, service: ServiceSettings, dataset: str | None = None, /, **context: Any
+) -> None:
+    job, priority = _make_job(service, dataset, **context)
+    await job.defer_async(app, priority)
+
+
 def ingest(
     app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
 ) -> None:
@@ -56,15 +358,7 @@ def ingest(
         context: Additional job context
     """
     if tasks.ingest.defer:
-        job = DatasetJob.from_entities(
-            dataset=dataset,
-            queue=tasks.ingest.queue,
-            task=tasks.ingest.task,
-            entities=entities,
-            **context,
-        )
-        priority = get_priority(context, tasks.ingest.get_priority())
-        job.defer(app, priority)
+        _defer_entities(app, tasks.ingest, dataset, entities, **context)
 
 
 def analyze(
@@ -81,15 +375,7 @@ def analyze(
         context: Additional job context
     """
     if tasks.analyze.defer:
-        job = DatasetJob.from_entities(
-            dataset=dataset,
-            queue=tasks.analyze.queue,
-            task=tasks.analyze.task,
-            entities=entities,
-            **context,
-        )
-        priority = get_priority(context, tasks.analyze.get_priority())
-        job.defer(app, priority)
+        _defer_entities(app, tasks.analyze, dataset, entities, **context)
 
 
 def index(
@@ -106,15 +392,7 @@ def index(
         context: Additional job context
     """
     if tasks.index.defer:
-        job = DatasetJob.from_entities(
-            dataset=dataset,
-            queue=tasks.index.queue,
-            task=tasks.index.task,
-            entities=entities,
-            **context,
-        )
-        priority = get_priority(context, tasks.index.get_priority())
-        job.defer(app, priority)
+        _defer_entities(app, tasks.index, dataset, entities, **context)
 
 
 def reindex(app: App, dataset: str, **context: Any) -> None:
@@ -128,14 +406,7 @@ def reindex(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.reindex.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.reindex.queue,
-            task=tasks.reindex.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.reindex.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.reindex, dataset, **context)
 
 
 def xref(app: App, dataset: str, **context: Any) -> None:
@@ -149,14 +420,7 @@ def xref(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.xref.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.xref.queue,
-            task=tasks.xref.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.xref.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.xref, dataset, **context)
 
 
 def load_mapping(app: App, dataset: str, **context: Any) -> None:
@@ -170,14 +434,7 @@ def load_mapping(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.load_mapping.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.load_mapping.queue,
-            task=tasks.load_mapping.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.load_mapping.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.load_mapping, dataset, **context)
 
 
 def flush_mapping(app: App, dataset: str, **context: Any) -> None:
@@ -191,14 +448,7 @@ def flush_mapping(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.flush_mapping.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.flush_mapping.queue,
-            task=tasks.flush_mapping.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.flush_mapping.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.flush_mapping, dataset, **context)
 
 
 def export_search(app: App, **context: Any) -> None:
@@ -211,13 +461,7 @@ def export_search(app: App, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.export_search.defer:
-        job = Job(
-            queue=tasks.export_search.queue,
-            task=tasks.export_search.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.export_search.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.export_search, **context)
 
 
 def export_xref(app: App, dataset: str, **context: Any) -> None:
@@ -230,14 +474,7 @@ def export_xref(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.export_xref.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.export_xref.queue,
-            task=tasks.export_xref.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.export_xref.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.export_xref, dataset, **context)
 
 
 def update_entity(app: App, dataset: str, **context: Any) -> None:
@@ -251,14 +488,7 @@ def update_entity(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.update_entity.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.update_entity.queue,
-            task=tasks.update_entity.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.update_entity.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.update_entity, dataset, **context)
 
 
 def prune_entity(app: App, dataset: str, **context: Any) -> None:
@@ -272,14 +502,7 @@ def prune_entity(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.prune_entity.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.prune_entity.queue,
-            task=tasks.prune_entity.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.prune_entity.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.prune_entity, dataset, **context)
 
 
 def cancel_dataset(app: App, dataset: str, **context: Any) -> None:
@@ -293,14 +516,7 @@ def cancel_dataset(app: App, dataset: str, **context: Any) -> None:
         context: Additional job context
     """
     if tasks.cancel_dataset.defer:
-        job = DatasetJob(
-            dataset=dataset,
-            queue=tasks.cancel_dataset.queue,
-            task=tasks.cancel_dataset.task,
-            payload={"context": ensure_dict(context)},
-        )
-        priority = get_priority(context, tasks.cancel_dataset.get_priority())
-        job.defer(app, priority)
+        _defer_job(app, tasks.cancel_dataset, dataset, **context)
 
 
 def transcribe(
@@ -317,15 +533,7 @@ def transcribe(
         context: Additional job context
     """
     if tasks.transcribe.defer:
-        job = DatasetJob.from_entities(
-            dataset=dataset,
-            queue=tasks.transcribe.queue,
-            task=tasks.transcribe.task,
-            entities=entities,
-            **context,
-        )
-        priority = get_priority(context, tasks.transcribe.get_priority())
-        job.defer(app, priority)
+        _defer_entities(app, tasks.transcribe, dataset, entities, **context)
 
 
 def translate(
@@ -342,15 +550,7 @@ def translate(
         context: Additional job context
     """
     if tasks.translate.defer:
-        job = DatasetJob.from_entities(
-            dataset=dataset,
-            queue=tasks.translate.queue,
-            task=tasks.translate.task,
-            entities=entities,
-            **context,
-        )
-        priority = get_priority(context, tasks.translate.get_priority())
-        job.defer(app, priority)
+        _defer_entities(app, tasks.translate, dataset, entities, **context)
 
 
 def geocode(
@@ -367,15 +567,7 @@ def geocode(
         context: Additional job context
     """
     if tasks.geocode.defer:
-        job = DatasetJob.from_entities(
-            dataset=dataset,
-            queue=tasks.geocode.queue,
-            task=tasks.geocode.task,
-            entities=entities,
-            **context,
-        )
-        priority = get_priority(context, tasks.geocode.get_priority())
-        job.defer(app, priority)
+        _defer_entities(app, tasks.geocode, dataset, entities, **context)
 
 
 def resolve_assets(
@@ -392,12 +584,121 @@ def resolve_assets(
         context: Additional job context
     """
     if tasks.assets.defer:
-        job = DatasetJob.from_entities(
-            dataset=dataset,
-            queue=tasks.assets.queue,
-            task=tasks.assets.task,
-            entities=entities,
-            **context,
-        )
-        priority = get_priority(context, tasks.assets.get_priority())
-        job.defer(app, priority)
+        _defer_entities(app, tasks.assets, dataset, entities, **context)
+
+
+# ASYNC #
+# Async versions of the stages above for callers running in an event loop
+# (e.g. the OpenAleph api). They need an app opened via `app.open_async()`
+# that uses the shared async connection pool. They are not affected by a
+# `DeferBuffer`.
+
+
+async def ingest_async(
+    app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
+) -> None:
+    """Async version of [`ingest`][openaleph_procrastinate.defer.ingest]"""
+    if tasks.ingest.defer:
+        await _defer_entities_async(app, tasks.ingest, dataset, entities, **context)
+
+
+async def analyze_async(
+    app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
+) -> None:
+    """Async version of [`analyze`][openaleph_procrastinate.defer.analyze]"""
+    if tasks.analyze.defer:
+        await _defer_entities_async(app, tasks.analyze, dataset, entities, **context)
+
+
+async def index_async(
+    app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
+) -> None:
+    """Async version of [`index`][openaleph_procrastinate.defer.index]"""
+    if tasks.index.defer:
+        await _defer_entities_async(app, tasks.index, dataset, entities, **context)
+
+
+async def reindex_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`reindex`][openaleph_procrastinate.defer.reindex]"""
+    if tasks.reindex.defer:
+        await _defer_job_async(app, tasks.reindex, dataset, **context)
+
+
+async def xref_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`xref`][openaleph_procrastinate.defer.xref]"""
+    if tasks.xref.defer:
+        await _defer_job_async(app, tasks.xref, dataset, **context)
+
+
+async def load_mapping_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`load_mapping`][openaleph_procrastinate.defer.load_mapping]"""
+    if tasks.load_mapping.defer:
+        await _defer_job_async(app, tasks.load_mapping, dataset, **context)
+
+
+async def flush_mapping_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`flush_mapping`][openaleph_procrastinate.defer.flush_mapping]"""
+    if tasks.flush_mapping.defer:
+        await _defer_job_async(app, tasks.flush_mapping, dataset, **context)
+
+
+async def export_search_async(app: App, **context: Any) -> None:
+    """Async version of [`export_search`][openaleph_procrastinate.defer.export_search]"""
+    if tasks.export_search.defer:
+        await _defer_job_async(app, tasks.export_search, **context)
+
+
+async def export_xref_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`export_xref`][openaleph_procrastinate.defer.export_xref]"""
+    if tasks.export_xref.defer:
+        await _defer_job_async(app, tasks.export_xref, dataset, **context)
+
+
+async def update_entity_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`update_entity`][openaleph_procrastinate.defer.update_entity]"""
+    if tasks.update_entity.defer:
+        await _defer_job_async(app, tasks.update_entity, dataset, **context)
+
+
+async def prune_entity_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`prune_entity`][openaleph_procrastinate.defer.prune_entity]"""
+    if tasks.prune_entity.defer:
+        await _defer_job_async(app, tasks.prune_entity, dataset, **context)
+
+
+async def cancel_dataset_async(app: App, dataset: str, **context: Any) -> None:
+    """Async version of [`cancel_dataset`][openaleph_procrastinate.defer.cancel_dataset]"""
+    if tasks.cancel_dataset.defer:
+        await _defer_job_async(app, tasks.cancel_dataset, dataset, **context)
+
+
+async def transcribe_async(
+    app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
+) -> None:
+    """Async version of [`transcribe`][openaleph_procrastinate.defer.transcribe]"""
+    if tasks.transcribe.defer:
+        await _defer_entities_async(app, tasks.transcribe, dataset, entities, **context)
+
+
+async def translate_async(
+    app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
+) -> None:
+    """Async version of [`translate`][openaleph_procrastinate.defer.translate]"""
+    if tasks.translate.defer:
+        await _defer_entities_async(app, tasks.translate, dataset, entities, **context)
+
+
+async def geocode_async(
+    app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
+) -> None:
+    """Async version of [`geocode`][openaleph_procrastinate.defer.geocode]"""
+    if tasks.geocode.defer:
+        await _defer_entities_async(app, tasks.geocode, dataset, entities, **context)
+
+
+async def resolve_assets_async(
+    app: App, dataset: str, entities: Iterable[EntityProxy], **context: Any
+) -> None:
+    """Async version of [`resolve_assets`][openaleph_procrastinate.defer.resolve_assets]"""
+    if tasks.assets.defer:
+        await _defer_entities_async(app, tasks.assets, dataset, entities, **context)
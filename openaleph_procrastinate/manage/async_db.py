@@ -0,0 +1,200 @@
+"""
+Async variant of the [Db][openaleph_procrastinate.manage.db.Db] status and job
+queries for async web backends. Queries run on a shared async connection pool
+instead of a new connection per query.
+"""
+
+import asyncio
+from datetime import datetime
+from functools import cache
+from typing import Any, AsyncGenerator, LiteralString, Mapping, TypeAlias
+
+from anystore.logging import get_logger
+from anystore.util import mask_uri
+from psycopg import AsyncConnection
+from psycopg.types.json import set_json_loads
+from psycopg_pool import AsyncConnectionPool
+
+from openaleph_procrastinate.manage import sql
+from openaleph_procrastinate.manage.db import (
+    THROUGHPUT_WINDOW,
+    Param,
+    make_cursor_name,
+    make_job_params,
+    unpack_job_row,
+)
+from openaleph_procrastinate.manage.status import _build_status
+from openaleph_procrastinate.model import AnyJob, DatasetStatus, EntityJob, Status
+from openaleph_procrastinate.settings import OpenAlephSettings
+from openaleph_procrastinate.util import json_loads
+
+AsyncRows: TypeAlias = AsyncGenerator[tuple[Any, ...], None]
+AsyncJobs: TypeAlias = AsyncGenerator[AnyJob | EntityJob, None]
+
+
+class AsyncDb:
+    """Get an async db manager object for the current procrastinate database
+    uri. The connection pool is opened on first use and bound to the event loop
+    it was opened in, a new one is opened when used from another event loop."""
+
+    def __init__(self, uri: str | None = None) -> None:
+        self.settings = OpenAlephSettings()
+        if self.settings.in_memory_db:
+            raise RuntimeError("Can't use in-memory database")
+        self.uri = uri or self.settings.procrastinate_db_uri
+        self.log = get_logger(__name__, uri=mask_uri(self.uri))
+        self._pool: AsyncConnectionPool | None = None
+        self._lock: asyncio.Lock | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def get_pool(self) -> AsyncConnectionPool:
+        """Get the connection pool (configured like the worker pool, see
+        [get_pool][openaleph_procrastinate.app.get_pool])"""
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._loop is not loop:
+            # the pool and its lock can't be used from another event loop
+            self._lock = asyncio.Lock()
+            self._loop = loop
+            self._pool = None
+        if self._pool is None:
+            async with self._lock:
+                if self._pool is None:
+                    pool = AsyncConnectionPool(
+                        self.uri,
+                        min_size=1,
+                        max_size=self.settings.db_pool_size,
+                        check=AsyncConnectionPool.check_connection,
+                        configure=self._configure_connection,
+                        max_idle=self.settings.db_pool_max_idle,
+                        max_lifetime=self.settings.db_pool_max_lifetime,
+                        timeout=self.settings.db_pool_timeout,
+                        open=False,
+                    )
+                    await pool.open()
+                    self._pool = pool
+        return self._pool
+
+    async def close(self) -> None:
+        """Close the connection pool"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def iterate_status(
+        self,
+        dataset: str | None = None,
+        batch: str | None = None,
+        queue: str | None = None,
+        task: str | None = None,
+        status: Status | None = None,
+        active_only: bool | None = True,
+        window: int = THROUGHPUT_WINDOW,
+    ) -> AsyncRows:
+        """
+        Iterate through aggregated job status summary, see
+        [Db.iterate_status][openaleph_procrastinate.manage.db.Db.iterate_status]
+        """
+        if active_only:
+            query = sql.STATUS_SUMMARY_ACTIVE
+        else:
+            query = sql.STATUS_SUMMARY
+        query = sql.compile_filters(
+            query, dataset=dataset, batch=batch, queue=queue, task=task, status=status
+        )
+        async for row in self._execute_iter(
+            query,
+            {
+                "dataset": dataset,
+                "batch": batch,
+                "queue": queue,
+                "task": task,
+                "status": status,
+                "window": window,
+            },
+        ):
+            yield row
+
+    async def iterate_jobs(
+        self,
+        dataset: str | None = None,
+        batch: str | None = None,
+        queue: str | None = None,
+        task: str | None = None,
+        status: Status | None = None,
+        min_ts: datetime | None = None,
+        max_ts: datetime | None = None,
+        flatten_entities: bool | None = False,
+    ) -> AsyncJobs:
+        """
+        Iterate job objects from the database by given criteria, see
+        [Db.iterate_jobs][openaleph_procrastinate.manage.db.Db.iterate_jobs]
+        """
+        params = make_job_params(dataset, batch, queue, task, status, min_ts, max_ts)
+        query = sql.compile_filters(sql.ALL_JOBS, **params)
+        async for row in self._execute_iter(query, params):
+            for job in unpack_job_row(row, flatten_entities):
+                yield job
+
+    async def get_status(
+        self, active_only: bool | None = True, dataset: str | None = None
+    ) -> AsyncGenerator[DatasetStatus, None]:
+        """Get the status of all (active) datasets, one dataset at a time"""
+        rows: list[tuple[Any, ...]] = []
+        async for row in self.iterate_status(dataset, active_only=active_only):
+            if rows and rows[0][0] != row[0]:
+                for dataset_status in _build_status(rows):
+                    yield dataset_status
+                rows = []
+            rows.append(row)
+        for dataset_status in _build_status(rows):
+            yield dataset_status
+
+    async def get_dataset_status(
+        self, dataset: str, active_only: bool | None = True
+    ) -> DatasetStatus:
+        # consume all (one) datasets, so that the connection is released
+        statuses = [s async for s in self.get_status(active_only, dataset=dataset)]
+        if statuses:
+            return statuses[0]
+        return DatasetStatus(name=dataset)
+
+    async def sample_throughput(self) -> bool:
+        """Sample the finished jobs counters for the throughput, see
+        [Db.sample_throughput][openaleph_procrastinate.manage.db.Db.sample_throughput]
+        """
+        # consume all rows, so that the sample is committed
+        rows = [
+            row
+            async for row in self._execute_iter(
+                sql.SAMPLE_THROUGHPUT,
+                {"interval": sql.THROUGHPUT_INTERVAL, "slots": sql.THROUGHPUT_SLOTS},
+            )
+        ]
+        return bool(rows and rows[0][0])
+
+    async def _execute_iter(
+        self,
+        q: LiteralString,
+        params: Mapping[str, Param] | None = None,
+        *,
+        itersize: int | None = None,
+    ) -> AsyncRows:
+        pool = await self.get_pool()
+        async with pool.connection() as connection:
+            async with connection.cursor(name=make_cursor_name()) as cursor:
+                cursor.itersize = itersize or self.settings.db_itersize
+                await cursor.execute(q, params)
+                async for row in cursor:
+                    yield row
+
+    @staticmethod
+    async def _configure_connection(connection: AsyncConnection) -> None:
+        set_json_loads(json_loads, connection)
+
+
+@cache
+def get_async_db(uri: str | None = None) -> AsyncDb:
+    """Get a globally cached `AsyncDb` instance"""
+    settings = OpenAlephSettings()
+    uri = uri or settings.procrastinate_db_uri
+    return AsyncDb(uri)
@@ -3,28 +3,121 @@ This is temporary and should use the procrastinate Django models at one point in
 the future
 """
 
+import base64
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from functools import cache
-from typing import Any, Generator, LiteralString, TypeAlias
+from typing import Any, Generator, LiteralString, Mapping, TypeAlias, cast
+from uuid import uuid4
 
 import psycopg
 from anystore.logging import get_logger
 from anystore.util import Took, mask_uri
 from psycopg.errors import UndefinedTable
+from psycopg.types.json import set_json_loads
+from psycopg_pool import ConnectionPool
+from pydantic import BaseModel, ValidationError
 
 from openaleph_procrastinate.app import make_app
 from openaleph_procrastinate.manage import sql
 from openaleph_procrastinate.model import AnyJob, DatasetJob, EntityJob, Status
-from openaleph_procrastinate.settings import OpenAlephSettings
+from openaleph_procrastinate.settings import (
+    MAX_PRIORITY,
+    DeferSettings,
+    OpenAlephSettings,
+)
 from openaleph_procrastinate.tasks import unpack_job
+from openaleph_procrastinate.util import json_dumps, json_loads
 
 RowType: TypeAlias = str | int | datetime | dict[str, Any]
 Rows: TypeAlias = Generator[tuple[RowType, ...], None, None]
 Jobs: TypeAlias = Generator[AnyJob | EntityJob, None, None]
+Param: TypeAlias = str | int | float | list[int] | None
+
+# default throughput window in minutes
+THROUGHPUT_WINDOW = 15
+
+# default number of jobs retried per bulk requeue statement
+REQUEUE_CHUNK_SIZE = 10_000
+
+
+def make_cursor_name() -> str:
+    return f"openaleph_procrastinate_{uuid4().hex}"
+
+
+def make_job_params(
+    dataset: str | None = None,
+    batch: str | None = None,
+    queue: str | None = None,
+    task: str | None = None,
+    status: Status | None = None,
+    min_ts: datetime | None = None,
+    max_ts: datetime | None = None,
+) -> dict[str, Param]:
+    """Make the query parameters for `sql.ALL_JOBS`"""
+    min_ts = min_ts or datetime(1970, 1, 1)
+    max_ts = max_ts or datetime.now()
+    return {
+        "dataset": dataset,
+        "min_ts": min_ts.isoformat(),
+        "max_ts": max_ts.isoformat(),
+        "batch": batch,
+        "queue": queue,
+        "task": task,
+        "status": status,
+    }
+
+
+def unpack_job_row(row: tuple[Any, ...], flatten_entities: bool | None = False) -> Jobs:
+    """Unpack a `sql.ALL_JOBS` row into its job (or a job per entity)"""
+    id, status, data = row
+    data["id"] = id
+    data["status"] = status
+    job = unpack_job(data)
+    if flatten_entities and isinstance(job, DatasetJob):
+        # read the ids from the payload instead of parsing each entity
+        entity_ids = [e["id"] for e in job.payload.get("entities", []) if e.get("id")]
+        for entity_id in entity_ids:
+            yield EntityJob(**data, entity_id=entity_id)
+        if not entity_ids:
+            yield job
+    else:
+        yield job
+
+
+class ResumeToken(BaseModel):
+    """The position of a paginated job iteration"""
+
+    after: int = 0
+    """The last job id seen"""
+    min_ts: datetime
+    max_ts: datetime
+    """The time range is fixed at the start, so that it stays the same when
+    resuming later"""
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(
+            json_dumps(self.model_dump(mode="json"))
+        ).decode()
+
+    @classmethod
+    def decode(cls, token: str) -> "ResumeToken":
+        try:
+            return cls.model_validate_json(base64.urlsafe_b64decode(token))
+        except (ValueError, ValidationError) as e:
+            raise ValueError(f"Invalid resume token: `{token}`") from e
+
+
+class JobsPage(BaseModel):
+    jobs: list[AnyJob | EntityJob]
+    token: str
+    """Resume token to continue after this page"""
 
 
 class Db:
-    """Get a db manager object for the current procrastinate database uri"""
+    """Get a db manager object for the current procrastinate database uri.
+    Queries run on a shared connection pool that is opened on first use."""
 
     def __init__(self, uri: str | None = None) -> None:
         self.settings = OpenAlephSettings()
@@ -32,10 +125,40 @@ class Db:
             raise RuntimeError("Can't use in-memory database")
         self.uri = uri or self.settings.procrastinate_db_uri
         self.log = get_logger(__name__, uri=mask_uri(self.uri))
+        self._pool: ConnectionPool | None = None
+        self._lock = threading.Lock()
+
+    def get_pool(self) -> ConnectionPool:
+        """Get the connection pool (configured like the worker pool, see
+        [get_pool][openaleph_procrastinate.app.get_pool])"""
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        self.uri,
+                        min_size=1,
+                        max_size=self.settings.db_pool_size,
+                        check=ConnectionPool.check_connection,
+                        configure=self._configure_connection,
+                        max_idle=self.settings.db_pool_max_idle,
+                        max_lifetime=self.settings.db_pool_max_lifetime,
+                        timeout=self.settings.db_pool_timeout,
+                        open=True,
+                    )
+        return self._pool
+
+    def close(self) -> None:
+        """Close the connection pool"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
 
     def configure(self) -> None:
         """Create procrastinate tables and schema (if not exists) and add our
-        index optimizations (if not exists)"""
+        index optimizations (if not exists). The triggers and indexes of
+        optional features (e.g. `fetch_fair_share`) are only installed while
+        the feature is enabled and removed otherwise."""
         if self.settings.in_memory_db:
             return
         app = make_app(sync=True)
@@ -49,7 +172,46 @@ class Db:
             self._execute(sql.REMOVE_FOREIGN_KEY)
             self._execute(sql.CUSTOM_PRUNE_STALLED_WORKERS)
             self._execute(sql.INDEXES)
-            self._execute(sql.OPTIMIZED_FETCH_FUNCTION)
+            self._execute(sql.CONCURRENCY_LIMITS)
+            self._execute(sql.REBUILD_RUNNING_JOBS)
+            self.sync_rate_limits()
+            self._execute(sql.LOCK_STATE)
+            if self.settings.fetch_lock_heads:
+                self._execute(sql.LOCK_HEAD_INDEX)
+                self._execute(sql.LOCK_STATE_TRIGGERS)
+                self._execute(sql.REBUILD_LOCK_STATE)
+            else:
+                self._execute(sql.DROP_LOCK_STATE_TRIGGERS)
+                self._drop_indexes(sql.LOCK_HEAD_INDEXES)
+            # count the existing jobs only once, later via `rebuild-status`
+            counted = self._table_exists(sql.STATUS_TABLE)
+            self._execute(sql.STATUS_COUNTS)
+            if not counted:
+                self.rebuild_status_counts()
+            self._execute(sql.THROUGHPUT)
+            if self.settings.status_throughput:
+                self._execute(sql.THROUGHPUT_TRIGGERS)
+            else:
+                self._execute(sql.DROP_THROUGHPUT_TRIGGERS)
+            self._execute(sql.PRIORITY_AGING)
+            if any(rate > 0 for rate in self.settings.priority_aging.values()):
+                self._execute(sql.PRIORITY_AGING_TRIGGERS)
+                self._execute(sql.AGING_INDEX)
+            else:
+                self._execute(sql.DROP_PRIORITY_AGING_TRIGGERS)
+                self._drop_indexes(sql.AGING_INDEXES)
+            self.sync_priority_aging()
+            self._execute(sql.compile_fetch_function(self.settings.fetch_lock_heads))
+            self._execute(sql.BATCH_FETCH_FUNCTION)
+            self._execute(sql.FAIR_SHARE)
+            if self.settings.fetch_fair_share:
+                self._execute(sql.FAIR_SHARE_TRIGGERS)
+            else:
+                self._execute(sql.DROP_FAIR_SHARE_TRIGGERS)
+            if self.settings.fetch_fair_share or self._has_dataset_limits():
+                self._execute(sql.DATASET_INDEX)
+            else:
+                self._drop_indexes(sql.DATASET_INDEXES)
             self.log.info("Configuring done.", took=t.took)
 
     def iterate_status(
@@ -60,13 +222,17 @@ class Db:
         task: str | None = None,
         status: Status | None = None,
         active_only: bool | None = True,
+        window: int = THROUGHPUT_WINDOW,
     ) -> Rows:
         """
         Iterate through aggregated job status summary
 
         Each row is an aggregation over
         `dataset,batch,queue_name,task_name,status` and includes jobs count,
-        timestamp first event, timestamp last event
+        timestamp first event, timestamp last event and the throughput of the
+        task group. The aggregations are read from the status counts table that
+        is maintained by triggers, so this scales with the number of groups and
+        not with the number of jobs. The throughput is sampled by the workers.
 
         Args:
             dataset: The dataset to filter for
@@ -76,24 +242,59 @@ class Db:
             status: The status to filter for
             active_only: Only include "active" datasets (at least 1 job in
                 'todo' or 'doing')
+            window: The throughput window in minutes (at most 60)
 
         Yields:
             Rows a tuple with the fields in this order:
                 dataset, batch, queue_name, task_name, status, jobs count,
-                timestamp first event, timestamp last event
+                timestamp first event, timestamp last event, finished jobs per
+                minute, finished entities per minute
         """
         if active_only:
             query = sql.STATUS_SUMMARY_ACTIVE
         else:
             query = sql.STATUS_SUMMARY
+        query = sql.compile_filters(
+            query, dataset=dataset, batch=batch, queue=queue, task=task, status=status
+        )
         yield from self._execute_iter(
             query,
-            dataset=dataset,
-            batch=batch,
-            queue=queue,
-            task=task,
-            status=status,
+            {
+                "dataset": dataset,
+                "batch": batch,
+                "queue": queue,
+                "task": task,
+                "status": status,
+                "window": window,
+            },
+        )
+
+    def sample_throughput(self) -> bool:
+        """Sample the finished jobs counters for the throughput if the last
+        sample is older than `THROUGHPUT_INTERVAL` seconds"""
+        # consume all rows, so that the sample is committed
+        rows = list(
+            self._execute_iter(
+                sql.SAMPLE_THROUGHPUT,
+                {"interval": sql.THROUGHPUT_INTERVAL, "slots": sql.THROUGHPUT_SLOTS},
+            )
         )
+        return bool(rows and rows[0][0])
+
+    def _table_exists(self, table: str) -> bool:
+        rows = list(self._execute_iter(sql.TABLE_EXISTS, {"table": table}))
+        return bool(rows and rows[0][0])
+
+    def _has_dataset_limits(self) -> bool:
+        rows = list(self._execute_iter(sql.HAS_DATASET_LIMITS))
+        return bool(rows and rows[0][0])
+
+    def rebuild_status_counts(self) -> None:
+        """Recount the jobs per status group to reconcile drift of the status
+        counts table (e.g. after manual changes with disabled triggers)"""
+        with Took() as t:
+            self._execute(sql.REBUILD_STATUS_COUNTS)
+            self.log.info("Rebuilt status counts.", took=t.took)
 
     def iterate_jobs(
         self,
@@ -105,9 +306,12 @@ class Db:
         min_ts: datetime | None = None,
         max_ts: datetime | None = None,
         flatten_entities: bool | None = False,
+        dump: bool | None = False,
     ) -> Jobs:
         """
-        Iterate job objects from the database by given criteria.
+        Iterate job objects from the database by given criteria. The rows are
+        streamed from a server side cursor, so memory stays flat for any number
+        of jobs.
 
         Args:
             dataset: The dataset to filter for
@@ -118,36 +322,83 @@ class Db:
             min_ts: Start timestamp (earliest event found in `procrastinate_events`)
             max_ts: End timestamp (latest event found in `procrastinate_events`)
             flatten_entities: If true, yield a job for each entity found in the source job
+            dump: Stream the rows via binary `COPY` instead of a cursor, which
+                is faster for full dumps
 
         Yields:
             Iterator of [Job][openaleph_procrastinate.model.Job]
         """
 
-        min_ts = min_ts or datetime(1970, 1, 1)
-        max_ts = max_ts or datetime.now()
-        params = {
-            "dataset": dataset,
-            "min_ts": min_ts.isoformat(),
-            "max_ts": max_ts.isoformat(),
-            "batch": batch,
-            "queue": queue,
-            "task": task,
-            "status": status,
-        }
-        for id, status_, data in self._execute_iter(sql.ALL_JOBS, **params):
-            data["id"] = id
-            data["status"] = status_
-            job = unpack_job(data)
-            if flatten_entities and isinstance(job, DatasetJob):
-                has_entities = False
-                for entity in job.get_entities():
-                    if entity.id:
-                        has_entities = True
-                        yield EntityJob(**data, entity_id=entity.id)
-                if not has_entities:
-                    yield job
-            else:
-                yield job
+        params = make_job_params(dataset, batch, queue, task, status, min_ts, max_ts)
+        if dump:
+            query = sql.compile_filters(sql.DUMP_JOBS, **params)
+            rows = self._copy_iter(query, sql.DUMP_JOBS_TYPES, **params)
+        else:
+            query = sql.compile_filters(sql.ALL_JOBS, **params)
+            rows = self._execute_iter(query, params)
+        for row in rows:
+            yield from unpack_job_row(row, flatten_entities)
+
+    def iterate_job_pages(
+        self,
+        dataset: str | None = None,
+        batch: str | None = None,
+        queue: str | None = None,
+        task: str | None = None,
+        status: Status | None = None,
+        min_ts: datetime | None = None,
+        max_ts: datetime | None = None,
+        flatten_entities: bool | None = False,
+        page_size: int = 1_000,
+        resume: str | None = None,
+    ) -> Generator[JobsPage, None, None]:
+        """
+        Iterate pages of job objects from the database by given criteria,
+        ordered by job id. Each page is a short query after the last id of the
+        previous page (keyset pagination), so that long scans don't hold a
+        snapshot open and can be resumed after an interruption with the resume
+        token of the last processed page (using the same filters).
+
+        Args:
+            dataset: The dataset to filter for
+            batch: The job batch to filter for
+            queue: The queue name to filter for
+            task: The task name to filter for
+            status: The status to filter for
+            min_ts: Start timestamp (earliest event found in `procrastinate_events`)
+            max_ts: End timestamp (latest event found in `procrastinate_events`)
+            flatten_entities: If true, yield a job for each entity found in the source job
+            page_size: Number of jobs (rows) per page
+            resume: Resume token of the last processed page
+
+        Yields:
+            Iterator of [JobsPage][openaleph_procrastinate.manage.db.JobsPage]
+        """
+        if resume is not None:
+            position = ResumeToken.decode(resume)
+        else:
+            position = ResumeToken(
+                min_ts=min_ts or datetime(1970, 1, 1), max_ts=max_ts or datetime.now()
+            )
+        params = make_job_params(
+            dataset, batch, queue, task, status, position.min_ts, position.max_ts
+        )
+        query = sql.compile_filters(sql.JOBS_PAGE, **params)
+        while True:
+            rows = list(
+                self._execute_iter(
+                    query, {**params, "after": position.after, "limit": page_size}
+                )
+            )
+            if not rows:
+                return
+            position.after = cast(int, rows[-1][0])
+            yield JobsPage(
+                jobs=[j for row in rows for j in unpack_job_row(row, flatten_entities)],
+                token=position.encode(),
+            )
+            if len(rows) < page_size:
+                return
 
     def cancel_jobs(
         self,
@@ -166,9 +417,8 @@ class Db:
             task: The task name to filter for
         """
 
-        self._execute(
-            sql.CANCEL_JOBS, dataset=dataset, batch=batch, queue=queue, task=task
-        )
+        params = {"dataset": dataset, "batch": batch, "queue": queue, "task": task}
+        self._execute(sql.compile_filters(sql.CANCEL_JOBS, **params), **params)
 
     def get_failed_jobs(
         self,
@@ -189,12 +439,9 @@ class Db:
         Yields:
             Rows with (id, queue_name, priority, lock) for each failed job
         """
+        params = {"dataset": dataset, "batch": batch, "queue": queue, "task": task}
         yield from self._execute_iter(
-            sql.GET_FAILED_JOBS,
-            dataset=dataset,
-            batch=batch,
-            queue=queue,
-            task=task,
+            sql.compile_filters(sql.GET_FAILED_JOBS, **params), params
         )
 
     def get_orphaned_jobs(
@@ -220,13 +467,184 @@ class Db:
         Yields:
             Rows with (id, queue_name, priority, lock) for each orphaned job
         """
+        params = {"dataset": dataset, "batch": batch, "queue": queue, "task": task}
         yield from self._execute_iter(
-            sql.GET_ORPHANED_JOBS,
-            dataset=dataset,
-            batch=batch,
+            sql.compile_filters(sql.GET_ORPHANED_JOBS, **params), params
+        )
+
+    def requeue_jobs(
+        self,
+        dataset: str | None = None,
+        batch: str | None = None,
+        queue: str | None = None,
+        task: str | None = None,
+        stalled: bool | None = False,
+        chunk_size: int = REQUEUE_CHUNK_SIZE,
+    ) -> int:
+        """
+        Retry failed (or stalled) jobs by given criteria in chunks of set based
+        updates instead of one `retry_job_by_id` query per job. Each chunk is
+        committed on its own, so an interrupted requeue can just be run again.
+
+        Like procrastinate's retry, the attempts are increased and priority,
+        queue and lock are kept, stalled jobs with a requested abort are set to
+        failed. Jobs whose queueing lock is taken by a waiting job are skipped.
+
+        Args:
+            dataset: The dataset to filter for
+            batch: The job batch to filter for
+            queue: The queue name to filter for
+            task: The task name to filter for
+            stalled: Requeue orphaned jobs (see `get_orphaned_jobs`) instead of
+                failed jobs
+            chunk_size: Number of jobs per update statement
+
+        Returns:
+            The number of requeued jobs
+        """
+        params = {"dataset": dataset, "batch": batch, "queue": queue, "task": task}
+        query = sql.REQUEUE_ORPHANED_IDS if stalled else sql.REQUEUE_FAILED_IDS
+        query = sql.compile_filters(query, **params)
+        after, requeued, failed, skipped = 0, 0, 0, 0
+        with Took() as t:
+            while True:
+                ids = [
+                    cast(int, row[0])
+                    for row in self._execute_iter(
+                        query, {**params, "after": after, "limit": chunk_size}
+                    )
+                ]
+                if not ids:
+                    break
+                after = ids[-1]
+                rows = self._fetch_all(sql.REQUEUE_JOBS, {"ids": ids})
+                statuses = [row[1] for row in rows]
+                requeued += statuses.count("todo")
+                failed += statuses.count("failed")
+                skipped += len(ids) - len(rows)
+                self.log.info(
+                    f"Requeued {requeued} jobs ...",
+                    chunk=len(ids),
+                    failed=failed,
+                    skipped=skipped,
+                    took=t.took,
+                )
+                if len(ids) < chunk_size:
+                    break
+        self.log.info(
+            f"Requeued {requeued} jobs.",
+            failed=failed,
+            skipped=skipped,
+            took=t.took,
+        )
+        return requeued
+
+    def set_concurrency_limit(
+        self,
+        queue: str,
+        max_doing: int,
+        dataset: str | None = None,
+        batch: str | None = None,
+    ) -> None:
+        """
+        Limit the number of concurrently running (`doing`) jobs for a queue,
+        optionally only for a dataset (or a batch of a dataset) within it. The
+        limit is enforced by the fetch functions.
+
+        Args:
+            queue: The queue name
+            max_doing: Max number of running jobs
+            dataset: Limit only the jobs of this dataset
+            batch: Limit only the jobs of this batch (requires dataset)
+        """
+        if batch and not dataset:
+            raise ValueError("A batch limit requires a dataset")
+        self._execute(
+            sql.SET_CONCURRENCY_LIMIT,
             queue=queue,
-            task=task,
+            dataset=dataset or sql.ANY_SCOPE,
+            batch=batch or sql.ANY_SCOPE,
+            max_doing=max_doing,
         )
+        if dataset:
+            # capped datasets are skipped by probing the others via the index
+            self._execute(sql.DATASET_INDEX)
+
+    def remove_concurrency_limit(
+        self, queue: str, dataset: str | None = None, batch: str | None = None
+    ) -> None:
+        """
+        Remove a concurrency limit, see
+        [`set_concurrency_limit`][openaleph_procrastinate.manage.db.Db.set_concurrency_limit]
+        """
+        self._execute(
+            sql.REMOVE_CONCURRENCY_LIMIT,
+            queue=queue,
+            dataset=dataset or sql.ANY_SCOPE,
+            batch=batch or sql.ANY_SCOPE,
+        )
+
+    def iterate_concurrency_limits(self) -> Rows:
+        """
+        Iterate through the configured concurrency limits
+
+        Yields:
+            Rows a tuple with the fields in this order:
+                queue_name, dataset, batch, max doing jobs, currently doing jobs
+        """
+        yield from self._execute_iter(sql.GET_CONCURRENCY_LIMITS)
+
+    def sync_rate_limits(self, settings: DeferSettings | None = None) -> None:
+        """
+        Store the rate limits (`max_rate`) of the stage settings in the
+        database, where the fetch functions enforce them across all workers.
+        Stages without `max_rate` get their limit removed.
+
+        Args:
+            settings: The stage settings (default: from the environment)
+        """
+        settings = settings or DeferSettings()
+        for name, service in settings.services.items():
+            if service.max_rate:
+                self.log.info(
+                    f"Rate limit for `{name}`: {service.max_rate}/s",
+                    queue=service.queue,
+                    task=service.task,
+                )
+                self._execute(
+                    sql.SET_RATE_LIMIT,
+                    queue=service.queue,
+                    task=service.task,
+                    rate=service.max_rate,
+                    burst=service.burst,
+                    per_entity=service.rate_per_entity,
+                )
+            else:
+                self._execute(
+                    sql.REMOVE_RATE_LIMIT, queue=service.queue, task=service.task
+                )
+
+    def sync_priority_aging(self, aging: dict[str, float] | None = None) -> None:
+        """
+        Store the priority aging rates in the database, where the workers
+        apply them periodically. Queues not configured get their aging removed.
+
+        Args:
+            aging: Priority points per minute per queue (default:
+                `OPENALEPH_PRIORITY_AGING`)
+        """
+        if aging is None:
+            aging = self.settings.priority_aging
+        self._execute(sql.CLEAR_PRIORITY_AGING)
+        for queue, rate in aging.items():
+            if rate > 0:
+                self.log.info(f"Priority aging for `{queue}`: {rate}/min")
+                self._execute(
+                    sql.SET_PRIORITY_AGING,
+                    queue=queue,
+                    rate=rate,
+                    max_priority=MAX_PRIORITY,
+                )
 
     def ensure_indexes(self, force: bool = False) -> None:
         """Ensure only desired indexes exist on procrastinate_jobs.
@@ -239,54 +657,63 @@ class Db:
         """
         if force:
             self.log.info("Force rebuilding custom indexes ...")
-            custom = sql.DESIRED_INDEXES - sql.BUILTIN_INDEXES
-            with psycopg.connect(self.uri, autocommit=True) as conn:
-                with conn.cursor() as cur:
-                    for index_name in sorted(custom):
-                        self.log.info(f"Dropping index {index_name} ...")
-                        cur.execute(
-                            psycopg.sql.SQL(
-                                "DROP INDEX CONCURRENTLY IF EXISTS {}"
-                            ).format(psycopg.sql.Identifier(index_name))
-                        )
+            self._drop_indexes(sql.DESIRED_INDEXES - sql.BUILTIN_INDEXES)
         self.configure()
         self.log.info("Checking for stale indexes ...")
-        with psycopg.connect(self.uri) as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql.GET_INDEXES)
-                current = {row[0] for row in cur.fetchall()}
-        stale = current - sql.DESIRED_INDEXES
+        stale = self._get_indexes() - sql.DESIRED_INDEXES
         if not stale:
             self.log.info("No stale indexes found.")
             return
         self.log.info(
             f"Dropping {len(stale)} stale indexes: {', '.join(sorted(stale))}"
         )
-        with psycopg.connect(self.uri, autocommit=True) as conn:
+        self._drop_indexes(stale)
+        self.log.info("Index ensure complete.")
+
+    def _get_indexes(self) -> set[str]:
+        return {row[0] for row in self._fetch_all(sql.GET_INDEXES)}
+
+    def _drop_indexes(self, names: set[str]) -> None:
+        # dropped one by one outside of a transaction, so that the jobs table
+        # isn't locked while the index is removed
+        existing = names & self._get_indexes()
+        with self._connect(autocommit=True) as conn:
             with conn.cursor() as cur:
-                for index_name in sorted(stale):
+                for index_name in sorted(existing):
                     self.log.info(f"Dropping index {index_name} ...")
                     cur.execute(
                         psycopg.sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(
                             psycopg.sql.Identifier(index_name)
                         )
                     )
-        self.log.info("Index ensure complete.")
 
-    def _execute_iter(self, q: LiteralString, **params: str | None) -> Rows:
-        with psycopg.connect(self.settings.procrastinate_db_uri) as connection:
+    def _execute_iter(
+        self,
+        q: LiteralString,
+        params: Mapping[str, Param] | None = None,
+        *,
+        itersize: int | None = None,
+    ) -> Rows:
+        # a named (server side) cursor fetches `itersize` rows per round trip
+        # instead of loading the whole result into memory
+        with self._connect() as connection:
+            with connection.cursor(name=make_cursor_name()) as cursor:
+                cursor.itersize = itersize or self.settings.db_itersize
+                cursor.execute(q, params)
+                yield from cursor
+
+    def _copy_iter(self, q: LiteralString, types: list[str], **params: Param) -> Rows:
+        with self._connect() as connection:
             with connection.cursor() as cursor:
-                cursor.execute(q, dict(params))
-                while rows := cursor.fetchmany(100_000):
-                    yield from rows
+                with cursor.copy(q, dict(params)) as copy:
+                    copy.set_types(types)
+                    yield from copy.rows()
 
-    def _execute(self, q: LiteralString, **params: str | None) -> None:
+    def _execute(self, q: LiteralString, **params: Param) -> None:
         # Use autocommit for DDL (no params) to support multiple statements
         # with $$-quoted strings. Use transactions for DML (with params)
         # to maintain atomicity
-        with psycopg.connect(
-            self.settings.procrastinate_db_uri, autocommit=not params
-        ) as connection:
+        with self._connect(autocommit=not params) as connection:
             with connection.cursor() as cursor:
                 # With parameters, must split to avoid prepared statement error
                 if params:
@@ -298,6 +725,28 @@ class Db:
                 else:
                     cursor.execute(q)
 
+    def _fetch_all(
+        self, q: LiteralString, params: Mapping[str, Param] | None = None
+    ) -> list[tuple[Any, ...]]:
+        # a client side cursor (e.g. for `UPDATE ... RETURNING`, which can't be
+        # declared as a server side cursor), committed before returning
+        with self._connect() as connection:
+            return connection.execute(q, params).fetchall()
+
+    @contextmanager
+    def _connect(
+        self, autocommit: bool | None = False
+    ) -> Generator[psycopg.Connection, None, None]:
+        # the pool commits (or rolls back on errors) when the connection is
+        # returned, autocommit is set per checkout as connections are shared
+        with self.get_pool().connection() as connection:
+            connection.autocommit = bool(autocommit)
+            yield connection
+
+    @staticmethod
+    def _configure_connection(connection: psycopg.Connection) -> None:
+        set_json_loads(json_loads, connection)
+
     def _destroy(self) -> None:
         """Destroy all data (used in tests)"""
         self.log.warning("🔥 Deleting all procrastinate data 🔥")
@@ -305,6 +754,19 @@ class Db:
             "procrastinate_jobs",
             "procrastinate_workers",
             "procrastinate_events",
+            sql.FAIR_SHARE_TABLE,
+            sql.RUNNING_TABLE,
+            sql.RUNNING_DELTAS_TABLE,
+            sql.LIMITS_TABLE,
+            sql.RATE_LIMITS_TABLE,
+            sql.RATE_USAGE_TABLE,
+            sql.LOCKS_TABLE,
+            sql.AGING_TABLE,
+            sql.STATUS_TABLE,
+            sql.STATUS_DELTAS_TABLE,
+            sql.FINISHED_TABLE,
+            sql.SAMPLES_TABLE,
+            sql.SAMPLER_TABLE,
         ):
             try:
                 self._execute(f"TRUNCATE {table} RESTART IDENTITY CASCADE")
@@ -1,21 +1,58 @@
 """sql queries for status aggregation and cancel jobs"""
 
+from typing import Any, LiteralString
+
 # HELPER VARS #
 JOBS = "procrastinate_jobs"
 EVENTS = "procrastinate_events"
+FAIR_SHARE_TABLE = "procrastinate_fair_share"
+RUNNING_TABLE = "procrastinate_running_jobs"
+RUNNING_DELTAS_TABLE = "procrastinate_running_deltas"
+RUNNING_VIEW = "procrastinate_running_jobs_current"
+LIMITS_TABLE = "procrastinate_concurrency_limits"
+RATE_LIMITS_TABLE = "procrastinate_rate_limits"
+RATE_USAGE_TABLE = "procrastinate_rate_limit_usage"
+LOCKS_TABLE = "procrastinate_lock_heads"
+AGING_TABLE = "procrastinate_priority_aging"
+STATUS_TABLE = "procrastinate_status_counts"
+STATUS_DELTAS_TABLE = "procrastinate_status_deltas"
+STATUS_VIEW = "procrastinate_status_counts_current"
+FINISHED_TABLE = "procrastinate_finished_counts"
+SAMPLES_TABLE = "procrastinate_throughput_samples"
+SAMPLER_TABLE = "procrastinate_throughput_sampler"
+ANY_SCOPE = "*"
 
 SYSTEM_DATASET = "__system__"
 DEFAULT_BATCH = "default"
 
 COLUMNS = "dataset, batch, queue_name, task_name, status"
+FINISHED_STATUSES = "'succeeded', 'failed', 'cancelled', 'aborted'"
 
 # FILTERS #
-F_DATASET = "(%(dataset)s::varchar IS NULL OR dataset = %(dataset)s)"
-F_BATCH = "(%(batch)s::varchar IS NULL OR batch = %(batch)s)"
-F_QUEUE = "(%(queue)s::varchar IS NULL OR queue_name = %(queue)s)"
-F_TASK = "(%(task)s::varchar IS NULL OR task_name = %(task)s)"
-F_STATUS = "(%(status)s::procrastinate_job_status IS NULL OR status = %(status)s)"
-F_ALL_ANDS = " AND ".join((F_DATASET, F_BATCH, F_QUEUE, F_TASK, F_STATUS))
+# Filtered queries contain the `FILTERS` placeholder, which is replaced with
+# only the predicates of the given filters via `compile_filters`. Optional
+# predicates like `(%(x)s IS NULL OR col = %(x)s)` can't be used as index
+# conditions with generic plans and lead to sequential scans.
+FILTERS = "{filters}"
+FILTER_COLUMNS: dict[str, LiteralString] = {
+    "dataset": "dataset",
+    "batch": "batch",
+    "queue": "queue_name",
+    "task": "task_name",
+    "status": "status",
+}
+
+
+def compile_filters(q: LiteralString, **params: Any) -> LiteralString:
+    """Replace the `FILTERS` placeholder in the query with the predicates for
+    the filter parameters that are set (not `None`)"""
+    predicates = [
+        f"{column} = %({name})s"
+        for name, column in FILTER_COLUMNS.items()
+        if params.get(name) is not None
+    ]
+    return q.replace(FILTERS, " AND ".join(predicates) or "true")
+
 
 # FOR INITIAL SETUP #
 GENERATED_FIELDS = f"""
@@ -29,6 +66,17 @@ ADD COLUMN IF NOT EXISTS batch TEXT GENERATED ALWAYS AS (
     COALESCE(args->>'batch', '{DEFAULT_BATCH}')
 ) STORED;
 
+-- number of entities in the payload, counted once at defer time so that the
+-- triggers and fetches don't need to detoast the args
+ALTER TABLE {JOBS}
+ADD COLUMN IF NOT EXISTS entity_count INTEGER GENERATED ALWAYS AS (
+    CASE
+        WHEN jsonb_typeof(args->'payload'->'entities') = 'array'
+        THEN jsonb_array_length(args->'payload'->'entities')
+        ELSE 0
+    END
+) STORED;
+
 ALTER TABLE {JOBS}
 ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ;
 
@@ -140,58 +188,765 @@ CUSTOM_INDEXES: set[str] = {
     f"idx_{JOBS}_status",
 }
 
+# Indexes of optional features, only created while the feature is enabled (see
+# `Db.configure`), which drops them otherwise
+DATASET_INDEXES: set[str] = {f"idx_{JOBS}_dataset_fast_path"}
+LOCK_HEAD_INDEXES: set[str] = {f"idx_{JOBS}_lock_head"}
+AGING_INDEXES: set[str] = {f"idx_{JOBS}_aging"}
+FEATURE_INDEXES: set[str] = DATASET_INDEXES | LOCK_HEAD_INDEXES | AGING_INDEXES
+
 # Known-good indexes for procrastinate_jobs table.
 # ensure_indexes() will drop anything not in this set.
-DESIRED_INDEXES: set[str] = BUILTIN_INDEXES | CUSTOM_INDEXES
+DESIRED_INDEXES: set[str] = BUILTIN_INDEXES | CUSTOM_INDEXES | FEATURE_INDEXES
 
 GET_INDEXES = f"""
 SELECT indexname FROM pg_indexes
 WHERE schemaname = 'public' AND tablename = '{JOBS}'
 """
 
-# OPTIMIZED JOB FETCH FUNCTION #
-# Fast path / slow path optimization for ~300x speedup on lock-free jobs
-# Most jobs have lock IS NULL, so check them first with simple index lookup
-# Only fall back to complex NOT EXISTS logic for jobs with locks
-# See: procrastinate-performance-optimization.md (Solution: Fast Path / Slow Path Optimization)
-OPTIMIZED_FETCH_FUNCTION = f"""
-CREATE OR REPLACE FUNCTION procrastinate_fetch_job_v2(
+TABLE_EXISTS = "SELECT to_regclass(%(table)s) IS NOT NULL"
+
+# next lock-free job per queue and dataset, for fair share fetching and to probe
+# the datasets of a queue with a dataset (or batch) concurrency limit
+DATASET_INDEX = f"""
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{JOBS}_dataset_fast_path
+ON {JOBS}(queue_name, dataset, priority DESC, id ASC)
+WHERE status = 'todo' AND lock IS NULL
+"""
+
+# CONCURRENCY AND RATE LIMITS #
+# Max number of `doing` jobs per queue, dataset or batch of a dataset. A limit
+# with dataset (and batch) "*" applies to the whole queue (or dataset). The
+# running jobs are counted in a compact table maintained by statement level
+# triggers on the status transitions, so the fetch functions don't need a
+# `COUNT(*)`. Like the status counts (see `STATUS_COUNTS`), the changes are
+# appended as delta rows and folded into the counts by the statement that gets
+# the compaction lock, so concurrent fetches and finishes of the same dataset
+# don't wait for each other on its counter row. The limits are soft: concurrent
+# fetches (and batch fetches) can overshoot them a bit.
+# Rate limits per queue or task (see `ServiceSettings.max_rate`) are token
+# buckets shared by all workers. The status trigger only appends the taken
+# tokens to a usage table (so that concurrent fetches don't queue up on the
+# bucket rows), the fetches settle them into the buckets without waiting.
+CONCURRENCY_LIMITS = f"""
+CREATE TABLE IF NOT EXISTS {RUNNING_TABLE} (
+    queue_name character varying(128) NOT NULL,
+    dataset text NOT NULL,
+    batch text NOT NULL,
+    doing integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (queue_name, dataset, batch)
+);
+
+CREATE TABLE IF NOT EXISTS {RUNNING_DELTAS_TABLE} (
+    queue_name character varying(128) NOT NULL,
+    dataset text NOT NULL,
+    batch text NOT NULL,
+    doing integer NOT NULL
+);
+
+CREATE OR REPLACE VIEW {RUNNING_VIEW} AS
+SELECT queue_name, dataset, batch, SUM(doing)::integer AS doing
+FROM (
+    SELECT queue_name, dataset, batch, doing FROM {RUNNING_TABLE}
+    UNION ALL
+    SELECT queue_name, dataset, batch, doing FROM {RUNNING_DELTAS_TABLE}
+) AS running
+GROUP BY queue_name, dataset, batch;
+
+CREATE TABLE IF NOT EXISTS {LIMITS_TABLE} (
+    queue_name character varying(128) NOT NULL,
+    dataset text NOT NULL DEFAULT '{ANY_SCOPE}',
+    batch text NOT NULL DEFAULT '{ANY_SCOPE}',
+    max_doing integer NOT NULL CHECK (max_doing >= 0),
+    PRIMARY KEY (queue_name, dataset, batch)
+);
+
+-- token buckets, refilled with `rate` tokens per second up to `burst`
+CREATE TABLE IF NOT EXISTS {RATE_LIMITS_TABLE} (
+    queue_name character varying(128) NOT NULL,
+    task_name character varying(128) NOT NULL DEFAULT '{ANY_SCOPE}',
+    rate double precision NOT NULL CHECK (rate > 0),
+    burst double precision NOT NULL CHECK (burst >= 1),
+    per_entity boolean NOT NULL DEFAULT false,
+    tokens double precision NOT NULL,
+    updated_at timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (queue_name, task_name)
+);
+
+-- tokens taken from the buckets since they were last settled
+CREATE TABLE IF NOT EXISTS {RATE_USAGE_TABLE} (
+    queue_name character varying(128) NOT NULL,
+    task_name character varying(128) NOT NULL,
+    tokens double precision NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_{RATE_USAGE_TABLE}_bucket
+ON {RATE_USAGE_TABLE} (queue_name, task_name);
+
+-- currently available tokens per bucket, including the unsettled usage
+CREATE OR REPLACE VIEW procrastinate_rate_limit_tokens AS
+SELECT r.queue_name, r.task_name, r.rate, LEAST(
+    r.burst, r.tokens + r.rate * EXTRACT(EPOCH FROM now() - r.updated_at)
+) - COALESCE((
+    SELECT SUM(u.tokens)
+    FROM {RATE_USAGE_TABLE} AS u
+    WHERE u.queue_name = r.queue_name AND u.task_name = r.task_name
+), 0) AS tokens
+FROM {RATE_LIMITS_TABLE} AS r;
+
+-- move the usage into the buckets, a queue that is settled by a concurrent
+-- transaction is skipped (its usage is still counted by the view)
+CREATE OR REPLACE FUNCTION procrastinate_rate_limits_settle(
+    target_queue_names character varying[]
+)
+    RETURNS void
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    settle_queue character varying;
+BEGIN
+    FOR settle_queue IN
+        SELECT DISTINCT u.queue_name
+        FROM {RATE_USAGE_TABLE} AS u
+        WHERE target_queue_names IS NULL OR u.queue_name = ANY(target_queue_names)
+    LOOP
+        CONTINUE WHEN NOT pg_try_advisory_xact_lock(
+            hashtext('procrastinate_rate_limits'), hashtext(settle_queue)
+        );
+        WITH taken AS (
+            DELETE FROM {RATE_USAGE_TABLE} AS u
+            WHERE u.queue_name = settle_queue
+            RETURNING u.task_name, u.tokens
+        ), used AS (
+            SELECT task_name, SUM(tokens) AS tokens FROM taken GROUP BY task_name
+        )
+        UPDATE {RATE_LIMITS_TABLE} AS r
+        SET tokens = LEAST(
+                r.burst,
+                r.tokens + r.rate * EXTRACT(EPOCH FROM now() - r.updated_at)
+            ) - used.tokens,
+            updated_at = now()
+        FROM used
+        WHERE r.queue_name = settle_queue AND r.task_name = used.task_name;
+    END LOOP;
+END;
+$$;
+
+-- fold the deltas into the counts, skipped if another transaction does
+CREATE OR REPLACE FUNCTION procrastinate_running_jobs_compact()
+    RETURNS void
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('procrastinate_running_jobs')) THEN
+        RETURN;
+    END IF;
+    WITH deltas AS (
+        DELETE FROM {RUNNING_DELTAS_TABLE} RETURNING *
+    )
+    INSERT INTO {RUNNING_TABLE} AS running (queue_name, dataset, batch, doing)
+    SELECT queue_name, dataset, batch, SUM(doing)
+    FROM deltas
+    GROUP BY queue_name, dataset, batch
+    ORDER BY queue_name, dataset, batch
+    ON CONFLICT (queue_name, dataset, batch)
+    DO UPDATE SET doing = running.doing + EXCLUDED.doing;
+
+    DELETE FROM {RUNNING_TABLE} WHERE doing <= 0;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION procrastinate_running_jobs_update()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        INSERT INTO {RUNNING_DELTAS_TABLE} (queue_name, dataset, batch, doing)
+        SELECT queue_name, dataset, batch, SUM(doing)
+        FROM (
+            SELECT queue_name, dataset, batch, 1 AS doing
+            FROM new_jobs WHERE status = 'doing'
+            UNION ALL
+            SELECT queue_name, dataset, batch, -1 AS doing
+            FROM old_jobs WHERE status = 'doing'
+        ) AS changes
+        GROUP BY queue_name, dataset, batch
+        HAVING SUM(doing) <> 0;
+        -- take tokens from the rate limit buckets (can go negative for
+        -- batch fetches, the debt is paid off by the next refills)
+        INSERT INTO {RATE_USAGE_TABLE} (queue_name, task_name, tokens)
+        SELECT r.queue_name, r.task_name, SUM(CASE
+            WHEN r.per_entity THEN GREATEST(n.entity_count, 1)
+            ELSE 1
+        END)
+        FROM new_jobs AS n
+        JOIN old_jobs AS o ON o.id = n.id
+        JOIN {RATE_LIMITS_TABLE} AS r
+            ON r.queue_name = n.queue_name
+            AND r.task_name IN ('{ANY_SCOPE}', n.task_name)
+        WHERE n.status = 'doing' AND o.status <> 'doing'
+        GROUP BY r.queue_name, r.task_name;
+    ELSE
+        INSERT INTO {RUNNING_DELTAS_TABLE} (queue_name, dataset, batch, doing)
+        SELECT queue_name, dataset, batch, -COUNT(*)
+        FROM old_jobs
+        WHERE status = 'doing'
+        GROUP BY queue_name, dataset, batch;
+    END IF;
+    PERFORM procrastinate_running_jobs_compact();
+    RETURN NULL;
+END;
+$$;
+
+-- transition tables require one trigger per event
+DROP TRIGGER IF EXISTS procrastinate_running_jobs_update ON {JOBS};
+CREATE TRIGGER procrastinate_running_jobs_update
+    AFTER UPDATE ON {JOBS}
+    REFERENCING OLD TABLE AS old_jobs NEW TABLE AS new_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_running_jobs_update();
+
+DROP TRIGGER IF EXISTS procrastinate_running_jobs_delete ON {JOBS};
+CREATE TRIGGER procrastinate_running_jobs_delete
+    AFTER DELETE ON {JOBS}
+    REFERENCING OLD TABLE AS old_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_running_jobs_update();
+
+-- scopes ("queue|dataset|batch" or "queue|task|name") that reached their
+-- concurrency limit or have no tokens left in their rate limit bucket
+CREATE OR REPLACE FUNCTION procrastinate_blocked_scopes(
+    target_queue_names character varying[]
+)
+    RETURNS text[]
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM procrastinate_rate_limits_settle(target_queue_names);
+    RETURN ARRAY(
+        SELECT l.queue_name || '|' || l.dataset || '|' || l.batch
+        FROM {LIMITS_TABLE} AS l
+        WHERE (target_queue_names IS NULL OR l.queue_name = ANY(target_queue_names))
+          AND l.max_doing <= (
+              SELECT COALESCE(SUM(r.doing), 0)
+              FROM {RUNNING_VIEW} AS r
+              WHERE r.queue_name = l.queue_name
+                AND (l.dataset = '{ANY_SCOPE}' OR r.dataset = l.dataset)
+                AND (l.batch = '{ANY_SCOPE}' OR r.batch = l.batch)
+          )
+        UNION ALL
+        SELECT CASE
+            WHEN r.task_name = '{ANY_SCOPE}'
+            THEN r.queue_name || '|{ANY_SCOPE}|{ANY_SCOPE}'
+            ELSE r.queue_name || '|task|' || r.task_name
+        END
+        FROM procrastinate_rate_limit_tokens AS r
+        WHERE (target_queue_names IS NULL OR r.queue_name = ANY(target_queue_names))
+          AND r.tokens < 1
+    );
+END;
+$$;
+
+-- queues with lock-free todo jobs, a skip scan over the fast path index
+CREATE OR REPLACE FUNCTION procrastinate_todo_queues()
+    RETURNS character varying[]
+    LANGUAGE sql
+    STABLE
+AS $$
+    WITH RECURSIVE queues AS (
+        (
+            SELECT jobs.queue_name
+            FROM {JOBS} AS jobs
+            WHERE jobs.status = 'todo' AND jobs.lock IS NULL
+            ORDER BY jobs.queue_name
+            LIMIT 1
+        )
+        UNION ALL
+        SELECT (
+            SELECT jobs.queue_name
+            FROM {JOBS} AS jobs
+            WHERE jobs.status = 'todo'
+              AND jobs.lock IS NULL
+              AND jobs.queue_name > queues.queue_name
+            ORDER BY jobs.queue_name
+            LIMIT 1
+        )
+        FROM queues
+        WHERE queues.queue_name IS NOT NULL
+    )
+    SELECT ARRAY(SELECT queue_name FROM queues WHERE queue_name IS NOT NULL);
+$$;
+
+-- datasets with lock-free todo jobs in a queue, a skip scan over the dataset
+-- index (see `DATASET_INDEX`)
+CREATE OR REPLACE FUNCTION procrastinate_todo_datasets(p_queue_name character varying)
+    RETURNS SETOF text
+    LANGUAGE sql
+    STABLE
+AS $$
+    WITH RECURSIVE datasets AS (
+        (
+            SELECT jobs.dataset
+            FROM {JOBS} AS jobs
+            WHERE jobs.status = 'todo'
+              AND jobs.lock IS NULL
+              AND jobs.queue_name = p_queue_name
+            ORDER BY jobs.dataset
+            LIMIT 1
+        )
+        UNION ALL
+        SELECT (
+            SELECT jobs.dataset
+            FROM {JOBS} AS jobs
+            WHERE jobs.status = 'todo'
+              AND jobs.lock IS NULL
+              AND jobs.queue_name = p_queue_name
+              AND jobs.dataset > datasets.dataset
+            ORDER BY jobs.dataset
+            LIMIT 1
+        )
+        FROM datasets
+        WHERE datasets.dataset IS NOT NULL
+    )
+    SELECT dataset FROM datasets WHERE dataset IS NOT NULL;
+$$;
+
+-- the target queues without the ones that are blocked as a whole, so that the
+-- fetches don't scan their jobs: a queue wide limit is reached, or all todo jobs
+-- of the queue (according to the status counts) are of rate limited tasks that
+-- have no tokens left. NULL (all queues) stays NULL if no queue is blocked.
+CREATE OR REPLACE FUNCTION procrastinate_unblocked_queues(
     target_queue_names character varying[],
-    p_worker_id bigint
+    blocked_scopes text[]
 )
-    RETURNS {JOBS}
+    RETURNS character varying[]
     LANGUAGE plpgsql
+    STABLE
 AS $$
 DECLARE
-    found_jobs {JOBS};
+    blocked_queues character varying[] := ARRAY(
+        SELECT left(scope, -length('|{ANY_SCOPE}|{ANY_SCOPE}'))
+        FROM unnest(blocked_scopes) AS scope
+        WHERE right(scope, length('|{ANY_SCOPE}|{ANY_SCOPE}')) = '|{ANY_SCOPE}|{ANY_SCOPE}'
+        UNION
+        SELECT tasks.queue_name
+        FROM (
+            SELECT split_part(scope, '|task|', 1) AS queue_name,
+                array_agg(split_part(scope, '|task|', 2)) AS task_names
+            FROM unnest(blocked_scopes) AS scope
+            WHERE scope LIKE '%|task|%'
+            GROUP BY 1
+        ) AS tasks
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {STATUS_VIEW} AS c
+            WHERE c.queue_name = tasks.queue_name
+              AND c.status = 'todo'
+              AND c.jobs > 0
+              AND c.task_name <> ALL(tasks.task_names)
+        )
+    );
 BEGIN
-    -- FAST PATH: lock-free jobs (should hit queue-specific partial index)
-    -- ~300x faster than slow path for typical workloads
-    WITH candidate AS (
-        SELECT jobs.id
-        FROM {JOBS} AS jobs
-        WHERE jobs.status = 'todo'
-          AND jobs.lock IS NULL
-          AND (target_queue_names IS NULL OR jobs.queue_name = ANY(target_queue_names))
-          AND (jobs.scheduled_at IS NULL OR jobs.scheduled_at <= now())
-        ORDER BY jobs.priority DESC, jobs.id ASC
-        LIMIT 1
-        FOR UPDATE OF jobs SKIP LOCKED
+    IF cardinality(blocked_queues) = 0 THEN
+        RETURN target_queue_names;
+    END IF;
+    RETURN ARRAY(
+        SELECT queue_name
+        FROM unnest(COALESCE(target_queue_names, procrastinate_todo_queues()))
+            AS queue_name
+        WHERE queue_name <> ALL(blocked_queues)
+    );
+END;
+$$;
+"""
+
+# seconds until the next token of a rate limited bucket for the given queues
+# (0 if none are exhausted), used by workers to back off
+RATE_LIMIT_WAIT = """
+SELECT COALESCE(MIN((1 - r.tokens) / r.rate), 0) AS wait
+FROM procrastinate_rate_limit_tokens AS r
+WHERE (%(queues)s::varchar[] IS NULL OR r.queue_name = ANY(%(queues)s::varchar[]))
+  AND r.tokens < 1
+"""
+
+SET_RATE_LIMIT = f"""
+INSERT INTO {RATE_LIMITS_TABLE} (queue_name, task_name, rate, burst, per_entity, tokens)
+VALUES (%(queue)s, %(task)s, %(rate)s, %(burst)s, %(per_entity)s, %(burst)s)
+ON CONFLICT (queue_name, task_name) DO UPDATE
+SET rate = EXCLUDED.rate, burst = EXCLUDED.burst, per_entity = EXCLUDED.per_entity
+"""
+
+REMOVE_RATE_LIMIT = f"""
+DELETE FROM {RATE_LIMITS_TABLE}
+WHERE queue_name = %(queue)s AND task_name = %(task)s
+"""
+
+# (re-)count the currently running jobs, locked like `REBUILD_STATUS_COUNTS`
+REBUILD_RUNNING_JOBS = f"""
+BEGIN;
+LOCK TABLE {RUNNING_DELTAS_TABLE}, {RUNNING_TABLE} IN EXCLUSIVE MODE;
+DELETE FROM {RUNNING_DELTAS_TABLE};
+DELETE FROM {RUNNING_TABLE};
+INSERT INTO {RUNNING_TABLE} (queue_name, dataset, batch, doing)
+SELECT queue_name, dataset, batch, COUNT(*)
+FROM {JOBS}
+WHERE status = 'doing'
+GROUP BY queue_name, dataset, batch;
+COMMIT;
+"""
+
+# a job candidate is not in a scope that reached its limit, the fetch functions
+# declare `blocked_scopes := procrastinate_blocked_scopes(target_queue_names)`
+# and scan only the queues that aren't blocked as a whole (`fetch_queues`)
+F_NOT_BLOCKED = f"""(
+    cardinality(blocked_scopes) = 0
+    OR NOT ARRAY[
+        jobs.queue_name || '|{ANY_SCOPE}|{ANY_SCOPE}',
+        jobs.queue_name || '|' || jobs.dataset || '|{ANY_SCOPE}',
+        jobs.queue_name || '|' || jobs.dataset || '|' || jobs.batch,
+        jobs.queue_name || '|task|' || jobs.task_name
+    ] && blocked_scopes
+)"""
+
+HAS_DATASET_LIMITS = f"""
+SELECT EXISTS (SELECT 1 FROM {LIMITS_TABLE} WHERE dataset <> '{ANY_SCOPE}')
+"""
+
+SET_CONCURRENCY_LIMIT = f"""
+INSERT INTO {LIMITS_TABLE} (queue_name, dataset, batch, max_doing)
+VALUES (%(queue)s, %(dataset)s, %(batch)s, %(max_doing)s)
+ON CONFLICT (queue_name, dataset, batch)
+DO UPDATE SET max_doing = EXCLUDED.max_doing
+"""
+
+REMOVE_CONCURRENCY_LIMIT = f"""
+DELETE FROM {LIMITS_TABLE}
+WHERE queue_name = %(queue)s AND dataset = %(dataset)s AND batch = %(batch)s
+"""
+
+GET_CONCURRENCY_LIMITS = f"""
+SELECT l.queue_name, l.dataset, l.batch, l.max_doing, (
+    SELECT COALESCE(SUM(r.doing), 0)
+    FROM {RUNNING_VIEW} AS r
+    WHERE r.queue_name = l.queue_name
+      AND (l.dataset = '{ANY_SCOPE}' OR r.dataset = l.dataset)
+      AND (l.batch = '{ANY_SCOPE}' OR r.batch = l.batch)
+) AS doing
+FROM {LIMITS_TABLE} AS l
+ORDER BY l.queue_name, l.dataset, l.batch
+"""
+
+# LOCK STATE #
+# One row per active lock with its head job (the todo job that runs next: the
+# highest priority, then the oldest) and if a job of the lock is running. Kept
+# up to date by triggers on the jobs, which re-read the head via
+# `idx_procrastinate_jobs_lock_head` and the running job via procrastinate's
+# unique `procrastinate_jobs_lock_idx_v1`. An advisory lock per lock value
+# serializes concurrent refreshes, so each one sees the committed jobs of the
+# others. The triggers and the index are only installed with
+# `OPENALEPH_FETCH_LOCK_HEADS` (see `Db.configure`), otherwise the fetch
+# function checks the locks per candidate (see `compile_fetch_function`).
+LOCK_STATE = f"""
+CREATE TABLE IF NOT EXISTS {LOCKS_TABLE} (
+    lock text PRIMARY KEY,
+    job_id bigint,
+    priority integer,
+    queue_name character varying(128),
+    scheduled_at timestamp with time zone,
+    busy boolean NOT NULL DEFAULT false
+);
+
+CREATE INDEX IF NOT EXISTS idx_{LOCKS_TABLE}_fetch
+ON {LOCKS_TABLE} (priority DESC, job_id ASC)
+WHERE NOT busy AND job_id IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION procrastinate_lock_state_refresh(p_lock text)
+    RETURNS void
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    head record;
+    is_busy boolean;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('procrastinate_lock_heads'), hashtext(p_lock));
+
+    SELECT jobs.id, jobs.priority, jobs.queue_name, jobs.scheduled_at INTO head
+    FROM {JOBS} AS jobs
+    WHERE jobs.lock = p_lock AND jobs.status = 'todo'
+    ORDER BY jobs.priority DESC, jobs.id ASC
+    LIMIT 1;
+
+    is_busy := EXISTS (
+        SELECT 1 FROM {JOBS} AS jobs
+        WHERE jobs.lock = p_lock AND jobs.status = 'doing'
+    );
+
+    IF head.id IS NULL AND NOT is_busy THEN
+        DELETE FROM {LOCKS_TABLE} WHERE lock = p_lock;
+    ELSE
+        INSERT INTO {LOCKS_TABLE} (lock, job_id, priority, queue_name, scheduled_at, busy)
+        VALUES (p_lock, head.id, head.priority, head.queue_name, head.scheduled_at, is_busy)
+        ON CONFLICT (lock) DO UPDATE
+        SET job_id = EXCLUDED.job_id,
+            priority = EXCLUDED.priority,
+            queue_name = EXCLUDED.queue_name,
+            scheduled_at = EXCLUDED.scheduled_at,
+            busy = EXCLUDED.busy;
+    END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION procrastinate_lock_state_update()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM procrastinate_lock_state_refresh(NEW.lock);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM procrastinate_lock_state_refresh(OLD.lock);
+    ELSE
+        IF OLD.lock IS NOT NULL THEN
+            PERFORM procrastinate_lock_state_refresh(OLD.lock);
+        END IF;
+        IF NEW.lock IS NOT NULL AND NEW.lock IS DISTINCT FROM OLD.lock THEN
+            PERFORM procrastinate_lock_state_refresh(NEW.lock);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+"""
+
+LOCK_HEAD_INDEX = f"""
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{JOBS}_lock_head
+ON {JOBS}(lock, priority DESC, id ASC)
+WHERE status = 'todo' AND lock IS NOT NULL
+"""
+
+LOCK_STATE_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS procrastinate_lock_state_insert ON {JOBS};
+CREATE TRIGGER procrastinate_lock_state_insert
+    AFTER INSERT ON {JOBS}
+    FOR EACH ROW
+    WHEN (NEW.lock IS NOT NULL)
+    EXECUTE PROCEDURE procrastinate_lock_state_update();
+
+DROP TRIGGER IF EXISTS procrastinate_lock_state_update ON {JOBS};
+CREATE TRIGGER procrastinate_lock_state_update
+    AFTER UPDATE OF status, priority, lock, queue_name, scheduled_at ON {JOBS}
+    FOR EACH ROW
+    WHEN (OLD.lock IS NOT NULL OR NEW.lock IS NOT NULL)
+    EXECUTE PROCEDURE procrastinate_lock_state_update();
+
+DROP TRIGGER IF EXISTS procrastinate_lock_state_delete ON {JOBS};
+CREATE TRIGGER procrastinate_lock_state_delete
+    AFTER DELETE ON {JOBS}
+    FOR EACH ROW
+    WHEN (OLD.lock IS NOT NULL)
+    EXECUTE PROCEDURE procrastinate_lock_state_update();
+"""
+
+DROP_LOCK_STATE_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS procrastinate_lock_state_insert ON {JOBS};
+DROP TRIGGER IF EXISTS procrastinate_lock_state_update ON {JOBS};
+DROP TRIGGER IF EXISTS procrastinate_lock_state_delete ON {JOBS};
+DELETE FROM {LOCKS_TABLE};
+"""
+
+# (re-)build the lock state from the current jobs
+REBUILD_LOCK_STATE = f"""
+BEGIN;
+DELETE FROM {LOCKS_TABLE};
+INSERT INTO {LOCKS_TABLE} (lock, job_id, priority, queue_name, scheduled_at, busy)
+SELECT locks.lock, head.id, head.priority, head.queue_name, head.scheduled_at,
+    EXISTS (
+        SELECT 1 FROM {JOBS} AS jobs
+        WHERE jobs.lock = locks.lock AND jobs.status = 'doing'
     )
-    UPDATE {JOBS}
-    SET status = 'doing', worker_id = p_worker_id
-    FROM candidate
-    WHERE {JOBS}.id = candidate.id
-    RETURNING {JOBS}.* INTO found_jobs;
+FROM (
+    SELECT DISTINCT lock FROM {JOBS}
+    WHERE lock IS NOT NULL AND status IN ('todo', 'doing')
+) AS locks
+LEFT JOIN LATERAL (
+    SELECT jobs.id, jobs.priority, jobs.queue_name, jobs.scheduled_at
+    FROM {JOBS} AS jobs
+    WHERE jobs.lock = locks.lock AND jobs.status = 'todo'
+    ORDER BY jobs.priority DESC, jobs.id ASC
+    LIMIT 1
+) AS head ON true;
+COMMIT;
+"""
 
-    IF FOUND THEN
-        RETURN found_jobs;
+# PRIORITY AGING #
+# Waiting jobs of a queue gain `rate` priority points per minute (up to
+# `max_priority`), so that low priority jobs don't wait forever under sustained
+# load of higher priority jobs. The aging raises the actual `priority` of the
+# jobs (starting from their original `base_priority`), so the fetch functions
+# and their indexes stay the same. Jobs age from when they are due (created or
+# scheduled, e.g. retried). The priority is raised in steps of
+# `PRIORITY_AGING_STEP` points, so a job is only rewritten a few times while it
+# waits instead of on every run. Workers run the aging periodically, an
+# advisory lock makes sure only one of them does at a time. Each run rewrites
+# at most `PRIORITY_AGING_LIMIT` jobs per queue (the longest waiting first, via
+# `AGING_INDEX`), the next runs catch up on the rest. The triggers and the index
+# are only installed while aging is configured (see `Db.configure`).
+PRIORITY_AGING_STEP = 10
+PRIORITY_AGING_LIMIT = 10_000
+PRIORITY_AGING = f"""
+ALTER TABLE {JOBS}
+ADD COLUMN IF NOT EXISTS base_priority integer;
+
+CREATE OR REPLACE FUNCTION procrastinate_base_priority()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.base_priority := NEW.priority;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TABLE IF NOT EXISTS {AGING_TABLE} (
+    queue_name character varying(128) PRIMARY KEY,
+    rate double precision NOT NULL CHECK (rate > 0),
+    max_priority integer NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION procrastinate_age_priorities()
+    RETURNS integer
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    conf record;
+    aged integer := 0;
+    updated integer;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('procrastinate_age_priorities')) THEN
+        RETURN 0;
     END IF;
+    FOR conf IN SELECT queue_name, rate, max_priority FROM {AGING_TABLE} LOOP
+        WITH aging AS (
+            SELECT jobs.id, step.priority
+            FROM {JOBS} AS jobs
+            CROSS JOIN LATERAL (
+                SELECT LEAST(
+                    conf.max_priority,
+                    jobs.base_priority + {PRIORITY_AGING_STEP} * floor(
+                        conf.rate * EXTRACT(
+                            EPOCH FROM now() - COALESCE(jobs.scheduled_at, jobs.created_at)
+                        )
+                        / 60 / {PRIORITY_AGING_STEP}
+                    )
+                )::integer AS priority
+            ) AS step
+            WHERE jobs.status = 'todo'
+              AND jobs.queue_name = conf.queue_name
+              AND jobs.base_priority IS NOT NULL
+              -- at least one step old
+              AND COALESCE(jobs.scheduled_at, jobs.created_at) <= now() - make_interval(
+                  secs => 60 * {PRIORITY_AGING_STEP} / conf.rate
+              )
+              -- only jobs that reached a new step are locked and rewritten
+              AND jobs.priority < step.priority
+            ORDER BY COALESCE(jobs.scheduled_at, jobs.created_at)
+            LIMIT {PRIORITY_AGING_LIMIT}
+            FOR UPDATE OF jobs SKIP LOCKED
+        )
+        UPDATE {JOBS}
+        SET priority = aging.priority
+        FROM aging
+        WHERE {JOBS}.id = aging.id;
+        GET DIAGNOSTICS updated = ROW_COUNT;
+        aged := aged + updated;
+    END LOOP;
+    RETURN aged;
+END;
+$$;
+"""
 
-    -- SLOW PATH: jobs with locks (requires NOT EXISTS check for lock conflicts)
-    -- Only executed if fast path returns nothing
-    WITH candidate AS (
-        SELECT jobs.id
+# the todo jobs of a queue by when they are due, the longest waiting first
+AGING_INDEX = f"""
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{JOBS}_aging
+ON {JOBS}(queue_name, (COALESCE(scheduled_at, created_at)))
+WHERE status = 'todo' AND base_priority IS NOT NULL
+"""
+
+PRIORITY_AGING_TRIGGERS = f"""
+-- jobs deferred before the base priority (or while aging was disabled)
+UPDATE {JOBS} SET base_priority = priority
+WHERE base_priority IS NULL AND status = 'todo';
+
+DROP TRIGGER IF EXISTS procrastinate_base_priority ON {JOBS};
+CREATE TRIGGER procrastinate_base_priority
+    BEFORE INSERT ON {JOBS}
+    FOR EACH ROW
+    EXECUTE PROCEDURE procrastinate_base_priority();
+
+-- a job that returns to the queue with a new priority (retry) ages from
+-- there, with an unchanged priority it keeps its base (and aged) priority
+DROP TRIGGER IF EXISTS procrastinate_base_priority_update ON {JOBS};
+CREATE TRIGGER procrastinate_base_priority_update
+    BEFORE UPDATE OF status ON {JOBS}
+    FOR EACH ROW
+    WHEN (
+        NEW.status = 'todo'
+        AND OLD.status <> 'todo'
+        AND (
+            NEW.base_priority IS NULL
+            OR NEW.priority IS DISTINCT FROM OLD.priority
+        )
+    )
+    EXECUTE PROCEDURE procrastinate_base_priority();
+"""
+
+# the base priorities aren't kept up to date anymore, they are backfilled when
+# aging is enabled again
+DROP_PRIORITY_AGING_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS procrastinate_base_priority ON {JOBS};
+DROP TRIGGER IF EXISTS procrastinate_base_priority_update ON {JOBS};
+UPDATE {JOBS} SET base_priority = NULL
+WHERE base_priority IS NOT NULL AND status = 'todo';
+"""
+
+AGE_PRIORITIES = "SELECT procrastinate_age_priorities() AS aged"
+
+CLEAR_PRIORITY_AGING = f"DELETE FROM {AGING_TABLE}"
+
+SET_PRIORITY_AGING = f"""
+INSERT INTO {AGING_TABLE} (queue_name, rate, max_priority)
+VALUES (%(queue)s, %(rate)s, %(max_priority)s)
+"""
+
+# OPTIMIZED JOB FETCH FUNCTION #
+# Fast path / slow path optimization for ~300x speedup on lock-free jobs
+# Most jobs have lock IS NULL, so check them first with simple index lookup
+# Only fall back to the lock state (see LOCK_STATE) for jobs with locks
+# See: procrastinate-performance-optimization.md (Solution: Fast Path / Slow Path Optimization)
+# The fast path of the single and the batch fetch claims via
+# `procrastinate_claim_jobs`: a queue with a dataset (or batch) that reached its
+# concurrency limit isn't scanned by priority, which would walk the whole
+# backlog of a capped big dataset on every fetch. Instead, its other datasets
+# are probed one by one via `DATASET_INDEX` (if it exists) and the best
+# candidates of all are claimed.
+# The slow path contains the `LOCKED_CANDIDATES` placeholder, which is replaced
+# via `compile_fetch_function` depending on whether the lock state is kept.
+LOCKED_CANDIDATES = "{locked_candidates}"
+
+# the head jobs of the lock state, an index lookup
+LOCK_HEAD_CANDIDATES = f"""SELECT jobs.id
+        FROM {LOCKS_TABLE} AS heads
+        JOIN {JOBS} AS jobs ON jobs.id = heads.job_id
+        WHERE NOT heads.busy
+          AND heads.job_id IS NOT NULL
+          AND (target_queue_names IS NULL OR heads.queue_name = ANY(target_queue_names))
+          AND (heads.scheduled_at IS NULL OR heads.scheduled_at <= now())
+          AND jobs.status = 'todo'
+          AND {F_NOT_BLOCKED}
+        ORDER BY heads.priority DESC, heads.job_id ASC"""
+
+# without the lock state: a NOT EXISTS check per candidate
+LOCK_SCAN_CANDIDATES = f"""SELECT jobs.id
         FROM {JOBS} AS jobs
         WHERE jobs.status = 'todo'
           AND jobs.lock IS NOT NULL
@@ -212,7 +967,154 @@ BEGIN
                     )
                 )
           )
-        ORDER BY jobs.priority DESC, jobs.id ASC
+          AND {F_NOT_BLOCKED}
+        ORDER BY jobs.priority DESC, jobs.id ASC"""
+
+OPTIMIZED_FETCH_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION procrastinate_claim_jobs(
+    fetch_queues character varying[],
+    p_worker_id bigint,
+    p_limit integer,
+    blocked_scopes text[]
+)
+    RETURNS SETOF {JOBS}
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    probe_queues character varying[];
+    scan_queues character varying[];
+    candidate_ids bigint[];
+    attempts integer := 0;
+    claimed integer := 0;
+    updated integer;
+BEGIN
+    IF to_regclass('idx_{JOBS}_dataset_fast_path') IS NOT NULL THEN
+        probe_queues := ARRAY(
+            SELECT DISTINCT split_part(scope, '|', 1)
+            FROM unnest(blocked_scopes) AS scope
+            WHERE split_part(scope, '|', 2) NOT IN ('{ANY_SCOPE}', 'task')
+              AND (fetch_queues IS NULL OR split_part(scope, '|', 1) = ANY(fetch_queues))
+        );
+    END IF;
+
+    IF COALESCE(cardinality(probe_queues), 0) = 0 THEN
+        RETURN QUERY
+        WITH candidates AS (
+            SELECT jobs.id
+            FROM {JOBS} AS jobs
+            WHERE jobs.status = 'todo'
+              AND jobs.lock IS NULL
+              AND (fetch_queues IS NULL OR jobs.queue_name = ANY(fetch_queues))
+              AND (jobs.scheduled_at IS NULL OR jobs.scheduled_at <= now())
+              AND {F_NOT_BLOCKED}
+            ORDER BY jobs.priority DESC, jobs.id ASC
+            LIMIT p_limit
+            FOR UPDATE OF jobs SKIP LOCKED
+        ), claimed_jobs AS (
+            UPDATE {JOBS}
+            SET status = 'doing', worker_id = p_worker_id
+            FROM candidates
+            WHERE {JOBS}.id = candidates.id
+            RETURNING {JOBS}.*
+        )
+        SELECT * FROM claimed_jobs;
+        RETURN;
+    END IF;
+
+    scan_queues := ARRAY(
+        SELECT queue_name
+        FROM unnest(COALESCE(fetch_queues, procrastinate_todo_queues())) AS queue_name
+        WHERE queue_name <> ALL(probe_queues)
+    );
+    -- the candidates are looked up without locks, a few more attempts if
+    -- concurrent fetches claimed them first
+    WHILE claimed < p_limit AND attempts < 3 LOOP
+        attempts := attempts + 1;
+        candidate_ids := ARRAY(
+            SELECT c.id
+            FROM (
+                (
+                    SELECT jobs.id, jobs.priority
+                    FROM {JOBS} AS jobs
+                    WHERE jobs.status = 'todo'
+                      AND jobs.lock IS NULL
+                      AND jobs.queue_name = ANY(scan_queues)
+                      AND (jobs.scheduled_at IS NULL OR jobs.scheduled_at <= now())
+                      AND {F_NOT_BLOCKED}
+                    ORDER BY jobs.priority DESC, jobs.id ASC
+                    LIMIT p_limit - claimed
+                )
+                UNION ALL
+                SELECT probe.id, probe.priority
+                FROM unnest(probe_queues) AS probe_queue
+                CROSS JOIN LATERAL procrastinate_todo_datasets(probe_queue) AS todo_dataset
+                CROSS JOIN LATERAL (
+                    SELECT jobs.id, jobs.priority
+                    FROM {JOBS} AS jobs
+                    WHERE jobs.status = 'todo'
+                      AND jobs.lock IS NULL
+                      AND jobs.queue_name = probe_queue
+                      AND jobs.dataset = todo_dataset
+                      AND (jobs.scheduled_at IS NULL OR jobs.scheduled_at <= now())
+                      AND {F_NOT_BLOCKED}
+                    ORDER BY jobs.priority DESC, jobs.id ASC
+                    LIMIT p_limit - claimed
+                ) AS probe
+                WHERE probe_queue || '|' || todo_dataset || '|{ANY_SCOPE}'
+                    <> ALL(blocked_scopes)
+            ) AS c
+            ORDER BY c.priority DESC, c.id ASC
+            LIMIT p_limit - claimed
+        );
+        EXIT WHEN cardinality(candidate_ids) = 0;
+
+        RETURN QUERY
+        WITH candidates AS (
+            SELECT jobs.id
+            FROM {JOBS} AS jobs
+            WHERE jobs.id = ANY(candidate_ids) AND jobs.status = 'todo'
+            FOR UPDATE OF jobs SKIP LOCKED
+        ), claimed_jobs AS (
+            UPDATE {JOBS}
+            SET status = 'doing', worker_id = p_worker_id
+            FROM candidates
+            WHERE {JOBS}.id = candidates.id
+            RETURNING {JOBS}.*
+        )
+        SELECT * FROM claimed_jobs;
+        GET DIAGNOSTICS updated = ROW_COUNT;
+        claimed := claimed + updated;
+    END LOOP;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION procrastinate_fetch_job_v2(
+    target_queue_names character varying[],
+    p_worker_id bigint
+)
+    RETURNS {JOBS}
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    found_jobs {JOBS};
+    blocked_scopes text[] := procrastinate_blocked_scopes(target_queue_names);
+    fetch_queues character varying[] := procrastinate_unblocked_queues(
+        target_queue_names, blocked_scopes
+    );
+BEGIN
+    -- FAST PATH: lock-free jobs (should hit queue-specific partial index)
+    -- ~300x faster than slow path for typical workloads
+    SELECT * INTO found_jobs
+    FROM procrastinate_claim_jobs(fetch_queues, p_worker_id, 1, blocked_scopes);
+
+    IF FOUND THEN
+        RETURN found_jobs;
+    END IF;
+
+    -- SLOW PATH: jobs with locks, only the head job (highest priority, then
+    -- oldest) of a lock without a running job can be fetched
+    WITH candidate AS (
+        {LOCKED_CANDIDATES}
         LIMIT 1
         FOR UPDATE OF jobs SKIP LOCKED
     )
@@ -228,35 +1130,654 @@ $$;
 """
 
 
+def compile_fetch_function(lock_heads: bool) -> LiteralString:
+    """Replace the `LOCKED_CANDIDATES` placeholder in the fetch function with
+    the lookup of the lock state (if kept) or the check per candidate"""
+    candidates = LOCK_HEAD_CANDIDATES if lock_heads else LOCK_SCAN_CANDIDATES
+    return OPTIMIZED_FETCH_FUNCTION.replace(LOCKED_CANDIDATES, candidates)
+
+
+# Claim up to `p_limit` jobs per call (see `app.PrefetchJobManager`). Lock-free
+# jobs are claimed in one statement, jobs with locks are still fetched one at a
+# time via `procrastinate_fetch_job_v2` to respect the lock ordering.
+BATCH_FETCH_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION procrastinate_fetch_jobs_batch(
+    target_queue_names character varying[],
+    p_worker_id bigint,
+    p_limit integer
+)
+    RETURNS SETOF {JOBS}
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    blocked_scopes text[] := procrastinate_blocked_scopes(target_queue_names);
+    fetch_queues character varying[] := procrastinate_unblocked_queues(
+        target_queue_names, blocked_scopes
+    );
+BEGIN
+    -- FAST PATH: lock-free jobs (same as the single fetch)
+    RETURN QUERY
+    SELECT * FROM procrastinate_claim_jobs(
+        fetch_queues, p_worker_id, p_limit, blocked_scopes
+    );
+
+    IF FOUND THEN
+        RETURN;
+    END IF;
+
+    -- SLOW PATH: one job with a lock
+    RETURN QUERY
+    SELECT * FROM procrastinate_fetch_job_v2(target_queue_names, p_worker_id) AS job
+    WHERE job.id IS NOT NULL;
+END;
+$$;
+"""
+
+# FAIR SHARE JOB FETCH FUNCTION #
+# Round-robin over the datasets of the target queues instead of strictly by
+# priority, so that one big dataset can't starve the others. The datasets with
+# todo jobs are tracked in a small bookkeeping table (filled via a statement
+# level insert trigger), the least recently served dataset comes first. Within
+# a dataset, jobs are fetched by priority via `DATASET_INDEX`. The triggers and
+# the index are only installed with `fetch_fair_share` (`FAIR_SHARE_TRIGGERS`),
+# without them the fair fetch falls back to the regular fetch. Datasets that
+# reached their concurrency limit are skipped without looking at their jobs.
+FAIR_SHARE = f"""
+CREATE TABLE IF NOT EXISTS {FAIR_SHARE_TABLE} (
+    queue_name character varying(128) NOT NULL,
+    dataset text NOT NULL,
+    last_fetched_at timestamp with time zone NOT NULL DEFAULT '-infinity',
+    PRIMARY KEY (queue_name, dataset)
+);
+
+CREATE INDEX IF NOT EXISTS idx_{FAIR_SHARE_TABLE}_last_fetched_at
+ON {FAIR_SHARE_TABLE} (last_fetched_at);
+
+-- A dataset with waiting jobs needs a row, added when jobs are inserted or
+-- return to 'todo' (retry, release, requeue). A fetch removes the row of a
+-- drained dataset, the shared advisory lock keeps it from doing so while a
+-- transaction that adds jobs for it is not committed yet.
+CREATE OR REPLACE FUNCTION procrastinate_fair_share_add(
+    p_queue_name character varying,
+    p_dataset text
+)
+    RETURNS void
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock_shared(
+        hashtext('procrastinate_fair_share'), hashtext(p_queue_name || '/' || p_dataset)
+    );
+    INSERT INTO {FAIR_SHARE_TABLE} (queue_name, dataset)
+    VALUES (p_queue_name, p_dataset)
+    ON CONFLICT DO NOTHING;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION procrastinate_fair_share_add_jobs()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    share record;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        FOR share IN
+            SELECT DISTINCT queue_name, dataset FROM new_jobs
+            WHERE status = 'todo'
+            ORDER BY queue_name, dataset
+        LOOP
+            PERFORM procrastinate_fair_share_add(share.queue_name, share.dataset);
+        END LOOP;
+    ELSE
+        FOR share IN
+            SELECT DISTINCT n.queue_name, n.dataset
+            FROM new_jobs n
+            JOIN old_jobs o ON o.id = n.id
+            WHERE n.status = 'todo' AND o.status <> 'todo'
+            ORDER BY n.queue_name, n.dataset
+        LOOP
+            PERFORM procrastinate_fair_share_add(share.queue_name, share.dataset);
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS procrastinate_fair_share_insert ON {JOBS};
+DROP FUNCTION IF EXISTS procrastinate_fair_share_insert();
+
+CREATE OR REPLACE FUNCTION procrastinate_fetch_jobs_fair(
+    target_queue_names character varying[],
+    p_worker_id bigint,
+    p_limit integer
+)
+    RETURNS SETOF {JOBS}
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    share record;
+    found_job {JOBS};
+    claimed integer := 0;
+    blocked_scopes text[] := procrastinate_blocked_scopes(target_queue_names);
+    fetch_queues character varying[] := procrastinate_unblocked_queues(
+        target_queue_names, blocked_scopes
+    );
+BEGIN
+    FOR share IN
+        SELECT queue_name, dataset
+        FROM {FAIR_SHARE_TABLE}
+        WHERE fetch_queues IS NULL OR queue_name = ANY(fetch_queues)
+        ORDER BY last_fetched_at ASC
+        FOR UPDATE SKIP LOCKED
+    LOOP
+        CONTINUE WHEN share.queue_name || '|' || share.dataset || '|{ANY_SCOPE}'
+            = ANY(blocked_scopes);
+        WITH candidate AS (
+            SELECT jobs.id
+            FROM {JOBS} AS jobs
+            WHERE jobs.status = 'todo'
+              AND jobs.lock IS NULL
+              AND jobs.queue_name = share.queue_name
+              AND jobs.dataset = share.dataset
+              AND (jobs.scheduled_at IS NULL OR jobs.scheduled_at <= now())
+              AND {F_NOT_BLOCKED}
+            ORDER BY jobs.priority DESC, jobs.id ASC
+            LIMIT 1
+            FOR UPDATE OF jobs SKIP LOCKED
+        )
+        UPDATE {JOBS}
+        SET status = 'doing', worker_id = p_worker_id
+        FROM candidate
+        WHERE {JOBS}.id = candidate.id
+        RETURNING {JOBS}.* INTO found_job;
+
+        IF FOUND THEN
+            UPDATE {FAIR_SHARE_TABLE}
+            SET last_fetched_at = clock_timestamp()
+            WHERE queue_name = share.queue_name AND dataset = share.dataset;
+            claimed := claimed + 1;
+            RETURN NEXT found_job;
+            EXIT WHEN claimed >= p_limit;
+        -- not while jobs for it are being added, see `procrastinate_fair_share_add`
+        ELSIF pg_try_advisory_xact_lock(
+            hashtext('procrastinate_fair_share'),
+            hashtext(share.queue_name || '/' || share.dataset)
+        ) THEN
+            IF NOT EXISTS (
+                SELECT 1 FROM {JOBS} AS jobs
+                WHERE jobs.status = 'todo'
+                  AND jobs.lock IS NULL
+                  AND jobs.queue_name = share.queue_name
+                  AND jobs.dataset = share.dataset
+            ) THEN
+                -- dataset is done for this queue, new or returning jobs add it
+                -- again
+                DELETE FROM {FAIR_SHARE_TABLE}
+                WHERE queue_name = share.queue_name AND dataset = share.dataset;
+            END IF;
+        END IF;
+    END LOOP;
+
+    -- jobs with locks (or datasets missing in the bookkeeping table) are
+    -- fetched the regular way
+    IF claimed = 0 THEN
+        RETURN QUERY
+        SELECT * FROM procrastinate_fetch_job_v2(target_queue_names, p_worker_id) AS job
+        WHERE job.id IS NOT NULL;
+    END IF;
+END;
+$$;
+"""
+
+FAIR_SHARE_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS procrastinate_fair_share_insert ON {JOBS};
+CREATE TRIGGER procrastinate_fair_share_insert
+    AFTER INSERT ON {JOBS}
+    REFERENCING NEW TABLE AS new_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_fair_share_add_jobs();
+
+DROP TRIGGER IF EXISTS procrastinate_fair_share_update ON {JOBS};
+CREATE TRIGGER procrastinate_fair_share_update
+    AFTER UPDATE ON {JOBS}
+    REFERENCING OLD TABLE AS old_jobs NEW TABLE AS new_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_fair_share_add_jobs();
+
+-- datasets with jobs added while the triggers didn't exist
+INSERT INTO {FAIR_SHARE_TABLE} (queue_name, dataset)
+SELECT DISTINCT queue_name, dataset FROM {JOBS}
+WHERE status = 'todo' AND lock IS NULL
+ON CONFLICT DO NOTHING;
+"""
+
+# the bookkeeping is outdated without the triggers
+DROP_FAIR_SHARE_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS procrastinate_fair_share_insert ON {JOBS};
+DROP TRIGGER IF EXISTS procrastinate_fair_share_update ON {JOBS};
+DELETE FROM {FAIR_SHARE_TABLE};
+"""
+
+FAIR_FETCH_JOBS = """
+SELECT * FROM procrastinate_fetch_jobs_fair(
+    %(queues)s::varchar[], %(worker_id)s, %(limit)s
+);
+"""
+
+BATCH_FETCH_JOBS = """
+SELECT * FROM procrastinate_fetch_jobs_batch(
+    %(queues)s::varchar[], %(worker_id)s, %(limit)s
+);
+"""
+
+# put claimed but not started jobs back to the queue
+RELEASE_JOBS = f"""
+UPDATE {JOBS}
+SET status = 'todo', worker_id = NULL
+WHERE id = ANY(%(job_ids)s) AND status = 'doing';
+"""
+
+# STATUS COUNTS #
+# The job counts per status group are maintained by statement level triggers
+# that aggregate the changed rows (transition tables) into one delta row per
+# group. The deltas are appended to their own table, so that concurrent fetches
+# and finishes don't wait for each other on the counts rows. A statement that
+# gets the (non-blocking) compaction lock folds all visible deltas into the
+# counts table, the others leave theirs for the next one. The status summary
+# reads the counts plus the pending deltas (`STATUS_VIEW`).
+# `min_ts` and `max_ts` are bounds since the group became non-empty: they are
+# not narrowed when jobs leave the group, `REBUILD_STATUS_COUNTS` reconciles.
+STATUS_COUNTS = f"""
+CREATE TABLE IF NOT EXISTS {STATUS_TABLE} (
+    dataset text NOT NULL,
+    batch text NOT NULL,
+    queue_name character varying(128) NOT NULL,
+    task_name character varying(128) NOT NULL,
+    status procrastinate_job_status NOT NULL,
+    jobs bigint NOT NULL DEFAULT 0,
+    min_ts timestamp with time zone,
+    max_ts timestamp with time zone,
+    PRIMARY KEY (dataset, batch, queue_name, task_name, status)
+);
+
+CREATE TABLE IF NOT EXISTS {STATUS_DELTAS_TABLE} (
+    dataset text NOT NULL,
+    batch text NOT NULL,
+    queue_name character varying(128) NOT NULL,
+    task_name character varying(128) NOT NULL,
+    status procrastinate_job_status NOT NULL,
+    jobs bigint NOT NULL,
+    min_ts timestamp with time zone,
+    max_ts timestamp with time zone
+);
+
+CREATE OR REPLACE VIEW {STATUS_VIEW} AS
+SELECT {COLUMNS}, SUM(jobs)::bigint AS jobs, MIN(min_ts) AS min_ts,
+    MAX(max_ts) AS max_ts
+FROM (
+    SELECT {COLUMNS}, jobs, min_ts, max_ts FROM {STATUS_TABLE}
+    UNION ALL
+    SELECT {COLUMNS}, jobs, min_ts, max_ts FROM {STATUS_DELTAS_TABLE}
+) AS counts
+GROUP BY {COLUMNS};
+
+-- fold the deltas into the counts, skipped if another transaction does
+CREATE OR REPLACE FUNCTION procrastinate_status_counts_compact()
+    RETURNS void
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    emptied text[];
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('procrastinate_status_counts')) THEN
+        RETURN;
+    END IF;
+    WITH deltas AS (
+        DELETE FROM {STATUS_DELTAS_TABLE} RETURNING *
+    ), applied AS (
+        INSERT INTO {STATUS_TABLE} AS c ({COLUMNS}, jobs, min_ts, max_ts)
+        SELECT {COLUMNS}, SUM(jobs), MIN(min_ts), MAX(max_ts)
+        FROM deltas
+        GROUP BY {COLUMNS}
+        ORDER BY {COLUMNS}
+        ON CONFLICT ({COLUMNS}) DO UPDATE
+        SET min_ts = LEAST(c.min_ts, EXCLUDED.min_ts),
+            max_ts = GREATEST(c.max_ts, EXCLUDED.max_ts),
+            jobs = c.jobs + EXCLUDED.jobs
+        RETURNING c.dataset, c.jobs
+    )
+    SELECT array_agg(DISTINCT dataset) INTO emptied
+    FROM applied WHERE jobs <= 0;
+
+    IF emptied IS NOT NULL THEN
+        DELETE FROM {STATUS_TABLE}
+        WHERE dataset = ANY(emptied) AND jobs <= 0;
+    END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION procrastinate_status_counts_update()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM {STATUS_TABLE};
+        DELETE FROM {STATUS_DELTAS_TABLE};
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO {STATUS_DELTAS_TABLE} ({COLUMNS}, jobs, min_ts, max_ts)
+        SELECT {COLUMNS}, COUNT(*), MIN(created_at), MAX(updated_at)
+        FROM new_jobs
+        GROUP BY {COLUMNS};
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO {STATUS_DELTAS_TABLE} ({COLUMNS}, jobs, min_ts, max_ts)
+        SELECT {COLUMNS}, COALESCE(n.jobs, 0) - COALESCE(o.jobs, 0),
+            n.min_ts, n.max_ts
+        FROM (
+            SELECT {COLUMNS}, COUNT(*) AS jobs, MIN(created_at) AS min_ts,
+                MAX(updated_at) AS max_ts
+            FROM new_jobs
+            GROUP BY {COLUMNS}
+        ) AS n
+        FULL JOIN (
+            SELECT {COLUMNS}, COUNT(*) AS jobs
+            FROM old_jobs
+            GROUP BY {COLUMNS}
+        ) AS o USING ({COLUMNS});
+    ELSE
+        INSERT INTO {STATUS_DELTAS_TABLE} ({COLUMNS}, jobs)
+        SELECT {COLUMNS}, -COUNT(*)
+        FROM old_jobs
+        GROUP BY {COLUMNS};
+    END IF;
+    PERFORM procrastinate_status_counts_compact();
+    RETURN NULL;
+END;
+$$;
+
+-- transition tables require one trigger per event
+DROP TRIGGER IF EXISTS procrastinate_status_counts_insert ON {JOBS};
+CREATE TRIGGER procrastinate_status_counts_insert
+    AFTER INSERT ON {JOBS}
+    REFERENCING NEW TABLE AS new_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_status_counts_update();
+
+DROP TRIGGER IF EXISTS procrastinate_status_counts_update ON {JOBS};
+CREATE TRIGGER procrastinate_status_counts_update
+    AFTER UPDATE ON {JOBS}
+    REFERENCING OLD TABLE AS old_jobs NEW TABLE AS new_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_status_counts_update();
+
+DROP TRIGGER IF EXISTS procrastinate_status_counts_delete ON {JOBS};
+CREATE TRIGGER procrastinate_status_counts_delete
+    AFTER DELETE ON {JOBS}
+    REFERENCING OLD TABLE AS old_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_status_counts_update();
+
+DROP TRIGGER IF EXISTS procrastinate_status_counts_truncate ON {JOBS};
+CREATE TRIGGER procrastinate_status_counts_truncate
+    AFTER TRUNCATE ON {JOBS}
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_status_counts_update();
+"""
+
+# (re-)count the jobs per status group. The exclusive locks wait for running
+# transactions that already recorded their deltas and block new ones until the
+# recount is committed, so no change is lost or counted twice. The deltas are
+# locked first, as the transactions that write the counts hold them as well.
+REBUILD_STATUS_COUNTS = f"""
+BEGIN;
+LOCK TABLE {STATUS_DELTAS_TABLE}, {STATUS_TABLE} IN EXCLUSIVE MODE;
+DELETE FROM {STATUS_DELTAS_TABLE};
+DELETE FROM {STATUS_TABLE};
+INSERT INTO {STATUS_TABLE} ({COLUMNS}, jobs, min_ts, max_ts)
+SELECT {COLUMNS}, COUNT(*), MIN(created_at), MAX(updated_at)
+FROM {JOBS}
+GROUP BY {COLUMNS};
+COMMIT;
+"""
+
+# THROUGHPUT #
+# Jobs (and their entities) that finished running are counted by a statement
+# level trigger into monotonic counters per dataset, batch, queue and task (the
+# entities are counted at defer time, see `GENERATED_FIELDS`). Jobs deleted while
+# running (procrastinate `delete_job`) count as finished. The workers sample the
+# counters at most every `THROUGHPUT_INTERVAL` seconds into a ring buffer of
+# `THROUGHPUT_SLOTS` samples, the throughput over a sliding window is the
+# difference of the current counters to the counters at the window start. Only
+# the groups that changed are sampled, and groups that didn't change for the
+# whole ring buffer are removed. The triggers are only installed with
+# `OPENALEPH_STATUS_THROUGHPUT` (see `Db.configure`).
+THROUGHPUT_INTERVAL = 60
+THROUGHPUT_SLOTS = 60
+THROUGHPUT = f"""
+CREATE TABLE IF NOT EXISTS {FINISHED_TABLE} (
+    dataset text NOT NULL,
+    batch text NOT NULL,
+    queue_name character varying(128) NOT NULL,
+    task_name character varying(128) NOT NULL,
+    jobs bigint NOT NULL DEFAULT 0,
+    entities bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (dataset, batch, queue_name, task_name)
+);
+
+ALTER TABLE {FINISHED_TABLE}
+ADD COLUMN IF NOT EXISTS updated_at timestamp with time zone NOT NULL DEFAULT now();
+
+CREATE TABLE IF NOT EXISTS {SAMPLES_TABLE} (
+    dataset text NOT NULL,
+    batch text NOT NULL,
+    queue_name character varying(128) NOT NULL,
+    task_name character varying(128) NOT NULL,
+    slot integer NOT NULL,
+    sampled_at timestamp with time zone NOT NULL,
+    jobs bigint NOT NULL,
+    entities bigint NOT NULL,
+    PRIMARY KEY (dataset, batch, queue_name, task_name, slot)
+);
+
+CREATE INDEX IF NOT EXISTS idx_{SAMPLES_TABLE}_sampled_at
+ON {SAMPLES_TABLE} (sampled_at);
+
+-- the last run of the sampler (a single row)
+CREATE TABLE IF NOT EXISTS {SAMPLER_TABLE} (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    slot integer NOT NULL,
+    sampled_at timestamp with time zone NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION procrastinate_finished_counts_update()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        INSERT INTO {FINISHED_TABLE} AS f
+            (dataset, batch, queue_name, task_name, jobs, entities)
+        SELECT j.dataset, j.batch, j.queue_name, j.task_name, COUNT(*), SUM(j.entity_count)
+        FROM new_jobs AS j JOIN old_jobs AS o ON o.id = j.id
+        WHERE o.status = 'doing' AND j.status IN ({FINISHED_STATUSES})
+        GROUP BY j.dataset, j.batch, j.queue_name, j.task_name
+        ORDER BY j.dataset, j.batch, j.queue_name, j.task_name
+        ON CONFLICT (dataset, batch, queue_name, task_name) DO UPDATE
+        SET jobs = f.jobs + EXCLUDED.jobs,
+            entities = f.entities + EXCLUDED.entities,
+            updated_at = now();
+    ELSE
+        INSERT INTO {FINISHED_TABLE} AS f
+            (dataset, batch, queue_name, task_name, jobs, entities)
+        SELECT j.dataset, j.batch, j.queue_name, j.task_name, COUNT(*), SUM(j.entity_count)
+        FROM old_jobs AS j
+        WHERE j.status = 'doing'
+        GROUP BY j.dataset, j.batch, j.queue_name, j.task_name
+        ORDER BY j.dataset, j.batch, j.queue_name, j.task_name
+        ON CONFLICT (dataset, batch, queue_name, task_name) DO UPDATE
+        SET jobs = f.jobs + EXCLUDED.jobs,
+            entities = f.entities + EXCLUDED.entities,
+            updated_at = now();
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- take a new sample of the counters of the groups that changed since the last
+-- one if it is older than the interval, and forget the groups that didn't
+-- change within the whole ring buffer
+CREATE OR REPLACE FUNCTION procrastinate_sample_throughput(
+    p_interval double precision, p_slots integer
+)
+    RETURNS boolean
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_slot integer;
+    last_sampled_at timestamp with time zone;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('procrastinate_sample_throughput')) THEN
+        RETURN false;
+    END IF;
+    SELECT slot, sampled_at INTO last_slot, last_sampled_at FROM {SAMPLER_TABLE};
+    IF last_sampled_at > now() - make_interval(secs => p_interval) THEN
+        RETURN false;
+    END IF;
+    last_slot := (COALESCE(last_slot, -1) + 1) % p_slots;
+    DELETE FROM {SAMPLES_TABLE} WHERE slot = last_slot;
+    -- an unchanged group keeps the value of its last sample, the overlap
+    -- covers counts committed after the last sample was taken
+    INSERT INTO {SAMPLES_TABLE}
+        (dataset, batch, queue_name, task_name, slot, sampled_at, jobs, entities)
+    SELECT dataset, batch, queue_name, task_name, last_slot, now(), jobs, entities
+    FROM {FINISHED_TABLE}
+    WHERE last_sampled_at IS NULL
+       OR updated_at >= last_sampled_at - make_interval(secs => p_interval);
+    WITH idle AS (
+        DELETE FROM {FINISHED_TABLE}
+        WHERE updated_at < now() - make_interval(secs => p_interval * p_slots)
+        RETURNING dataset, batch, queue_name, task_name
+    )
+    DELETE FROM {SAMPLES_TABLE} AS s
+    USING idle
+    WHERE s.dataset = idle.dataset
+      AND s.batch = idle.batch
+      AND s.queue_name = idle.queue_name
+      AND s.task_name = idle.task_name;
+    INSERT INTO {SAMPLER_TABLE} (slot, sampled_at) VALUES (last_slot, now())
+    ON CONFLICT (id) DO UPDATE
+    SET slot = EXCLUDED.slot, sampled_at = EXCLUDED.sampled_at;
+    RETURN true;
+END;
+$$;
+"""
+
+THROUGHPUT_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS procrastinate_finished_counts_update ON {JOBS};
+CREATE TRIGGER procrastinate_finished_counts_update
+    AFTER UPDATE ON {JOBS}
+    REFERENCING OLD TABLE AS old_jobs NEW TABLE AS new_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_finished_counts_update();
+
+DROP TRIGGER IF EXISTS procrastinate_finished_counts_delete ON {JOBS};
+CREATE TRIGGER procrastinate_finished_counts_delete
+    AFTER DELETE ON {JOBS}
+    REFERENCING OLD TABLE AS old_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE procrastinate_finished_counts_update();
+"""
+
+DROP_THROUGHPUT_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS procrastinate_finished_counts_update ON {JOBS};
+DROP TRIGGER IF EXISTS procrastinate_finished_counts_delete ON {JOBS};
+DELETE FROM {FINISHED_TABLE};
+DELETE FROM {SAMPLES_TABLE};
+DELETE FROM {SAMPLER_TABLE};
+"""
+
+SAMPLE_THROUGHPUT = """
+SELECT procrastinate_sample_throughput(%(interval)s, %(slots)s) AS sampled
+"""
+
+# jobs and entities finished per minute over the last `window` minutes for the
+# status group of `c` (NULL without a sample older than a minute). As only
+# changed groups are sampled, the counts at the window start are those of the
+# last sample before it, or else of the first sample within the window.
+THROUGHPUT_COLUMNS = f"""
+    t.jobs_per_minute,
+    t.entities_per_minute
+FROM {STATUS_VIEW} c
+LEFT JOIN LATERAL (
+    SELECT
+        (f.jobs - s.jobs) * 60 / EXTRACT(EPOCH FROM now() - s.since)
+            AS jobs_per_minute,
+        (f.entities - s.entities) * 60 / EXTRACT(EPOCH FROM now() - s.since)
+            AS entities_per_minute
+    FROM {FINISHED_TABLE} f
+    JOIN LATERAL (
+        SELECT
+            b.jobs,
+            b.entities,
+            GREATEST(b.sampled_at, now() - make_interval(mins => %(window)s)) AS since
+        FROM (
+            (
+                SELECT jobs, entities, sampled_at
+                FROM {SAMPLES_TABLE} s
+                WHERE s.dataset = f.dataset
+                  AND s.batch = f.batch
+                  AND s.queue_name = f.queue_name
+                  AND s.task_name = f.task_name
+                  AND s.sampled_at < now() - make_interval(mins => %(window)s)
+                ORDER BY s.sampled_at DESC
+                LIMIT 1
+            )
+            UNION ALL
+            (
+                SELECT jobs, entities, sampled_at
+                FROM {SAMPLES_TABLE} s
+                WHERE s.dataset = f.dataset
+                  AND s.batch = f.batch
+                  AND s.queue_name = f.queue_name
+                  AND s.task_name = f.task_name
+                  AND s.sampled_at >= now() - make_interval(mins => %(window)s)
+                ORDER BY s.sampled_at
+                LIMIT 1
+            )
+        ) b
+        ORDER BY b.sampled_at
+        LIMIT 1
+    ) s ON s.since <= now() - interval '1 minute'
+    WHERE f.dataset = c.dataset
+      AND f.batch = c.batch
+      AND f.queue_name = c.queue_name
+      AND f.task_name = c.task_name
+) t ON true"""
+
 # QUERY JOB STATUS #
-# query status aggregation, optional filtered for dataset.
+# query status aggregation, optional filtered (see `compile_filters`).
 # this returns result rows with these values in its order:
-# dataset,batch,queue_name,task_name,status,jobs count,first created,last updated
+# dataset,batch,queue_name,task_name,status,jobs count,first created,last updated,
+# jobs per minute, entities per minute
 STATUS_SUMMARY = f"""
-SELECT {COLUMNS},
-    COUNT(*) AS jobs,
-    MIN(created_at) AS min_ts,
-    MAX(updated_at) AS max_ts
-FROM {JOBS}
-WHERE {F_DATASET}
-GROUP BY {COLUMNS}
+SELECT {COLUMNS}, jobs, min_ts, max_ts, {THROUGHPUT_COLUMNS}
+WHERE jobs > 0 AND {FILTERS}
 ORDER BY {COLUMNS}
 """
 
 # only return status aggregation for active datasets
 STATUS_SUMMARY_ACTIVE = f"""
-SELECT {COLUMNS},
-    COUNT(*) AS jobs,
-    MIN(created_at) AS min_ts,
-    MAX(updated_at) AS max_ts
-FROM {JOBS} j1
-WHERE {F_DATASET}
+SELECT {COLUMNS}, jobs, min_ts, max_ts, {THROUGHPUT_COLUMNS}
+WHERE jobs > 0 AND {FILTERS}
 AND EXISTS (
-    SELECT 1 FROM {JOBS} j2
-    WHERE j2.dataset = j1.dataset
-    AND j2.status IN ('todo', 'doing')
+    SELECT 1 FROM {STATUS_VIEW} c2
+    WHERE c2.dataset = c.dataset
+    AND c2.status IN ('todo', 'doing')
+    AND c2.jobs > 0
 )
-GROUP BY {COLUMNS}
 ORDER BY {COLUMNS}
 """
 
@@ -265,9 +1786,28 @@ ALL_JOBS = f"""
 SELECT id, status, args
 FROM {JOBS}
 WHERE (updated_at BETWEEN %(min_ts)s AND %(max_ts)s)
-AND {F_ALL_ANDS}
+AND {FILTERS}
+"""
+
+# keyset pagination over the primary key, resumable after the last seen id
+JOBS_PAGE = f"""
+SELECT id, status, args
+FROM {JOBS}
+WHERE id > %(after)s
+AND (updated_at BETWEEN %(min_ts)s AND %(max_ts)s)
+AND {FILTERS}
+ORDER BY id
+LIMIT %(limit)s
 """
 
+# stream `ALL_JOBS` via binary COPY for full dumps (parameters are merged
+# client side), rows are typed as `DUMP_JOBS_TYPES`
+DUMP_JOBS = f"""
+COPY (SELECT id, status::text, args FROM ({ALL_JOBS}) AS jobs)
+TO STDOUT (FORMAT BINARY)
+"""
+DUMP_JOBS_TYPES = ["int8", "text", "jsonb"]
+
 # CANCEL OPS #
 # they follow the logic from here:
 # https://github.com/procrastinate-org/procrastinate/blob/main/procrastinate/sql/schema.sql
@@ -275,15 +1815,15 @@ AND {F_ALL_ANDS}
 # This is equivalent to the function `procrastinate_cancel_job_v1` with delete=true,abort=true
 CANCEL_JOBS = f"""
 DELETE FROM {JOBS} WHERE status = 'todo'
-AND {F_DATASET} AND {F_BATCH} AND {F_QUEUE} AND {F_TASK};
+AND {FILTERS};
 
 UPDATE {JOBS} SET abort_requested = true, status = 'cancelled'
 WHERE status = 'todo'
-AND {F_DATASET} AND {F_BATCH} AND {F_QUEUE} AND {F_TASK};
+AND {FILTERS};
 
 UPDATE {JOBS} SET abort_requested = true
 WHERE status = 'doing'
-AND {F_DATASET} AND {F_BATCH} AND {F_QUEUE} AND {F_TASK};
+AND {FILTERS};
 """
 
 # REQUEUE FAILED JOBS #
@@ -292,7 +1832,7 @@ GET_FAILED_JOBS = f"""
 SELECT id, queue_name, priority, lock
 FROM {JOBS}
 WHERE status = 'failed'
-AND {F_DATASET} AND {F_BATCH} AND {F_QUEUE} AND {F_TASK}
+AND {FILTERS}
 """
 
 # DETECT ORPHANED JOBS #
@@ -308,5 +1848,50 @@ WHERE status = 'doing'
   AND NOT EXISTS (
     SELECT 1 FROM procrastinate_workers w WHERE w.id = {JOBS}.worker_id
   )
-  AND {F_DATASET} AND {F_BATCH} AND {F_QUEUE} AND {F_TASK}
+  AND {FILTERS}
+"""
+
+# BULK REQUEUE #
+# the next chunk of job ids of `GET_FAILED_JOBS` / `GET_ORPHANED_JOBS` after the
+# last seen id (keyset pagination, so that each chunk is a short transaction)
+NEXT_JOB_IDS = """
+AND id > %(after)s
+ORDER BY id
+LIMIT %(limit)s
+"""
+REQUEUE_FAILED_IDS = f"{GET_FAILED_JOBS}{NEXT_JOB_IDS}"
+REQUEUE_ORPHANED_IDS = f"{GET_ORPHANED_JOBS}{NEXT_JOB_IDS}"
+
+# Retry the given jobs in one statement. This follows the logic of
+# `procrastinate_retry_job_v2` (keeping priority, queue and lock): aborted
+# running jobs fail, all others are set to 'todo' with one more attempt. The
+# row triggers for the events are the same as for the single job retry. Jobs
+# whose queueing lock is already taken by a 'todo' job (or by another job of the
+# chunk) are skipped instead of failing the whole chunk.
+REQUEUE_JOBS = f"""
+WITH candidates AS (
+    SELECT id, status, abort_requested, queueing_lock
+    FROM {JOBS}
+    WHERE id = ANY(%(ids)s) AND status IN ('doing', 'failed')
+    ORDER BY id
+    FOR UPDATE
+), retried AS (
+    SELECT DISTINCT ON (
+        queueing_lock, CASE WHEN queueing_lock IS NULL THEN id END
+    ) id, status = 'doing' AND abort_requested AS aborted
+    FROM candidates c
+    WHERE c.queueing_lock IS NULL OR NOT EXISTS (
+        SELECT 1 FROM {JOBS} t
+        WHERE t.queueing_lock = c.queueing_lock AND t.status = 'todo'
+    )
+    ORDER BY queueing_lock, CASE WHEN queueing_lock IS NULL THEN id END, id
+)
+UPDATE {JOBS} j
+SET status = CASE WHEN r.aborted
+        THEN 'failed' ELSE 'todo' END::procrastinate_job_status,
+    attempts = CASE WHEN r.aborted THEN j.attempts ELSE j.attempts + 1 END,
+    scheduled_at = CASE WHEN r.aborted THEN j.scheduled_at ELSE now() END
+FROM retried r
+WHERE j.id = r.id
+RETURNING j.id, j.status::text
 """
@@ -1,5 +1,17 @@
-from collections import defaultdict
-from typing import Generator
+import threading
+import time
+from datetime import UTC, datetime
+from functools import cache
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Generator, Iterable, TypeAlias
+from uuid import uuid4
+
+from anystore.logging import get_logger
+from anystore.util import Took
+from pydantic import BaseModel
+from redis import Redis
+from redis.client import Pipeline
 
 from openaleph_procrastinate.manage.db import get_db
 from openaleph_procrastinate.model import (
@@ -8,47 +20,54 @@ from openaleph_procrastinate.model import (
     DatasetStatus,
     QueueStatus,
     TaskStatus,
+    Throughput,
 )
+from openaleph_procrastinate.settings import OpenAlephSettings
+
+Row: TypeAlias = tuple[Any, ...]
 
 DEFAULT_BACH = "default"
+SNAPSHOT_KEY = "openaleph-procrastinate/status/snapshot"
+REFRESH_LOCK_KEY = f"{SNAPSHOT_KEY}.lock"
+# max seconds to wait for another process refreshing the snapshot
+REFRESH_TIMEOUT = 30
 
+log = get_logger(__name__)
 
-def _gather_status(
-    dataset: str | None = None, active_only: bool | None = True
-) -> Generator[DatasetStatus, None, None]:
-    db = get_db()
-    tree = lambda: defaultdict(tree)  # noqa: E731
-    data = tree()
-    for (
-        dataset_name,
-        batch,
-        queue,
-        task,
-        status,
-        jobs,
-        min_ts,
-        max_ts,
-    ) in db.iterate_status(dataset, active_only=active_only):
-        data[dataset_name][batch][queue][task]["counts"][status] = jobs
-        data[dataset_name][batch][queue][task]["min_ts"][status] = min_ts
-        data[dataset_name][batch][queue][task]["max_ts"][status] = max_ts
-
-    for dataset_name, batches in data.items():
-        dataset_status = DatasetStatus(name=dataset_name or SYSTEM_DATASET)
-        for batch, queues in batches.items():
+
+def _build_status(rows: Iterable[Row]) -> Generator[DatasetStatus, None, None]:
+    """
+    Build the status tree in a single pass over the status summary rows, which
+    are ordered by dataset, batch, queue, task. Each dataset is yielded as soon
+    as its rows are consumed, so only one dataset is held in memory at a time.
+    """
+    for dataset, dataset_rows in groupby(rows, key=itemgetter(0)):
+        dataset_status = DatasetStatus(name=dataset or SYSTEM_DATASET)
+        for batch, batch_rows in groupby(dataset_rows, key=itemgetter(1)):
             batch_status = BatchStatus(name=batch or DEFAULT_BACH)
-            for queue, tasks in queues.items():
+            for queue, queue_rows in groupby(batch_rows, key=itemgetter(2)):
                 queue_status = QueueStatus(name=queue)
-                for task, stats in tasks.items():
-                    min_ts_ = [v for v in stats["min_ts"].values() if v is not None]
-                    max_ts_ = [v for v in stats["max_ts"].values() if v is not None]
-                    min_ts = min(min_ts_) if min_ts_ else None
-                    max_ts = max(max_ts_) if max_ts_ else None
+                for task, task_rows in groupby(queue_rows, key=itemgetter(3)):
+                    counts: dict[str, int] = {}
+                    min_ts = max_ts = throughput = None
+                    for row in task_rows:
+                        status, jobs, row_min_ts, row_max_ts, *rates = row[4:]
+                        counts[status] = jobs
+                        # the same throughput for all status rows of a task
+                        if throughput is None and rates[0] is not None:
+                            throughput = Throughput(jobs=rates[0], entities=rates[1])
+                        if row_min_ts is not None:
+                            if min_ts is None or row_min_ts < min_ts:
+                                min_ts = row_min_ts
+                        if row_max_ts is not None:
+                            if max_ts is None or row_max_ts > max_ts:
+                                max_ts = row_max_ts
                     task_status = TaskStatus(
                         name=task,
-                        **stats["counts"],
+                        **counts,
                         min_ts=min_ts,
                         max_ts=max_ts,
+                        throughput=throughput,
                     )
                     queue_status.add_child_stats(task_status)
                     queue_status.tasks.append(task_status)
@@ -59,11 +78,146 @@ def _gather_status(
         yield dataset_status
 
 
+def _gather_status(
+    dataset: str | None = None, active_only: bool | None = True
+) -> Generator[DatasetStatus, None, None]:
+    db = get_db()
+    yield from _build_status(db.iterate_status(dataset, active_only=active_only))
+
+
+class StatusSnapshot(BaseModel):
+    created_at: datetime
+    datasets: list[DatasetStatus] = []
+
+
+class StatusCache:
+    """
+    Cache the status of all datasets for `ttl` seconds. Concurrent misses
+    within a process wait for one refresh. With a redis `uri`, the snapshot is
+    shared across processes and only one process refreshes it at a time while
+    the others wait for the result.
+    """
+
+    def __init__(self, ttl: int, uri: str | None = None) -> None:
+        self.ttl = ttl
+        self._snapshot: StatusSnapshot | None = None
+        self._datasets: dict[str, DatasetStatus] = {}
+        self._lock = threading.Lock()
+        self._redis: Redis | None = Redis.from_url(uri) if uri else None
+
+    def get(self) -> dict[str, DatasetStatus]:
+        """Get (copies of) the cached status of all datasets by name"""
+        if not self._is_fresh(self._snapshot):
+            with self._lock:
+                if not self._is_fresh(self._snapshot):
+                    snapshot = self._load()
+                    if snapshot is None or not self._is_fresh(snapshot):
+                        snapshot = self._refresh()
+                    self._set(snapshot)
+        # callers must not be able to alter the cached status objects
+        return {name: d.model_copy(deep=True) for name, d in self._datasets.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._snapshot = None
+            self._datasets = {}
+            if self._redis is not None:
+                self._redis.delete(SNAPSHOT_KEY)
+
+    def _is_fresh(self, snapshot: StatusSnapshot | None) -> bool:
+        if snapshot is None:
+            return False
+        age = datetime.now(UTC) - snapshot.created_at
+        return age.total_seconds() < self.ttl
+
+    def _set(self, snapshot: StatusSnapshot) -> None:
+        self._datasets = {d.name: d for d in snapshot.datasets}
+        self._snapshot = snapshot
+
+    def _load(self) -> StatusSnapshot | None:
+        if self._redis is None:
+            return None
+        data = self._redis.get(SNAPSHOT_KEY)
+        if data is None:
+            return None
+        return StatusSnapshot.model_validate_json(data)
+
+    def _refresh(self) -> StatusSnapshot:
+        if self._redis is None:
+            return self._compute()
+        token = uuid4().hex
+        if self._redis.set(REFRESH_LOCK_KEY, token, nx=True, ex=REFRESH_TIMEOUT):
+            try:
+                return self._compute()
+            finally:
+                self._release(token)
+        # another process is refreshing, wait for its snapshot
+        deadline = time.monotonic() + REFRESH_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            snapshot = self._load()
+            if snapshot is not None and self._is_fresh(snapshot):
+                return snapshot
+        log.warning("Timed out waiting for status refresh.")
+        return self._compute()
+
+    def _release(self, token: str) -> None:
+        """Delete the refresh lock only if it is still ours (it might have
+        expired and been taken by another process meanwhile)"""
+        assert self._redis is not None
+
+        def release(pipe: Pipeline) -> None:
+            if pipe.get(REFRESH_LOCK_KEY) == token.encode():
+                pipe.multi()
+                pipe.delete(REFRESH_LOCK_KEY)
+
+        # retried if the lock changes in between
+        self._redis.transaction(release, REFRESH_LOCK_KEY)
+
+    def _compute(self) -> StatusSnapshot:
+        with Took() as t:
+            snapshot = StatusSnapshot(
+                created_at=datetime.now(UTC),
+                datasets=list(_gather_status(active_only=False)),
+            )
+            if self._redis is not None:
+                self._redis.set(
+                    SNAPSHOT_KEY, snapshot.model_dump_json(), ex=max(self.ttl, 1)
+                )
+            log.info(
+                "Refreshed status snapshot.",
+                datasets=len(snapshot.datasets),
+                took=t.took,
+            )
+        return snapshot
+
+
+@cache
+def get_status_cache() -> StatusCache | None:
+    """Get the status cache if `OPENALEPH_STATUS_CACHE_TTL` is set"""
+    settings = OpenAlephSettings()
+    if settings.status_cache_ttl:
+        return StatusCache(settings.status_cache_ttl, settings.redis_url)
+    return None
+
+
 def get_status(active_only: bool | None = True) -> Generator[DatasetStatus, None, None]:
-    yield from _gather_status(active_only=active_only)
+    status_cache = get_status_cache()
+    if status_cache is None:
+        yield from _gather_status(active_only=active_only)
+        return
+    for status in status_cache.get().values():
+        if not active_only or status.is_active():
+            yield status
 
 
 def get_dataset_status(dataset: str, active_only: bool | None = True) -> DatasetStatus:
-    for status in _gather_status(dataset, active_only):
-        return status
-    return DatasetStatus(name=dataset)
+    status_cache = get_status_cache()
+    if status_cache is None:
+        for status in _gather_status(dataset, active_only):
+            return status
+        return DatasetStatus(name=dataset)
+    cached = status_cache.get().get(dataset)
+    if cached is None or (active_only and not cached.is_active()):
+        return DatasetStatus(name=dataset)
+    return cached
@@ -5,24 +5,25 @@ from typing import Any, ContextManager, Generator, Iterable, Literal, Self, Type
 
 from anystore.logging import get_logger
 from anystore.store.virtual import VirtualIO
-from anystore.util import clean_dict
 from banal import ensure_dict
 from followthemoney import model
 from followthemoney.proxy import EntityProxy
-from pydantic import BaseModel, ConfigDict, computed_field
+from procrastinate.jobs import Job as ProcrastinateJob
+from pydantic import BaseModel, ConfigDict, PrivateAttr, computed_field
 from structlog.stdlib import BoundLogger
 
 from openaleph_procrastinate import helpers
-from openaleph_procrastinate.app import App, run_sync_worker
+from openaleph_procrastinate.app import App, run_sync_worker, run_worker_async
 from openaleph_procrastinate.repository import EntityStore
 from openaleph_procrastinate.settings import (
     MAX_PRIORITY,
     MIN_PRIORITY,
     OpenAlephSettings,
 )
-from openaleph_procrastinate.util import make_file_entity
+from openaleph_procrastinate.util import batched, json_dumps, make_file_entity_data
 
 settings = OpenAlephSettings()
+log = get_logger(__name__)
 
 
 def get_priority() -> int:
@@ -88,19 +89,132 @@ class Job(JobModel):
     def log(self) -> BoundLogger:
         return get_logger(name="openaleph.job", queue=self.queue, task=self.task)
 
+    def to_args(self) -> dict[str, Any]:
+        """Get the json compatible task arguments for this job. Serialization
+        (via `orjson`) is done by the procrastinate connector, see
+        [`get_connector`][openaleph_procrastinate.app.get_connector]"""
+        return self.model_dump(mode="json", exclude_none=True)
+
     def defer(self: Self, app: App, priority: int | None = None) -> None:
         """Defer this job"""
         self.log.debug("Deferring ...", payload=self.payload)
-        data = clean_dict(self.model_dump(mode="json"))
+        data = self.to_args()
         app.configure_task(
             name=self.task, queue=self.queue, priority=priority or get_priority()
         ).defer(**data)
-        if settings.debug:
-            # option to change synchronousness during test runtime
-            _settings = OpenAlephSettings()
-            if _settings.procrastinate_sync:
-                # run worker synchronously (for testing)
-                run_sync_worker(app)
+        _maybe_run_sync_worker(app)
+
+    def make_procrastinate_job(
+        self: Self, app: App, priority: int | None = None
+    ) -> ProcrastinateJob:
+        """Get the procrastinate job instance for this job (without deferring
+        it)"""
+        data = self.to_args()
+        return app.configure_task(
+            name=self.task, queue=self.queue, priority=priority or get_priority()
+        ).make_new_job(**data)
+
+    async def defer_async(self: Self, app: App, priority: int | None = None) -> None:
+        """Defer this job asynchronously. The app needs to be opened via
+        `app.open_async()` which uses the shared async connection pool."""
+        self.log.debug("Deferring ...", payload=self.payload)
+        data = self.to_args()
+        await app.configure_task(
+            name=self.task, queue=self.queue, priority=priority or get_priority()
+        ).defer_async(**data)
+        await _maybe_run_worker_async(app)
+
+    @staticmethod
+    def defer_many(
+        app: App,
+        jobs: Iterable["Job | tuple[Job, int | None]"],
+        chunk_size: int | None = None,
+    ) -> int:
+        """
+        Defer many jobs at once. Instead of one query (and round trip) per job,
+        the jobs are inserted in chunks with one query per chunk. Jobs can be
+        of different queues and tasks and keep their own priority.
+
+        Example:
+            ```python
+            jobs = (
+                DatasetJob.from_entities(dataset, queue, task, [proxy])
+                for proxy in proxies
+            )
+            Job.defer_many(app, jobs)
+
+            # with explicit priorities per job
+            Job.defer_many(app, ((job, 80) for job in jobs))
+            ```
+
+        Args:
+            app: The procrastinate app instance
+            jobs: The jobs to defer, optionally as `(job, priority)` tuples. A
+                random priority is used if none is given
+            chunk_size: Number of jobs per insert query (default:
+                `settings.defer_chunk_size`)
+
+        Returns:
+            The number of deferred jobs
+        """
+        deferred = 0
+        for chunk in _iter_procrastinate_jobs(app, jobs, chunk_size):
+            app.job_manager.batch_defer_jobs(chunk)
+            deferred += len(chunk)
+            log.debug("Deferred jobs chunk.", jobs=len(chunk))
+        if deferred:
+            _maybe_run_sync_worker(app)
+        return deferred
+
+    @staticmethod
+    async def defer_many_async(
+        app: App,
+        jobs: Iterable["Job | tuple[Job, int | None]"],
+        chunk_size: int | None = None,
+    ) -> int:
+        """
+        Async version of [`defer_many`][openaleph_procrastinate.model.Job.defer_many].
+        The app needs to be opened via `app.open_async()`.
+        """
+        deferred = 0
+        for chunk in _iter_procrastinate_jobs(app, jobs, chunk_size):
+            await app.job_manager.batch_defer_jobs_async(chunk)
+            deferred += len(chunk)
+            log.debug("Deferred jobs chunk.", jobs=len(chunk))
+        if deferred:
+            await _maybe_run_worker_async(app)
+        return deferred
+
+
+def _iter_procrastinate_jobs(
+    app: App,
+    jobs: Iterable["Job | tuple[Job, int | None]"],
+    chunk_size: int | None = None,
+) -> Generator[list[ProcrastinateJob], None, None]:
+    chunk_size = chunk_size or settings.defer_chunk_size
+    for chunk in batched(jobs, chunk_size):
+        procrastinate_jobs: list[ProcrastinateJob] = []
+        for item in chunk:
+            job, priority = item if isinstance(item, tuple) else (item, None)
+            procrastinate_jobs.append(job.make_procrastinate_job(app, priority))
+        yield procrastinate_jobs
+
+
+def _maybe_run_sync_worker(app: App) -> None:
+    if settings.debug:
+        # option to change synchronousness during test runtime
+        _settings = OpenAlephSettings()
+        if _settings.procrastinate_sync:
+            # run worker synchronously (for testing)
+            run_sync_worker(app)
+
+
+async def _maybe_run_worker_async(app: App) -> None:
+    if settings.debug:
+        _settings = OpenAlephSettings()
+        if _settings.procrastinate_sync:
+            # run worker until the queue is empty (for testing)
+            await run_worker_async(app)
 
 
 class DatasetJob(Job):
@@ -116,6 +230,10 @@ class DatasetJob(Job):
     dataset: str
     batch: str | None = None
 
+    # parsed entities cache, see `entities`
+    _entities: list[EntityProxy] | None = PrivateAttr(default=None)
+    _entities_data: list[dict[str, Any]] | None = PrivateAttr(default=None)
+
     @property
     def log(self) -> BoundLogger:
         return get_logger(
@@ -132,13 +250,42 @@ class DatasetJob(Job):
         """Get the writer for the dataset of the current job"""
         return helpers.entity_writer(self.dataset, origin)
 
+    @property
+    def entity_ids(self) -> list[str]:
+        """Get the entity ids from the payload (without parsing the entities)"""
+        assert "entities" in self.payload, "No entities in payload"
+        return [e["id"] for e in self.payload["entities"]]
+
+    @property
+    def content_hashes(self) -> list[str]:
+        """Get the `contentHash` values of all entities from the payload
+        (without parsing the entities)"""
+        assert "entities" in self.payload, "No entities in payload"
+        return [
+            content_hash
+            for e in self.payload["entities"]
+            for content_hash in ensure_dict(e.get("properties")).get("contentHash", [])
+        ]
+
+    @property
+    def entities(self) -> list[EntityProxy]:
+        """
+        Get the parsed entities from the payload. They are parsed only once per
+        job (unless the `entities` in the payload are replaced), so every
+        caller gets the same `EntityProxy` instances.
+        """
+        assert "entities" in self.payload, "No entities in payload"
+        data = self.payload["entities"]
+        if self._entities is None or self._entities_data is not data:
+            self._entities = [model.get_proxy(e) for e in data]
+            self._entities_data = data
+        return self._entities
+
     def get_entities(self) -> Generator[EntityProxy, None, None]:
         """
         Get the entities from the payload
         """
-        assert "entities" in self.payload, "No entities in payload"
-        for data in self.payload["entities"]:
-            yield model.get_proxy(data)
+        yield from self.entities
 
     def load_entities(self: Self) -> Generator[EntityProxy, None, None]:
         """Load the entities from the store to refresh it to the latest data"""
@@ -148,8 +295,7 @@ class DatasetJob(Job):
         if not settings.procrastinate_dehydrate_entities:
             yield from self.get_entities()
         else:
-            entity_ids = [e["id"] for e in self.payload["entities"]]
-            yield from helpers.load_entities(self.dataset, entity_ids)
+            yield from helpers.load_entities(self.dataset, self.entity_ids)
 
     # Helpers for file jobs that access the servicelayer archive
 
@@ -204,21 +350,116 @@ class DatasetJob(Job):
                 Ignored when `procrastinate_dehydrate_entities` is disabled
             context: Job context
         """
-        dehydrate = dehydrate and settings.procrastinate_dehydrate_entities
-        if dehydrate:
-            entities_ = (make_file_entity(e, quiet=True) for e in entities)
-            entities = (e for e in entities_ if e is not None)
         return cls(
             dataset=dataset,
             queue=queue,
             task=task,
             batch=context.pop("batch", None),
             payload={
-                "entities": [e.to_dict() for e in entities],
+                "entities": list(make_entity_payloads(entities, dehydrate)),
                 "context": ensure_dict(context),
             },
         )
 
+    @classmethod
+    def iter_from_entities(
+        cls,
+        dataset: str,
+        queue: str,
+        task: str,
+        entities: Iterable[EntityProxy],
+        max_entities: int | None = None,
+        max_bytes: int | None = None,
+        dehydrate: bool = settings.procrastinate_dehydrate_entities,
+        **context: Any,
+    ) -> Generator[Self, None, None]:
+        """
+        Make jobs to process entities for a dataset, bounded by the number of
+        entities and the serialized size of their payload per job. The
+        entities are consumed lazily, so this works for arbitrary large
+        iterables. No job is created if there are no entities.
+
+        Example:
+            ```python
+            jobs = DatasetJob.iter_from_entities(
+                dataset="my_dataset",
+                queue="index",
+                task="aleph.tasks.index_proxy",
+                entities=proxies,
+                max_entities=1_000,
+                max_bytes=10_000_000,
+            )
+            Job.defer_many(app, jobs)
+            ```
+
+        Args:
+            dataset: Name of the dataset
+            queue: Name of the queue
+            task: Python module path of the task
+            entities: Entities
+            max_entities: Max number of entities per job
+            max_bytes: Max size of the serialized entities per job (a single
+                entity that is larger still gets its own job)
+            dehydrate: Reduce entity payload to only a reference (see
+                `from_entities`)
+            context: Job context
+
+        Yields:
+            The jobs with the same `context` and `batch`
+        """
+        batch = context.pop("batch", None)
+        context = ensure_dict(context)
+
+        payloads = make_entity_payloads(entities, dehydrate)
+        for chunk in chunk_payloads(payloads, max_entities, max_bytes):
+            yield cls(
+                dataset=dataset,
+                queue=queue,
+                task=task,
+                batch=batch,
+                payload={"entities": chunk, "context": dict(context)},
+            )
+
+
+def chunk_payloads(
+    payloads: Iterable[dict[str, Any]],
+    max_entities: int | None = None,
+    max_bytes: int | None = None,
+) -> Generator[list[dict[str, Any]], None, None]:
+    """Chunk entity payloads by number and (approximate) serialized size"""
+    chunk: list[dict[str, Any]] = []
+    size = 0
+    for data in payloads:
+        data_size = get_payload_size(data) if max_bytes else 0
+        if chunk and (
+            (max_entities and len(chunk) >= max_entities)
+            or (max_bytes and size + data_size > max_bytes)
+        ):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(data)
+        size += data_size
+    if chunk:
+        yield chunk
+
+
+def get_payload_size(data: dict[str, Any]) -> int:
+    """Get the (approximate) size in bytes of serialized payload data"""
+    return len(json_dumps(data))
+
+
+def make_entity_payloads(
+    entities: Iterable[EntityProxy],
+    dehydrate: bool = settings.procrastinate_dehydrate_entities,
+) -> Generator[dict[str, Any], None, None]:
+    """Serialize entities for a job payload, optionally dehydrated"""
+    dehydrate = dehydrate and settings.procrastinate_dehydrate_entities
+    for entity in entities:
+        if dehydrate:
+            yield make_file_entity_data(entity)
+        else:
+            yield entity.to_dict()
+
 
 class EntityJob(JobModel):
     dataset: str
@@ -228,6 +469,18 @@ class EntityJob(JobModel):
 AnyJob: TypeAlias = Job | DatasetJob
 
 
+class Throughput(BaseModel):
+    """Finished jobs and entities per minute over a recent time window"""
+
+    jobs: float = 0
+    entities: float = 0
+
+    def __add__(self, other: "Throughput") -> "Throughput":
+        return Throughput(
+            jobs=self.jobs + other.jobs, entities=self.entities + other.entities
+        )
+
+
 class StatusCounts(BaseModel):
     todo: int = 0
     doing: int = 0
@@ -240,14 +493,28 @@ class StatusCounts(BaseModel):
     min_ts: datetime | None = None
     max_ts: datetime | None = None
 
+    throughput: Throughput | None = None
+
     @computed_field
     @property
     def remaining_time(self) -> timedelta | None:
         if self.finished and self.min_ts and self.max_ts:
             took = self.max_ts - self.min_ts
-            remaining = (took.seconds / self.finished) * self.todo
+            remaining = (took.total_seconds() / self.finished) * self.todo
             return timedelta(seconds=remaining)
 
+    @computed_field
+    @property
+    def eta(self) -> timedelta | None:
+        """Estimated time until the active jobs are finished at the recent
+        throughput (None if nothing finished recently), falls back to
+        `remaining_time` without throughput samples"""
+        if self.throughput is None:
+            return self.remaining_time
+        if self.throughput.jobs > 0:
+            return timedelta(minutes=self.active / self.throughput.jobs)
+        return None
+
     @computed_field
     @property
     def took(self) -> timedelta | None:
@@ -301,6 +568,11 @@ class StatusCounts(BaseModel):
         if child.max_ts:
             if not self.max_ts or self.max_ts < child.max_ts:
                 self.max_ts = child.max_ts
+        if child.throughput is not None:
+            if self.throughput is None:
+                self.throughput = child.throughput
+            else:
+                self.throughput = self.throughput + child.throughput
 
 
 class TaskStatus(StatusCounts):
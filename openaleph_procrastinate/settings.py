@@ -37,6 +37,23 @@ class ServiceSettings(BaseSettings):
     """Minimum priority"""
     max_priority: int = MAX_PRIORITY
     """Maximum priority"""
+    max_entities: int | None = None
+    """Split entity jobs into chunks of this number of entities"""
+    max_bytes: int | None = None
+    """Split entity jobs into chunks of this serialized payload size"""
+    max_rate: float | None = None
+    """Max number of jobs per second for this task across all workers, enforced
+    when jobs are fetched (needs `openaleph-procrastinate init-db`)"""
+    rate_per_entity: bool = False
+    """Count `max_rate` in entities of the job payloads instead of jobs"""
+    rate_burst: float | None = None
+    """Number of jobs (or entities) that can be fetched at once after idling
+    (default: `max_rate`, at least 1)"""
+
+    @property
+    def chunked(self) -> bool:
+        """If entity jobs for this service are split into chunks"""
+        return bool(self.max_entities or self.max_bytes)
 
     @property
     def retries(self) -> int | bool:
@@ -44,6 +61,11 @@ class ServiceSettings(BaseSettings):
             return True
         return max(0, self.max_retries)
 
+    @property
+    def burst(self) -> float:
+        """Size of the token bucket for `max_rate`"""
+        return self.rate_burst or max(1.0, self.max_rate or 0)
+
     def get_priority(self, priority: int | None = None) -> int:
         """Calculate a random priority between `min_priority` and
         `max_priority`"""
@@ -80,6 +102,8 @@ class DeferSettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="openaleph_",
         env_nested_delimiter="_",
+        # don't split service setting names, e.g. `OPENALEPH_INDEX_MAX_RETRIES`
+        env_nested_max_split=1,
         env_file=".env",
         nested_model_default_partial_update=True,
         extra="ignore",  # other envs in .env file
@@ -192,6 +216,11 @@ class DeferSettings(BaseSettings):
     )
     """openaleph cancel dataset processing"""
 
+    @property
+    def services(self) -> dict[str, ServiceSettings]:
+        """All stage settings by their name"""
+        return {name: getattr(self, name) for name in type(self).model_fields}
+
 
 class OpenAlephSettings(BaseSettings):
     """
@@ -230,6 +259,26 @@ class OpenAlephSettings(BaseSettings):
     db_pool_size: int = Field(default=5, validation_alias="openaleph_db_pool_size")
     """Max psql pool size per thread"""
 
+    db_pool_timeout: float = Field(
+        default=30, gt=0, validation_alias="openaleph_db_pool_timeout"
+    )
+    """Max seconds to wait for a connection from the pool"""
+
+    db_pool_max_idle: float = Field(
+        default=300, gt=0, validation_alias="openaleph_db_pool_max_idle"
+    )
+    """Seconds after which idle pool connections are closed"""
+
+    db_pool_max_lifetime: float = Field(
+        default=3600, gt=0, validation_alias="openaleph_db_pool_max_lifetime"
+    )
+    """Seconds after which pool connections are replaced"""
+
+    db_itersize: int = Field(
+        default=10_000, ge=1, validation_alias="openaleph_db_itersize"
+    )
+    """Number of rows fetched per round trip when iterating query results"""
+
     procrastinate_db_uri: str = Field(
         default=DEFAULT_DB_URI,
         validation_alias=AliasChoices(
@@ -247,11 +296,52 @@ class OpenAlephSettings(BaseSettings):
     redis_url: str | None = Field(default=None, validation_alias="redis_url")
     """Redis instance uri"""
 
+    status_cache_ttl: int = Field(
+        default=0, ge=0, validation_alias="openaleph_status_cache_ttl"
+    )
+    """Cache the job status summary for this number of seconds (0 = disabled),
+    shared across processes via `redis_url` if set"""
+
+    status_throughput: bool = Field(
+        default=False, validation_alias="openaleph_status_throughput"
+    )
+    """Count the finished jobs (via triggers) and sample them in the workers for
+    the status throughput and eta"""
+
     procrastinate_dehydrate_entities: bool = Field(
         default=True, validation_alias="openaleph_procrastinate_dehydrate_entities"
     )
     """Dehydrate entity in job payload, jobs need to re-fetch entity from store"""
 
+    defer_chunk_size: int = Field(
+        default=1_000, validation_alias="openaleph_defer_chunk_size"
+    )
+    """Number of jobs inserted per query when deferring in bulk"""
+
+    fetch_batch_size: int = Field(
+        default=1, ge=1, validation_alias="openaleph_fetch_batch_size"
+    )
+    """Number of jobs a worker claims per fetch query. Jobs are buffered in the
+    worker until a concurrency slot is free (1 = fetch one job at a time)"""
+
+    fetch_fair_share: bool = Field(
+        default=False, validation_alias="openaleph_fetch_fair_share"
+    )
+    """Fetch jobs round-robin over the datasets of a queue instead of strictly
+    by priority, so that one big dataset doesn't starve the others"""
+
+    fetch_lock_heads: bool = Field(
+        default=False, validation_alias="openaleph_fetch_lock_heads"
+    )
+    """Track the next job per procrastinate `lock` in a table (maintained by
+    triggers), so that fetching locked jobs doesn't scan all of them"""
+
+    priority_aging: dict[str, float] = Field(
+        default={}, validation_alias="openaleph_priority_aging"
+    )
+    """Priority points per minute that waiting jobs gain, per queue (as json,
+    e.g. `{"openaleph": 0.5}`). Bounds the wait time of low priority jobs."""
+
     lakehouse: bool = Field(default=False, validation_alias="openaleph_lakehouse")
     """Activate lakehouse storage backend (experimental)"""
 
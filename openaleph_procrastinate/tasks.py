@@ -1,6 +1,6 @@
 import functools
 import random
-from typing import Any, Callable, cast
+from typing import Any, Callable
 
 from anystore.logging import get_logger
 from ftm_lakehouse import get_entities as get_lakehouse_entities
@@ -58,7 +58,7 @@ def task(app: App, **kwargs):
             entity_ids = []
             if tracer_uri and isinstance(job, DatasetJob):
                 tracer = get_job_tracer(job, tracer_uri)
-                entity_ids = list([cast(str, e.id) for e in job.get_entities()])
+                entity_ids = job.entity_ids
                 handle_trace(entity_ids, "doing", tracer)
             try:
                 func(*job_args, job)
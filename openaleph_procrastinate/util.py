@@ -1,12 +1,14 @@
-from typing import Type
+from itertools import islice
+from typing import Any, Generator, Iterable, Type, TypeVar
 
+import orjson
 from anystore.logging import get_logger
 from followthemoney import E, ValueEntity
 from followthemoney.namespace import Namespace
 from followthemoney.proxy import EntityProxy
 from followthemoney.util import make_entity_id
 from ftmq.types import EntityProxies
-from ftmq.util import make_entity
+from ftmq.util import DEFAULT_DATASET, make_entity
 
 from openaleph_procrastinate.repository import get_entity_store
 
@@ -15,6 +17,36 @@ log = get_logger(__name__)
 # FTMQ BulkLoader default size = 1000
 QUERY_LIMIT = 1000
 
+# properties kept for dehydrated (file) entities
+FILE_PROPS = ("contentHash", "fileName", "parent", "ancestors")
+
+T = TypeVar("T")
+
+
+def batched(items: Iterable[T], n: int) -> Generator[list[T], None, None]:
+    """
+    Consume an iterable in lists of (at most) `n` items (like
+    `itertools.batched` that is only available from python 3.12 on)
+    """
+    if n < 1:
+        raise ValueError("Batch size must be at least 1")
+    it = iter(items)
+    while batch := list(islice(it, n)):
+        yield batch
+
+
+def json_dumps(data: Any) -> bytes:
+    """
+    Serialize data to compact json bytes via `orjson`. Used for the
+    procrastinate connectors and the payload size.
+    """
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def json_loads(data: str | bytes) -> Any:
+    """Deserialize json data via `orjson`"""
+    return orjson.loads(data)
+
 
 def make_stub_entity(e: E, entity_type: Type[E] | None = ValueEntity) -> E:
     """
@@ -36,13 +68,33 @@ def make_file_entity(
     q = bool(quiet)
     stub = make_stub_entity(e, entity_type)
     if stub is not None:
-        stub.add("contentHash", e.get("contentHash", quiet=q), quiet=q)
-        stub.add("fileName", e.get("fileName", quiet=q), quiet=q)
-        stub.add("parent", e.get("parent", quiet=q), quiet=q)
-        stub.add("ancestors", e.get("ancestors", quiet=q), quiet=q)
+        for prop in FILE_PROPS:
+            stub.add(prop, e.get(prop, quiet=q), quiet=q)
         return stub
 
 
+def make_file_entity_data(e: EntityProxy) -> dict[str, Any]:
+    """
+    Reduce an entity to the serialized data of its file entity (see
+    `make_file_entity`) without building and validating an intermediate entity.
+    Properties not available for the entity schema are skipped.
+    """
+    if not e.id:
+        raise RuntimeError("Entity has no ID!")
+    properties: dict[str, list[str]] = {}
+    for prop in FILE_PROPS:
+        if values := e.get(prop, quiet=True):
+            properties[prop] = list(values)
+    return {
+        "id": e.id,
+        "schema": e.schema.name,
+        "properties": properties,
+        "referents": [],
+        "datasets": [DEFAULT_DATASET],
+        "caption": e.caption,
+    }
+
+
 def get_page_entity_fragments(
     entity: EntityProxy, ftm_dataset: str, ns: Namespace, origin: str = "ingest"
 ) -> EntityProxies:
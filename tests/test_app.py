@@ -0,0 +1,185 @@
+import asyncio
+
+import pytest
+from procrastinate import jobs
+
+from openaleph_procrastinate.app import App, PrefetchJobManager, in_memory_connector
+from openaleph_procrastinate.manage import sql
+
+
+def make_job(id: int, priority: int = 0) -> jobs.Job:
+    return jobs.Job(
+        id=id,
+        queue="test",
+        lock=None,
+        queueing_lock=None,
+        task_name="tests.tasks.dummy_task",
+        priority=priority,
+        task_kwargs={},
+    )
+
+
+def test_app_prefetch_job_manager(monkeypatch):
+    # the batch fetch function needs postgres (see e2e tests), here we only
+    # test the worker side buffer
+    manager = PrefetchJobManager(in_memory_connector(), batch_size=3)
+    fetched = [[make_job(1), make_job(2), make_job(3)], [make_job(4)], []]
+    calls = []
+
+    async def fetch_jobs(queues, worker_id):
+        calls.append(worker_id)
+        return fetched.pop(0) if fetched else []
+
+    released = []
+
+    async def execute_query_async(query, **arguments):
+        released.extend(arguments["job_ids"])
+
+    monkeypatch.setattr(manager, "fetch_jobs", fetch_jobs)
+    monkeypatch.setattr(manager.connector, "execute_query_async", execute_query_async)
+
+    async def run():
+        # one query for 3 jobs
+        job = await manager.fetch_job(["test"], worker_id=1)
+        assert job is not None and job.id == 1
+        job = await manager.fetch_job(["test"], worker_id=1)
+        assert job is not None and job.id == 2
+        assert calls == [1]
+        # job 3 is prefetched but not started
+        return await manager.release_prefetched()
+
+    assert asyncio.run(run()) == 1
+    assert released == [3]
+
+    async def run_empty():
+        assert (await manager.fetch_job(["test"], worker_id=1)).id == 4
+        assert await manager.fetch_job(["test"], worker_id=1) is None
+        return await manager.release_prefetched()
+
+    assert asyncio.run(run_empty()) == 0
+    assert released == [3]
+
+
+def test_app_prefetch_fair_share(monkeypatch):
+    def make_row(id: int, priority: int) -> dict:
+        data = make_job(id, priority).asdict()
+        data["args"] = data.pop("task_kwargs")
+        data["queue_name"] = data.pop("queue")
+        return data
+
+    queries = []
+
+    async def execute_query_all_async(query, **arguments):
+        queries.append(query)
+        return [make_row(1, 10), make_row(2, 50), make_row(3, 10)]
+
+    manager = PrefetchJobManager(in_memory_connector(), batch_size=3)
+    monkeypatch.setattr(
+        manager.connector, "execute_query_all_async", execute_query_all_async
+    )
+    fetched = asyncio.run(manager.fetch_jobs(["test"], worker_id=1))
+    assert [j.id for j in fetched] == [2, 1, 3]  # by priority
+
+    manager.fair_share = True
+    fetched = asyncio.run(manager.fetch_jobs(["test"], worker_id=1))
+    assert [j.id for j in fetched] == [1, 2, 3]  # round-robin order
+    assert queries == [sql.BATCH_FETCH_JOBS, sql.FAIR_FETCH_JOBS]
+
+
+def test_app_prefetch_rate_limit_backoff(monkeypatch):
+    manager = PrefetchJobManager(in_memory_connector(), batch_size=1)
+    queries = []
+    notified = []
+
+    async def fetch_jobs(queues, worker_id):
+        return []
+
+    async def execute_query_one_async(query, **arguments):
+        queries.append(query)
+        return {"wait": 0.01}
+
+    async def on_notification(*, channel, notification):
+        notified.append(notification["type"])
+
+    monkeypatch.setattr(manager, "fetch_jobs", fetch_jobs)
+    monkeypatch.setattr(
+        manager.connector, "execute_query_one_async", execute_query_one_async
+    )
+    # no back off without rate limits
+    assert asyncio.run(manager.fetch_job(["test"], worker_id=1)) is None
+    assert not queries
+
+    # the fetch returns right away, the worker is woken up for the next token
+    async def fetch_and_wait():
+        asyncio.create_task(manager.listen_for_jobs(on_notification=on_notification))
+        await asyncio.sleep(0)
+        assert await manager.fetch_job(["test"], worker_id=1) is None
+        assert not notified
+        await asyncio.sleep(0.05)
+
+    manager.rate_limited = True
+    asyncio.run(fetch_and_wait())
+    assert queries == [sql.RATE_LIMIT_WAIT]
+    assert notified == ["job_inserted"]
+
+
+def test_app_prefetch_priority_aging(monkeypatch):
+    manager = PrefetchJobManager(in_memory_connector(), batch_size=1)
+    queries = []
+
+    async def fetch_jobs(queues, worker_id):
+        return []
+
+    async def execute_query_one_async(query, **arguments):
+        queries.append(query)
+        return {"aged": 3}
+
+    monkeypatch.setattr(manager, "fetch_jobs", fetch_jobs)
+    monkeypatch.setattr(
+        manager.connector, "execute_query_one_async", execute_query_one_async
+    )
+    asyncio.run(manager.fetch_job(["test"], worker_id=1))
+    assert not queries
+
+    # aging runs at most once per interval
+    manager.priority_aging = True
+    for _ in range(3):
+        asyncio.run(manager.fetch_job(["test"], worker_id=1))
+    assert queries == [sql.AGE_PRIORITIES]
+    assert asyncio.run(manager.age_priorities()) == 0
+    assert asyncio.run(manager.age_priorities(force=True)) == 3
+
+
+def test_app_prefetch_setting(monkeypatch):
+    # in-memory connector doesn't support the batch fetch function
+    monkeypatch.setenv("OPENALEPH_FETCH_BATCH_SIZE", "10")
+    monkeypatch.setenv("OPENALEPH_FETCH_FAIR_SHARE", "1")
+    monkeypatch.setenv("OPENALEPH_GEOCODE_MAX_RATE", "1")
+    monkeypatch.setenv("OPENALEPH_PRIORITY_AGING", '{"test": 1}')
+    app = App(connector=in_memory_connector())
+    assert not isinstance(app.job_manager, PrefetchJobManager)
+
+
+def test_app_sample_throughput(monkeypatch):
+    app = App(connector=in_memory_connector())
+    queries = []
+
+    async def execute_query_one_async(query, **arguments):
+        queries.append(query)
+        if len(queries) == 1:
+            raise RuntimeError("connection lost")
+        return {"sampled": True}
+
+    async def sleep(seconds):
+        assert seconds == sql.THROUGHPUT_INTERVAL
+        if len(queries) > 1:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(
+        app.connector, "execute_query_one_async", execute_query_one_async
+    )
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    # keeps sampling after errors until the worker stops
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(app.sample_throughput())
+    assert queries == [sql.SAMPLE_THROUGHPUT, sql.SAMPLE_THROUGHPUT]
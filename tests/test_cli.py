@@ -1,6 +1,7 @@
 from typer.testing import CliRunner
 
 from openaleph_procrastinate import __version__
+from openaleph_procrastinate.app import in_memory_connector
 from openaleph_procrastinate.cli import cli
 
 runner = CliRunner()
@@ -11,3 +12,39 @@ def test_cli():
     res = runner.invoke(cli, "--version")
     assert res.exit_code == 0
     assert res.stdout.strip() == __version__
+
+
+def test_cli_defer_entities(fixtures_path, monkeypatch):
+    # don't run the sync worker, the tasks are not known here
+    monkeypatch.setenv("PROCRASTINATE_SYNC", "0")
+    connector = in_memory_connector()
+    connector.reset()
+
+    res = runner.invoke(
+        cli,
+        [
+            "defer-entities",
+            "-i",
+            str(fixtures_path / "eu_authorities.ftm.json"),
+            "-d",
+            "eu_authorities",
+            "-q",
+            "test",
+            "-t",
+            "some.tasks.task",
+            "--batch-size",
+            "50",
+            "--chunk-size",
+            "2",
+            "--concurrency",
+            "2",
+        ],
+    )
+    assert res.exit_code == 0
+    jobs = list(connector.jobs.values())
+    # 151 entities in batches of 50
+    assert len(jobs) == 4
+    assert sum(len(j["args"]["payload"]["entities"]) for j in jobs) == 151
+    assert all(j["queue_name"] == "test" for j in jobs)
+    # the in-memory connector is shared across tests
+    connector.reset()
@@ -1,8 +1,18 @@
+import asyncio
+
 from anystore.store import get_store
+from followthemoney import model
 from procrastinate.testing import InMemoryConnector
 
+from openaleph_procrastinate import defer
 from openaleph_procrastinate.app import make_app
-from openaleph_procrastinate.model import Job
+from openaleph_procrastinate.model import (
+    DatasetJob,
+    Job,
+    get_payload_size,
+    make_entity_payloads,
+)
+from openaleph_procrastinate.settings import ServiceSettings
 
 
 def test_defer(tmp_path):
@@ -21,3 +31,165 @@ def test_defer(tmp_path):
     store = get_store(tmp_path)
     assert store.get("dummy_task") == {"tmp_path": str(tmp_path)}
     assert store.exists("next_task")
+
+
+def test_defer_many(tmp_path):
+    app = make_app("tests.tasks")
+    # reset stale notification handler from previous tests (see test_tracer)
+    app.connector.on_notification = None
+    jobs_before = len(app.connector.jobs)
+
+    def _jobs():
+        for i in range(4):
+            yield Job(
+                queue="test",
+                task="tests.tasks.next_task",
+                payload={"tmp_path": str(tmp_path / str(i))},
+            )
+        # explicit priority
+        job = Job(
+            queue="test",
+            task="tests.tasks.next_task",
+            payload={"tmp_path": str(tmp_path / "prio")},
+        )
+        yield job, 42
+
+    assert Job.defer_many(app, _jobs(), chunk_size=2) == 5
+    jobs = list(app.connector.jobs.values())[jobs_before:]
+    assert len(jobs) == 5
+    assert jobs[-1]["priority"] == 42
+    for i in (*range(4), "prio"):
+        assert get_store(tmp_path / str(i)).exists("next_task")
+
+
+def test_defer_bulk():
+    app = make_app("tests.tasks")
+    jobs_before = len(app.connector.jobs)
+
+    # deferring is disabled for this stage by default
+    assert not defer.tasks.transcribe.defer
+    job = DatasetJob(
+        dataset="test",
+        queue=defer.tasks.transcribe.queue,
+        task=defer.tasks.transcribe.task,
+    )
+    assert defer.bulk(app, [job]) == 0
+    assert len(app.connector.jobs) == jobs_before
+
+    assert defer.get_service(defer.tasks.index.task) == defer.tasks.index
+    assert defer.get_service("unknown.task") is None
+
+
+def test_defer_buffer(monkeypatch):
+    # don't run the sync worker, the tasks are not known here
+    monkeypatch.setenv("PROCRASTINATE_SYNC", "0")
+    app = make_app("tests.tasks")
+    app.connector.reset()
+    service = ServiceSettings(queue="test", task="tests.tasks.buffered")
+
+    def make_entities(*ids: str):
+        for id_ in ids:
+            e = model.make_entity("Person")
+            e.id = id_
+            yield e
+
+    with defer.DeferBuffer(app, max_entities=3, max_age=None) as buffer:
+        for i in range(4):
+            buffer.add(service, "test", make_entities(f"a-{i}"), foo=1)
+        # first group is full and flushed
+        assert len(app.connector.jobs) == 1
+        buffer.add(service, "test", make_entities("b-1"), foo=2)
+        buffer.add(service, "other", make_entities("c-1"), foo=1)
+        assert len(app.connector.jobs) == 1
+
+        # stages are buffered within the context
+        monkeypatch.setattr(defer.tasks, "analyze", service)
+        defer.analyze(app, "test", make_entities("a-4"), foo=1)
+        assert len(app.connector.jobs) == 1
+    # the rest is flushed when leaving the context
+    jobs = list(app.connector.jobs.values())
+    assert len(jobs) == 4
+    entities = {
+        (j["args"]["dataset"], j["args"]["payload"]["context"]["foo"]): [
+            e["id"] for e in j["args"]["payload"]["entities"]
+        ]
+        for j in jobs[1:]
+    }
+    assert jobs[0]["args"]["payload"]["entities"][2]["id"] == "a-2"
+    assert entities == {
+        ("test", 1): ["a-3", "a-4"],
+        ("test", 2): ["b-1"],
+        ("other", 1): ["c-1"],
+    }
+
+    # not buffered outside of the context anymore
+    assert defer._buffer.get() is None
+
+    # flush by age
+    with defer.DeferBuffer(app, max_age=0) as buffer:
+        buffer.add(service, "test", make_entities("d-1"))
+        assert len(app.connector.jobs) == 5
+    app.connector.reset()
+
+
+def test_defer_buffer_max_bytes(monkeypatch):
+    monkeypatch.setenv("PROCRASTINATE_SYNC", "0")
+    app = make_app("tests.tasks")
+    app.connector.reset()
+    service = ServiceSettings(queue="test", task="tests.tasks.buffered")
+
+    entities = []
+    for i in range(10):
+        e = model.make_entity("Person")
+        e.id = f"a-{i}"
+        e.add("name", "Jane Doe")
+        entities.append(e)
+    size = get_payload_size(next(make_entity_payloads(entities[:1])))
+    max_bytes = size * 3 + size // 2
+
+    with defer.DeferBuffer(app, max_bytes=max_bytes, max_age=None) as buffer:
+        buffer.add(service, "test", entities)
+    jobs = list(app.connector.jobs.values())
+    assert [len(j["args"]["payload"]["entities"]) for j in jobs] == [3, 3, 3, 1]
+    for job in jobs:
+        payloads = job["args"]["payload"]["entities"]
+        assert sum(get_payload_size(p) for p in payloads) <= max_bytes
+    app.connector.reset()
+
+
+def test_defer_async(tmp_path):
+    app = make_app("tests.tasks")
+    app.connector.reset()
+
+    async def run():
+        async with app.open_async():
+            job = Job(
+                queue="test",
+                task="tests.tasks.next_task",
+                payload={"tmp_path": str(tmp_path / "a")},
+            )
+            await job.defer_async(app)
+            jobs = (
+                Job(
+                    queue="test",
+                    task="tests.tasks.next_task",
+                    payload={"tmp_path": str(tmp_path / str(i))},
+                )
+                for i in range(3)
+            )
+            assert await Job.defer_many_async(app, jobs, chunk_size=2) == 3
+
+            # deferring is disabled for this stage by default
+            job = DatasetJob(
+                dataset="test",
+                queue=defer.tasks.transcribe.queue,
+                task=defer.tasks.transcribe.task,
+            )
+            assert await defer.bulk_async(app, [job]) == 0
+
+    asyncio.run(run())
+    assert len(app.connector.jobs) == 4
+    assert all(j["status"] == "succeeded" for j in app.connector.jobs.values())
+    for i in ("a", *range(3)):
+        assert get_store(tmp_path / str(i)).exists("next_task")
+    app.connector.reset()
@@ -0,0 +1,138 @@
+import json
+from datetime import UTC, datetime, timedelta
+
+from anystore.util import clean_dict
+from followthemoney import model
+
+from openaleph_procrastinate.model import DatasetJob, StatusCounts, Throughput
+from openaleph_procrastinate.util import json_dumps, json_loads
+
+
+def make_entities(n: int):
+    for i in range(n):
+        e = model.make_entity("Person")
+        e.id = f"p-{i}"
+        e.add("name", f"Person {i}")
+        yield e
+
+
+def test_model_iter_from_entities():
+    kwargs = {"dataset": "test", "queue": "test", "task": "tests.tasks.dummy_task"}
+
+    # no limit: one job
+    jobs = list(
+        DatasetJob.iter_from_entities(entities=make_entities(10), **kwargs, foo="bar")
+    )
+    assert len(jobs) == 1
+    assert len(jobs[0].payload["entities"]) == 10
+    assert jobs[0].payload["context"] == {"foo": "bar"}
+    assert (
+        jobs[0].model_dump()
+        == DatasetJob.from_entities(
+            entities=make_entities(10), **kwargs, foo="bar"
+        ).model_dump()
+    )
+
+    # no entities: no job
+    assert not list(DatasetJob.iter_from_entities(entities=[], **kwargs))
+
+    # by count
+    jobs = list(
+        DatasetJob.iter_from_entities(
+            entities=make_entities(10), max_entities=3, batch="b1", **kwargs
+        )
+    )
+    assert [len(j.payload["entities"]) for j in jobs] == [3, 3, 3, 1]
+    assert all(j.batch == "b1" for j in jobs)
+    assert [e["id"] for j in jobs for e in j.payload["entities"]] == [
+        f"p-{i}" for i in range(10)
+    ]
+
+    # by size
+    max_bytes = 300
+    jobs = list(
+        DatasetJob.iter_from_entities(
+            entities=make_entities(10), max_bytes=max_bytes, dehydrate=False, **kwargs
+        )
+    )
+    assert len(jobs) > 1
+    for job in jobs:
+        size = sum(
+            len(json.dumps(e, separators=(",", ":"))) for e in job.payload["entities"]
+        )
+        assert size <= max_bytes
+    assert sum(len(j.payload["entities"]) for j in jobs) == 10
+
+    # an entity larger than the limit still gets its own job
+    jobs = list(
+        DatasetJob.iter_from_entities(
+            entities=make_entities(2), max_bytes=1, dehydrate=False, **kwargs
+        )
+    )
+    assert [len(j.payload["entities"]) for j in jobs] == [1, 1]
+
+
+def test_model_entities_cached():
+    job = DatasetJob.from_entities(
+        dataset="test",
+        queue="test",
+        task="tests.tasks.dummy_task",
+        entities=make_entities(3),
+        dehydrate=False,
+    )
+    assert job.entity_ids == ["p-0", "p-1", "p-2"]
+    assert job.content_hashes == []
+
+    # parsed only once
+    entities = list(job.get_entities())
+    assert [e.id for e in entities] == job.entity_ids
+    assert job.entities is job.entities
+    assert all(a is b for a, b in zip(entities, job.get_entities()))
+
+    # replaced payload is parsed again
+    job.payload["entities"] = job.payload["entities"][:1]
+    assert [e.id for e in job.get_entities()] == ["p-0"]
+
+    doc = model.make_entity("Document")
+    doc.id = "d"
+    doc.add("contentHash", ["a", "b"])
+    job = DatasetJob.from_entities(
+        dataset="test", queue="test", task="tests.tasks.dummy_task", entities=[doc]
+    )
+    assert job.content_hashes == ["a", "b"]
+    assert [r.content_hash for r in job.get_file_references()] == ["a", "b"]
+
+
+def test_model_job_args():
+    job = DatasetJob.from_entities(
+        dataset="test",
+        queue="test",
+        task="tests.tasks.dummy_task",
+        entities=make_entities(1_000),
+        dehydrate=False,
+    )
+    args = job.to_args()
+    assert "batch" not in args
+    assert "id" not in args
+    # same content as the previous (stdlib) path that dropped empty values
+    legacy = json.dumps(clean_dict(job.model_dump(mode="json")))
+    data = json_loads(json_dumps(args))
+    assert data["payload"].pop("context") == {}
+    assert data == json.loads(legacy)
+
+
+def test_model_status_eta():
+    now = datetime.now(UTC)
+    status = StatusCounts(
+        todo=10, succeeded=10, min_ts=now - timedelta(days=1, hours=1), max_ts=now
+    )
+    # lifetime average including the days
+    assert status.remaining_time == timedelta(days=1, hours=1)
+    assert status.eta == status.remaining_time
+
+    # recent throughput
+    status.throughput = Throughput(jobs=2, entities=20)
+    assert status.eta == timedelta(minutes=5)
+    # nothing finished recently
+    status.throughput = Throughput()
+    assert status.eta is None
@@ -11,7 +11,7 @@ carries an explicit (validation) alias.
 
 from pydantic_settings import SettingsConfigDict
 
-from openaleph_procrastinate.settings import OpenAlephSettings
+from openaleph_procrastinate.settings import DeferSettings, OpenAlephSettings
 
 
 class DownstreamSettings(OpenAlephSettings):
@@ -117,3 +117,50 @@ def test_settings_lakehouse_disables_dehydrate(monkeypatch):
     settings = OpenAlephSettings(_env_file=None)
     assert settings.lakehouse is True
     assert settings.procrastinate_dehydrate_entities is False
+
+
+def test_settings_defer_service_fields(monkeypatch):
+    # service settings with an underscore must not be split up as nested keys
+    monkeypatch.setenv("OPENALEPH_INDEX_MAX_RETRIES", "2")
+    monkeypatch.setenv("OPENALEPH_INDEX_MAX_ENTITIES", "100")
+    monkeypatch.setenv("OPENALEPH_LOAD_MAPPING_DEFER", "false")
+    settings = DeferSettings(_env_file=None)
+    assert settings.index.max_retries == 2
+    assert settings.index.max_entities == 100
+    assert settings.index.chunked
+    assert not settings.analyze.chunked
+    assert settings.load_mapping.defer is False
+
+
+def test_settings_rate_limits(monkeypatch):
+    monkeypatch.setenv("OPENALEPH_TRANSCRIBE_MAX_RATE", "0.5")
+    monkeypatch.setenv("OPENALEPH_GEOCODE_MAX_RATE", "20")
+    monkeypatch.setenv("OPENALEPH_GEOCODE_RATE_PER_ENTITY", "true")
+    monkeypatch.setenv("OPENALEPH_GEOCODE_RATE_BURST", "100")
+    settings = DeferSettings(_env_file=None)
+    assert settings.transcribe.max_rate == 0.5
+    assert settings.transcribe.burst == 1
+    assert settings.geocode.rate_per_entity
+    assert settings.geocode.burst == 100
+    assert settings.index.max_rate is None
+    limited = {n for n, s in settings.services.items() if s.max_rate}
+    assert limited == {"transcribe", "geocode"}
+
+
+def test_settings_priority_aging(monkeypatch):
+    assert OpenAlephSettings(_env_file=None).priority_aging == {}
+    monkeypatch.setenv("OPENALEPH_PRIORITY_AGING", '{"openaleph": 0.5, "ingest": 2}')
+    settings = OpenAlephSettings(_env_file=None)
+    assert settings.priority_aging == {"openaleph": 0.5, "ingest": 2.0}
+
+
+def test_settings_db_pool(monkeypatch):
+    settings = OpenAlephSettings(_env_file=None)
+    assert settings.db_pool_timeout == 30
+    assert settings.db_pool_max_idle == 300
+    assert settings.db_pool_max_lifetime == 3600
+    monkeypatch.setenv("OPENALEPH_DB_POOL_TIMEOUT", "5")
+    monkeypatch.setenv("OPENALEPH_DB_POOL_MAX_IDLE", "60")
+    settings = OpenAlephSettings(_env_file=None)
+    assert settings.db_pool_timeout == 5
+    assert settings.db_pool_max_idle == 60
@@ -0,0 +1,27 @@
+from openaleph_procrastinate.manage import sql
+
+
+def test_sql_compile_filters():
+    query = f"SELECT id FROM {sql.JOBS} WHERE {sql.FILTERS}"
+    assert sql.compile_filters(query) == f"SELECT id FROM {sql.JOBS} WHERE true"
+    assert sql.compile_filters(query, dataset=None, batch=None) == (
+        f"SELECT id FROM {sql.JOBS} WHERE true"
+    )
+    assert sql.compile_filters(query, dataset="d", task="t", other="o") == (
+        f"SELECT id FROM {sql.JOBS} "
+        "WHERE dataset = %(dataset)s AND task_name = %(task)s"
+    )
+    compiled = sql.compile_filters(sql.CANCEL_JOBS, queue="q")
+    assert compiled.count("AND queue_name = %(queue)s") == 3
+    assert "IS NULL" not in compiled
+    for query in (
+        sql.STATUS_SUMMARY,
+        sql.STATUS_SUMMARY_ACTIVE,
+        sql.ALL_JOBS,
+        sql.JOBS_PAGE,
+        sql.DUMP_JOBS,
+        sql.GET_FAILED_JOBS,
+        sql.GET_ORPHANED_JOBS,
+    ):
+        assert sql.FILTERS in query
+        assert sql.FILTERS not in sql.compile_filters(query, status="todo")
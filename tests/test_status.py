@@ -0,0 +1,172 @@
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+from itertools import product
+
+import fakeredis
+
+from openaleph_procrastinate.manage import status
+from openaleph_procrastinate.manage.status import DEFAULT_BACH, StatusCache
+from openaleph_procrastinate.model import SYSTEM_DATASET, DatasetStatus
+
+STATUSES = ("todo", "doing", "succeeded", "failed")
+
+
+def make_status_rows(datasets: int, rates: tuple[float, float] | None = None):
+    # ordered like the status summary query
+    now = datetime.now(UTC)
+    jobs_per_minute, entities_per_minute = rates or (None, None)
+    groups = product(range(datasets), ("1", "2"), ("index", "ingest"))
+    for (d, batch, queue), (i, job_status) in product(groups, enumerate(STATUSES)):
+        min_ts = now - timedelta(hours=d % 5 + i)
+        max_ts = now - timedelta(minutes=i)
+        yield (
+            f"d{d:05}",
+            batch,
+            queue,
+            "a",
+            job_status,
+            i + 1,
+            min_ts,
+            max_ts,
+            jobs_per_minute,
+            entities_per_minute,
+        )
+
+
+def _mock_gather_status(monkeypatch) -> list[int]:
+    calls = []
+
+    def _gather_status(dataset=None, active_only=True):
+        calls.append(1)
+        time.sleep(0.1)  # a slow query
+        yield DatasetStatus(name="active", todo=1)
+        yield DatasetStatus(name="done", succeeded=1)
+
+    monkeypatch.setattr(status, "_gather_status", _gather_status)
+    return calls
+
+
+def test_status_cache(monkeypatch):
+    calls = _mock_gather_status(monkeypatch)
+    cache = StatusCache(ttl=60)
+
+    # concurrent misses are coalesced into one query
+    threads = [threading.Thread(target=cache.get) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert set(cache.get()) == {"active", "done"}
+    assert cache.get()["active"] == cache.get()["active"]
+    assert len(calls) == 1
+
+    # callers get copies of the cached status
+    cache.get()["active"].todo = 100
+    assert cache.get()["active"] is not cache.get()["active"]
+    assert cache.get()["active"].todo == 1
+
+    # expired
+    cache.ttl = 0
+    cache.get()
+    assert len(calls) == 2
+
+    # readers
+    monkeypatch.setattr(status, "get_status_cache", lambda: cache)
+    cache.ttl = 60
+    assert [s.name for s in status.get_status()] == ["active"]
+    assert [s.name for s in status.get_status(active_only=False)] == [
+        "active",
+        "done",
+    ]
+    assert status.get_dataset_status("active").todo == 1
+    assert status.get_dataset_status("done").succeeded == 0
+    assert status.get_dataset_status("done", active_only=False).succeeded == 1
+    assert status.get_dataset_status("other").total == 0
+    assert len(calls) == 2
+
+
+def test_status_cache_shared(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        status.Redis,
+        "from_url",
+        lambda uri: fakeredis.FakeStrictRedis(server=server),
+    )
+    calls = _mock_gather_status(monkeypatch)
+    uri = "redis://localhost"
+
+    # another process refreshed the snapshot already
+    StatusCache(ttl=60, uri=uri).clear()
+    StatusCache(ttl=60, uri=uri).get()
+    assert len(calls) == 1
+    datasets = StatusCache(ttl=60, uri=uri).get()
+    assert len(calls) == 1
+    assert datasets["active"].todo == 1
+
+    # processes waiting for another one refreshing
+    caches = [StatusCache(ttl=60, uri=uri) for _ in range(5)]
+    caches[0].clear()
+    threads = [threading.Thread(target=c.get) for c in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 2
+    assert all(set(c.get()) == {"active", "done"} for c in caches)
+
+    # only the owner releases the refresh lock
+    redis = fakeredis.FakeStrictRedis(server=server)
+    assert redis.get(status.REFRESH_LOCK_KEY) is None
+    redis.set(status.REFRESH_LOCK_KEY, "other")
+    caches[0]._release("mine")
+    assert redis.get(status.REFRESH_LOCK_KEY) == b"other"
+    caches[0]._release("other")
+    assert redis.get(status.REFRESH_LOCK_KEY) is None
+
+
+def test_status_build():
+    rows = list(make_status_rows(10))
+    datasets = list(status._build_status(rows))
+    assert [d.name for d in datasets] == [f"d{d:05}" for d in range(10)]
+    assert datasets[0].total == 2 * 2 * (1 + 2 + 3 + 4)
+    assert [b.name for b in datasets[0].batches] == ["1", "2"]
+    assert [q.name for q in datasets[0].batches[0].queues] == ["index", "ingest"]
+    task = datasets[0].batches[0].queues[0].tasks[0]
+    assert (task.todo, task.doing, task.succeeded, task.failed) == (1, 2, 3, 4)
+    # the bounds over all status rows of the task
+    task_rows = rows[:4]
+    assert task.min_ts == min(r[6] for r in task_rows)
+    assert task.max_ts == max(r[7] for r in task_rows)
+    assert datasets[0].min_ts == task.min_ts
+    assert not list(status._build_status([]))
+
+    # rows without dataset or batch
+    row = (None, None, "index", "a", "todo", 1, None, None, None, None)
+    dataset = next(status._build_status([row]))
+    assert dataset.name == SYSTEM_DATASET
+    assert dataset.batches[0].name == DEFAULT_BACH
+    assert dataset.min_ts is None
+
+    # streaming: a dataset is emitted before the rows of the next one are read
+    consumed = []
+
+    def _rows():
+        for row in make_status_rows(3):
+            consumed.append(row[0])
+            yield row
+
+    built = status._build_status(_rows())
+    assert next(built).name == "d00000"
+    assert set(consumed) == {"d00000", "d00001"}
+
+    # throughput is summed up the tree, 4 tasks with 2 jobs/min each
+    dataset = next(status._build_status(make_status_rows(1, rates=(2, 20))))
+    assert dataset.throughput is not None
+    assert dataset.throughput.jobs == 8
+    assert dataset.throughput.entities == 80
+    assert dataset.batches[0].queues[0].throughput.jobs == 2
+    # 4 tasks with 1 todo and 2 doing jobs
+    assert dataset.active == 12
+    assert dataset.eta == timedelta(minutes=12 / 8)
@@ -0,0 +1,54 @@
+from followthemoney import model
+from followthemoney.proxy import EntityProxy
+
+from openaleph_procrastinate.model import DatasetJob
+from openaleph_procrastinate.tasks import unpack_job
+
+
+def make_job_data(n: int) -> dict:
+    entities = []
+    for i in range(n):
+        e = model.make_entity("Document")
+        e.id = f"doc-{i}"
+        e.add("fileName", f"file-{i}.pdf")
+        e.add("contentHash", f"{i:040d}")
+        entities.append(e)
+    job = DatasetJob.from_entities(
+        dataset="test",
+        queue="test",
+        task="tests.tasks.dummy_task",
+        entities=entities,
+        dehydrate=False,
+    )
+    return job.model_dump(mode="json", exclude_none=True)
+
+
+def test_tasks_unpack_job():
+    data = make_job_data(1_000)
+    job = unpack_job(data)
+    assert isinstance(job, DatasetJob)
+    assert len(job.entity_ids) == 1_000
+    # entities are parsed lazily, not during unpacking
+    assert job._entities is None
+
+
+def test_tasks_unpack_job_no_parsing(monkeypatch):
+    # the `payload` is validated shallow (`dict[str, Any]`), so unpacking a job
+    # doesn't parse its entities, only accessing them does (once)
+    data = make_job_data(100)
+    parsed = []
+    init = EntityProxy.__init__
+
+    def _init(self, *args, **kwargs):
+        parsed.append(1)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(EntityProxy, "__init__", _init)
+    job = unpack_job(data)
+    assert isinstance(job, DatasetJob)
+    assert len(job.entity_ids) == 100
+    assert len(job.content_hashes) == 100
+    assert not parsed
+    assert len(list(job.get_entities())) == 100
+    assert len(list(job.get_entities())) == 100
+    assert len(parsed) == 100
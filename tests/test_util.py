@@ -1,5 +1,6 @@
 import pytest
 from followthemoney import model
+from followthemoney.proxy import EntityProxy
 
 from openaleph_procrastinate import util
 
@@ -39,3 +40,66 @@ def test_util():
             util.make_stub_entity(e)
         with pytest.raises(RuntimeError):
             util.make_file_entity(e)
+
+
+def test_util_batched():
+    assert list(util.batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(util.batched([], 2)) == []
+    with pytest.raises(ValueError):
+        list(util.batched(range(5), 0))
+
+
+def test_util_json():
+    data = {"a": [1, "ä", None], "b": {"c": 1.5}, 1: True}
+    assert util.json_dumps(data) == b'{"a":[1,"\xc3\xa4",null],"b":{"c":1.5},"1":true}'
+    assert util.json_loads(util.json_dumps(data)) == {
+        "a": [1, "ä", None],
+        "b": {"c": 1.5},
+        "1": True,
+    }
+
+
+def test_util_file_entity_data():
+    e = model.make_entity("Document")
+    e.id = "a"
+    e.add("fileName", "test.txt")
+    e.add("contentHash", "123")
+    e.add("parent", "1")
+    e.add("ancestors", ["1", "2"])
+    e.add("title", "A document")
+    p = model.make_entity("Person")
+    p.id = "b"
+    p.add("name", "Jane")
+
+    # same result as building the intermediate file entity
+    for entity in (e, p):
+        expected = util.make_file_entity(entity, quiet=True).to_dict()
+        assert util.make_file_entity_data(entity) == expected
+
+    # payload data doesn't share the property values with the entity
+    data = util.make_file_entity_data(e)
+    data["properties"]["ancestors"].append("3")
+    assert e.get("ancestors") == ["1", "2"]
+
+    p.id = None
+    with pytest.raises(RuntimeError):
+        util.make_file_entity_data(p)
+
+
+def test_util_file_entity_data_no_proxies(monkeypatch):
+    # the dict-level path doesn't build (and validate) intermediate entities
+    e = model.make_entity("Document")
+    e.id = "a"
+    e.add("fileName", "test.txt")
+    created = []
+    init = EntityProxy.__init__
+
+    def _init(self, *args, **kwargs):
+        created.append(1)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(EntityProxy, "__init__", _init)
+    util.make_file_entity_data(e)
+    assert not created
+    util.make_file_entity(e, quiet=True).to_dict()
+    assert created